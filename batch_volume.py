@@ -0,0 +1,205 @@
+# coding: utf8
+"""
+无界面的批量体积计算
+
+遍历根目录下所有DICOM序列，在进程池中并行计算掩膜各标签的体积，结果写入CSV或Parquet
+每完成一个序列就追加写入检查点文件，中断后使用相同的参数重新运行会跳过已完成的序列
+
+用法:
+    python batch_volume.py /data/studies --roi roi.nii.gz --workers 8 --output volumes.csv
+    python batch_volume.py /data/studies --roi roi.nii.gz --output volumes.parquet --labels 1 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import SimpleITK as sitk
+from utils.export import COLUMN_TYPES, iter_csv, record_rows
+from utils.filehelper import iter_dicom_folders
+from utils.pipeline import compute_volume_record
+
+
+def _init_worker(itk_threads, quiet):
+    # 多个工作进程并行时限制每个进程内ITK的线程数，避免CPU过度订阅
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(itk_threads)
+    if quiet:
+        # 屏蔽体积计算中逐个序列的 print 输出
+        sys.stdout = open(os.devnull, "w")
+
+
+def load_checkpoint(path):
+    """
+    读取检查点文件，返回 {DICOM目录: 任务结果}，同一目录以最后一条为准
+    中断时可能写了一半的最后一行会被忽略
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["folder_path"]] = record
+    return records
+
+
+def to_checkpoint(record):
+    # 体积字典的键为标签值，转换为列表以便写入JSON
+    record = dict(record)
+    if "volumes" in record:
+        record["volumes"] = [[label, bucket] for label, bucket in record["volumes"].items()]
+    return record
+
+
+def write_output(path, file_format, records):
+    tmp_path = path + ".tmp"
+    if file_format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("写入Parquet需要安装 pyarrow: pip install pyarrow")
+        types = {"str": pyarrow.string(), "int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_()}
+        table = pyarrow.Table.from_pylist([row for record in records for row in record_rows(record)],
+                                          schema=pyarrow.schema([(name, types[kind]) for name, kind in COLUMN_TYPES]))
+        pyarrow.parquet.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, "wb") as f:
+            for chunk in iter_csv(records):
+                f.write(chunk)
+    os.replace(tmp_path, path)
+    return sum(1 for record in records for _ in record_rows(record))
+
+
+def summarize_stages(records):
+    # 各阶段耗时的次数、平均值与分位数 (毫秒)
+    samples = {}
+    for record in records:
+        for stage, elapsed_ms in record.get("stats", {}).get("stages", {}).items():
+            samples.setdefault(stage, []).append(elapsed_ms)
+    summary = {}
+    for stage, values in samples.items():
+        values.sort()
+        summary[stage] = {
+            "count": len(values),
+            "total_s": sum(values) / 1000.0,
+            "mean_ms": statistics.fmean(values),
+            "p50_ms": values[len(values) // 2],
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+    return summary
+
+
+def print_summary(processed, failed, skipped, elapsed, records):
+    rate = processed / elapsed * 60.0 if elapsed > 0 else 0.0
+    print("完成 {} 个序列 (失败 {}，跳过已完成 {})，耗时 {:.1f} s，吞吐量 {:.1f} 序列/分钟".format(
+        processed, failed, skipped, elapsed, rate))
+    summary = summarize_stages(records)
+    if not summary:
+        return
+    print("{:<20} {:>8} {:>12} {:>12} {:>12} {:>12}".format("stage", "count", "total_s", "mean_ms", "p50_ms", "p95_ms"))
+    for stage, row in sorted(summary.items(), key=lambda item: -item[1]["total_s"]):
+        print("{:<20} {count:>8} {total_s:>12.2f} {mean_ms:>12.2f} {p50_ms:>12.2f} {p95_ms:>12.2f}".format(stage, **row))
+
+
+def run(args):
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint.jsonl"
+    records = load_checkpoint(checkpoint_path)
+    # 已成功的序列不再计算，失败的序列只在 --retry-failed 时重新计算
+    done = {folder for folder, record in records.items()
+            if record["roi_file"] == args.roi and (record["status"] == "success" or not args.retry_failed)}
+
+    workers = max(1, args.workers)
+    itk_threads = max(1, (multiprocessing.cpu_count() or 1) // workers)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(itk_threads, not args.verbose))
+    # 限制已提交但未完成的任务数，遍历与计算同时进行
+    max_pending = workers * 4
+    pending = {}
+    run_records, processed, failed, skipped = [], 0, 0, 0
+    start = time.perf_counter()
+
+    def collect(done_futures):
+        nonlocal processed, failed
+        for future in done_futures:
+            folder = pending.pop(future)
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"folder_path": folder, "roi_file": args.roi, "status": "error",
+                          "message": f"体积计算失败: {str(e)}", "stats": {"stages": {}}}
+            record = to_checkpoint(record)
+            checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+            records[folder] = record
+            run_records.append(record)
+            processed += 1
+            failed += record["status"] != "success"
+            if args.progress and processed % args.progress == 0:
+                elapsed = time.perf_counter() - start
+                print("已完成 {} 个序列，{:.1f} 序列/分钟".format(processed, processed / elapsed * 60.0), flush=True)
+
+    interrupted = False
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        try:
+            for folder in iter_dicom_folders(args.root, args.discovery_workers):
+                if folder in done:
+                    skipped += 1
+                    continue
+                while len(pending) >= max_pending:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                future = pool.submit(compute_volume_record, folder, args.roi, args.labels, not args.no_cache,
+                                     args.intensity)
+                pending[future] = folder
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+        except KeyboardInterrupt:
+            # 已完成的结果都已写入检查点，重新运行时从中断处继续
+            interrupted = True
+            print("已中断，重新运行相同的命令可继续未完成的序列", file=sys.stderr)
+        finally:
+            pool.shutdown(wait=not interrupted, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    rows = write_output(args.output, args.format, sorted(records.values(), key=lambda r: r["folder_path"]))
+    print("结果已写入 {} ({} 行)".format(args.output, rows))
+    print_summary(processed, failed, skipped, elapsed, run_records)
+    return 130 if interrupted else (1 if failed else 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量计算DICOM序列中掩膜各标签的体积 (无界面)")
+    parser.add_argument("root", help="包含DICOM序列的根目录")
+    parser.add_argument("--roi", required=True, help="ROI文件名 (位于每个DICOM目录的上一级)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="计算进程数")
+    parser.add_argument("--discovery-workers", type=int, default=None, help="遍历目录的线程数")
+    parser.add_argument("--labels", type=int, nargs="+", default=None, help="要计算的标签值 (默认所有非零标签)")
+    parser.add_argument("--output", default="volumes.csv", help="输出文件 (.csv 或 .parquet)")
+    parser.add_argument("--format", choices=("csv", "parquet"), help="输出格式 (默认按扩展名判断)")
+    parser.add_argument("--checkpoint", help="检查点文件 (默认为 <output>.checkpoint.jsonl)")
+    parser.add_argument("--retry-failed", action="store_true", help="重新计算检查点中失败的序列")
+    parser.add_argument("--no-cache", action="store_true", help="不读取和写入体积结果缓存")
+    parser.add_argument("--intensity", action="store_true",
+                        help="同时统计各标签的CT值 (mean_hu、min_hu、max_hu、std_hu)，需要解码DICOM像素")
+    parser.add_argument("--verbose", action="store_true", help="输出每个序列的计算日志")
+    parser.add_argument("--progress", type=int, default=100, help="每完成多少个序列打印一次进度 (0为不打印)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.root):
+        parser.error("根目录不存在: {}".format(args.root))
+    if args.format is None:
+        args.format = "parquet" if args.output.lower().endswith(".parquet") else "csv"
+    return run(args)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# coding: utf8
+"""
+DICOM目录查找的基准测试
+
+在生成的深层目录树上比较：
+  os_walk       原来的做法：os.walk 找出所有末级目录 (不检查是否包含DICOM文件)
+  scandir_N     iter_dicom_folders 用 N 个线程并行 scandir，只返回包含DICOM文件的目录
+  index_cold    SeriesIndex.scan 首次扫描 (读取文件头并写入SQLite索引)
+  index_warm    目录未修改时再次扫描 (只比较目录的修改时间)
+并校验各方法找到的序列目录与生成时记录的一致 (os_walk 另外报告多出的非DICOM目录数)
+--cold 时每次测量前清空页缓存 (需要root，写 /proc/sys/vm/drop_caches)
+
+用法:
+    python -m benchmarks.bench_discovery --depth 5 --fanout 4 --workers 1 4 8 16 --output discovery.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from benchmarks.synthetic import make_tree
+from utils.filehelper import iter_dicom_folders
+from utils.seriesindex import SeriesIndex
+
+
+def walk_leaf_folders(root):
+    # 原来的做法 (os.walk)：没有子目录的目录都视为DICOM目录
+    return [path for path, dirs, _ in os.walk(root) if not dirs]
+
+
+def drop_caches():
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except OSError:
+        return False
+
+
+def measure(fn, repeat, cold):
+    times, result = [], None
+    for _ in range(repeat):
+        if cold:
+            drop_caches()
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return result, {"ms_median": round(statistics.median(times), 3), "ms_min": round(min(times), 3)}
+
+
+def run(args, workdir):
+    tree_root = os.path.join(workdir, "tree")
+    expected_path = os.path.join(workdir, "series.json")
+    if os.path.exists(expected_path):
+        with open(expected_path) as f:
+            expected = json.load(f)
+    else:
+        expected = make_tree(workdir, depth=args.depth, fanout=args.fanout, series_every=args.series_every)
+        with open(expected_path, "w") as f:
+            json.dump(expected, f)
+    expected_set = set(expected)
+    directories = sum(1 for _ in os.walk(tree_root))
+
+    rows = {}
+    found, rows["os_walk"] = measure(lambda: walk_leaf_folders(tree_root), args.repeat, args.cold)
+    rows["os_walk"].update(found=len(found), missing=len(expected_set - set(found)),
+                           non_dicom=len(set(found) - expected_set))
+    for workers in args.workers:
+        found, row = measure(lambda: list(iter_dicom_folders(tree_root, workers)), args.repeat, args.cold)
+        row.update(found=len(found), correct=set(found) == expected_set)
+        rows["scandir_{}".format(workers)] = row
+
+    # 索引扫描：首次扫描只测一次，之后的扫描目录未修改
+    index_path = os.path.join(workdir, "index.sqlite")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = SeriesIndex(index_path)
+    workers = max(args.workers)
+    found, rows["index_cold"] = measure(lambda: index.scan(tree_root, workers), 1, args.cold)
+    rows["index_cold"].update(found=len(found), correct={s["folder"] for s in found} == expected_set)
+    found, rows["index_warm"] = measure(lambda: index.scan(tree_root, workers), args.repeat, args.cold)
+    rows["index_warm"].update(found=len(found), correct={s["folder"] for s in found} == expected_set)
+
+    baseline = rows["os_walk"]["ms_median"]
+    for row in rows.values():
+        row["relative_to_os_walk"] = round(row["ms_median"] / baseline, 2) if baseline else None
+    return {"depth": args.depth, "fanout": args.fanout, "directories": directories, "series": len(expected),
+            "cold": args.cold, "cpu_count": os.cpu_count(), "methods": rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DICOM目录查找的基准测试 (生成的深层目录树)")
+    parser.add_argument("--depth", type=int, default=5, help="目录树的深度")
+    parser.add_argument("--fanout", type=int, default=4, help="每个目录的子目录数")
+    parser.add_argument("--series-every", type=int, default=2, help="每隔几个末级目录放一个DICOM序列")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16], help="并行遍历的线程数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cold", action="store_true", help="每次测量前清空页缓存 (需要root)")
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录并在结束后删除；指定时复用已生成的目录树)")
+    parser.add_argument("--output", default="benchmark_discovery.json")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="volumer_discovery_")
+    try:
+        result = run(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("目录数: {}, 序列数: {}".format(result["directories"], result["series"]))
+    print("{:<12} {:>10} {:>8} {:>10} {:>10}".format("method", "ms_median", "found", "correct", "relative"))
+    for name, row in result["methods"].items():
+        correct = row.get("correct", "non_dicom={}".format(row.get("non_dicom")))
+        print("{:<12} {:>10.1f} {:>8} {:>10} {:>10}".format(
+            name, row["ms_median"], row["found"], str(correct), row["relative_to_os_walk"]))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print("结果已写入", args.output)
+
+
+if __name__ == "__main__":
+    main()
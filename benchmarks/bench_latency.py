@@ -0,0 +1,174 @@
+# coding: utf8
+"""
+体积计算负载下其他接口的响应延迟
+
+启动一个真实的服务进程，同时发起 --concurrency 个 /calculate_volume 请求 (不使用结果缓存，也不会被合并)，
+在计算进行期间持续请求静态页面与 /traverse_folder，记录两者的延迟分位数，
+并与没有负载时的延迟对比；排队已满被拒绝的体积请求 (503) 单独计数
+
+用法:
+    python -m benchmarks.bench_latency --concurrency 64 --size 256 --slices 64 --output latency.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from benchmarks.bench_push import Server
+from benchmarks.synthetic import make_study
+
+STATIC_PATH = "/static/html/index.html"
+
+
+def timed_request(server, method, path, body=None):
+    """
+    :return: (HTTP状态码, 耗时秒数)
+    """
+    conn = server.connect()
+    try:
+        start = time.perf_counter()
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        conn.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def summarize(samples):
+    # 延迟分位数 (毫秒)
+    if not samples:
+        return {"count": 0}
+    values = sorted(seconds * 1000.0 for seconds in samples)
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values), 2),
+        "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+        "max_ms": round(values[-1], 2),
+    }
+
+
+def probe(server, root, roi_file, stop, interval):
+    """
+    在 stop 置位前交替请求静态页面与 /traverse_folder
+    :return: {"static": [秒], "traverse_folder": [秒], "errors": 非200的响应数}
+    """
+    samples = {"static": [], "traverse_folder": [], "errors": 0}
+    while not stop.is_set():
+        status, seconds = timed_request(server, "GET", STATIC_PATH)
+        samples["static"].append(seconds)
+        samples["errors"] += status != 200
+        status, seconds = timed_request(server, "POST", "/traverse_folder",
+                                        {"folder_path": root, "roi_file": roi_file})
+        samples["traverse_folder"].append(seconds)
+        samples["errors"] += status != 200
+        stop.wait(interval)
+    return samples
+
+
+def run_load(server, items, concurrency, labels):
+    # 同时发起 concurrency 个体积计算请求，返回各状态码的数量与总耗时
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(index):
+        folder_path, roi_file = items[index % len(items)]
+        # 各请求的标签列表不同 (多出的标签不存在)，不会被合并为同一次计算
+        label_values = list(range(1, labels + 1)) + [1000 + index]
+        status, _ = timed_request(server, "POST", "/calculate_volume",
+                                  {"folder_path": folder_path, "roi_file": roi_file, "use_cache": False,
+                                   "label_values": label_values})
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(index, )) for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, time.perf_counter() - start
+
+
+def run(args, workdir):
+    data_dir = os.path.join(workdir, "data")
+    items = make_study(data_dir, patients=args.patients, size=(args.size, args.size), slices=args.slices,
+                       labels=args.labels)
+    roi_file = items[0][1]
+    extra_env = {"VOLUMER_VOLUME_QUEUE_DEPTH": str(args.queue_depth)}
+    if args.max_jobs:
+        extra_env["VOLUMER_MAX_VOLUME_JOBS"] = str(args.max_jobs)
+    server = Server(workdir, args.workers, extra_env)
+    try:
+        # 启动工作进程并建立序列索引
+        timed_request(server, "POST", "/calculate_volume", {"folder_path": items[0][0], "roi_file": roi_file})
+        timed_request(server, "POST", "/traverse_folder", {"folder_path": data_dir, "roi_file": roi_file})
+
+        # 没有负载时的延迟
+        stop = threading.Event()
+        timer = threading.Timer(args.idle_seconds, stop.set)
+        timer.start()
+        idle = probe(server, data_dir, roi_file, stop, args.interval)
+
+        # 体积计算负载期间的延迟
+        stop = threading.Event()
+        loaded = {}
+        prober = threading.Thread(target=lambda: loaded.update(probe(server, data_dir, roi_file, stop, args.interval)))
+        prober.start()
+        statuses, load_s = run_load(server, items, args.concurrency, args.labels)
+        stop.set()
+        prober.join()
+    finally:
+        server.stop()
+    return {
+        "concurrency": args.concurrency, "workers": args.workers, "queue_depth": args.queue_depth,
+        "size": args.size, "slices": args.slices, "load_s": round(load_s, 3),
+        "volume_statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "rejected_503": statuses.get(503, 0),
+        "idle": {name: summarize(idle[name]) for name in ("static", "traverse_folder")},
+        "loaded": {name: summarize(loaded[name]) for name in ("static", "traverse_folder")},
+        "probe_errors": idle["errors"] + loaded["errors"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="体积计算负载下其他接口的响应延迟 (合成数据)")
+    parser.add_argument("--concurrency", type=int, default=64, help="同时发起的体积计算请求数")
+    parser.add_argument("--patients", type=int, default=4, help="生成的序列数 (各请求循环使用)")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--labels", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2, help="服务的体积计算进程数")
+    parser.add_argument("--max-jobs", type=int, default=0, help="同时执行的体积计算任务数 (默认与进程数相同)")
+    parser.add_argument("--queue-depth", type=int, default=32, help="排队等待的体积计算请求数上限")
+    parser.add_argument("--idle-seconds", type=float, default=3.0, help="测量无负载延迟的时间")
+    parser.add_argument("--interval", type=float, default=0.05, help="探测请求之间的间隔 (秒)")
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录并在结束后删除)")
+    parser.add_argument("--output", default="benchmark_latency.json")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="volumer_latency_")
+    try:
+        result = run(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("体积请求: {} 个, 耗时 {:.2f}s, 状态码 {}".format(
+        args.concurrency, result["load_s"], result["volume_statuses"]))
+    print("{:<8} {:<16} {:>7} {:>9} {:>9} {:>9}".format("phase", "endpoint", "count", "p50_ms", "p95_ms", "max_ms"))
+    for phase in ("idle", "loaded"):
+        for name, row in result[phase].items():
+            print("{:<8} {:<16} {:>7} {:>9} {:>9} {:>9}".format(
+                phase, name, row["count"], row.get("p50_ms", "-"), row.get("p95_ms", "-"), row.get("max_ms", "-")))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print("结果已写入", args.output)
+
+
+if __name__ == "__main__":
+    main()
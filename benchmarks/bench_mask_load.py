@@ -0,0 +1,150 @@
+# coding: utf8
+"""
+掩膜加载的基准测试
+
+生成斜位的合成掩膜，分别以 sform 与 qform、仅 sform、仅 qform、sform_code 为 ALIGNED_ANAT (与 qform 不同)
+和 .nii.gz 保存，比较：
+  sitk_read   sitk.ReadImage 读取后统计标签直方图
+  memmap      Volumer._load_mask_image (未压缩 .nii 内存映射，其余回退到 sitk.ReadImage) 后统计标签直方图
+并校验两者的原点、间距、方向与体素逐一一致
+--cold 时每次读取前用 posix_fadvise 把掩膜文件移出页缓存，测量包含文件读取的耗时
+
+用法:
+    python -m benchmarks.bench_mask_load --size 512 512 --slices 300 --output mask_load.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import struct
+import tempfile
+import time
+import numpy as np
+import SimpleITK as sitk
+from benchmarks.bench_decode import drop_file_cache
+from benchmarks.synthetic import make_mask
+from utils.cache import get_mask_cache
+from utils.nifti import memmap_nifti
+from utils.volumer import DicomVolumer, MappedImage, ReferenceGeometry, label_histogram
+
+# NIfTI-1 文件头中 qform_code 与 sform_code (int16)、qoffset (3个float32) 的偏移
+QFORM_CODE_OFFSET = 252
+SFORM_CODE_OFFSET = 254
+QOFFSET_OFFSET = 268
+# 掩膜保存方式: (文件名, {文件头偏移: (格式, 写入的值)})
+VARIANTS = {
+    "sform_qform": ("roi.nii", {}),
+    "sform_only": ("roi_sform.nii", {QFORM_CODE_OFFSET: ("<h", (0, ))}),
+    "qform_only": ("roi_qform.nii", {SFORM_CODE_OFFSET: ("<h", (0, ))}),
+    # sform_code 为 2 (ALIGNED_ANAT) 且 qform 与 sform 不同：ITK 使用 qform
+    "aligned_anat": ("roi_aligned.nii", {SFORM_CODE_OFFSET: ("<h", (2, )),
+                                          QOFFSET_OFFSET: ("<3f", (-110.0, -80.0, -50.0))}),
+    "nii_gz": ("roi.nii.gz", {}),
+}
+GEOMETRY_TOLERANCE = 1e-4
+
+
+def write_variant(path, mask, patches):
+    # ITK 同时写入 sform 与 qform，需要时修改文件头中的变换代码或 qform 的原点
+    sitk.WriteImage(mask, path)
+    if patches:
+        with open(path, "r+b") as f:
+            for offset, (fmt, values) in patches.items():
+                f.seek(offset)
+                f.write(struct.pack(fmt, *values))
+
+
+def _array(image):
+    return image.array if isinstance(image, MappedImage) else sitk.GetArrayViewFromImage(image)
+
+
+def load_with_sitk(path):
+    image = sitk.ReadImage(path)
+    return image, label_histogram(sitk.GetArrayViewFromImage(image))
+
+
+def load_with_volumer(path):
+    volumer = DicomVolumer(use_memmap=True)
+    image = volumer._load_mask_image(path)
+    return image, label_histogram(_array(image)), volumer.stats["mask_loader"]
+
+
+def measure(fn, path, repeat, cold):
+    times, result = [], None
+    for _ in range(repeat):
+        # 回退到 sitk.ReadImage 时不使用进程内的掩膜缓存
+        get_mask_cache().clear()
+        if cold:
+            drop_file_cache([path])
+        start = time.perf_counter()
+        result = fn(path)
+        times.append((time.perf_counter() - start) * 1000.0)
+    return result, {"ms_median": round(statistics.median(times), 3), "ms_min": round(min(times), 3)}
+
+
+def compare_geometry(image, expected):
+    # 原点、间距、方向与 sitk.ReadImage 的差异是否都在 GEOMETRY_TOLERANCE 以内
+    return {name: bool(np.allclose(getattr(image, "Get" + name.capitalize())(),
+                                   getattr(expected, "Get" + name.capitalize())(), atol=GEOMETRY_TOLERANCE))
+            for name in ("origin", "spacing", "direction")}
+
+
+def run_variant(path, repeat, cold):
+    (expected, expected_histogram), sitk_row = measure(load_with_sitk, path, repeat, cold)
+    (image, histogram, loader), volumer_row = measure(load_with_volumer, path, repeat, cold)
+    volumer_row.update(loader=loader, memmap_supported=memmap_nifti(path) is not None,
+                       speedup=round(sitk_row["ms_median"] / volumer_row["ms_median"], 2)
+                       if volumer_row["ms_median"] else None)
+    volumer_row.update(compare_geometry(image, expected))
+    volumer_row["identical"] = bool(tuple(image.GetSize()) == expected.GetSize()
+                                    and np.array_equal(_array(image), sitk.GetArrayViewFromImage(expected))
+                                    and histogram == expected_histogram)
+    return {"file_bytes": os.path.getsize(path), "sitk_read": sitk_row, "memmap": volumer_row}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="掩膜加载的基准测试 (合成数据)")
+    parser.add_argument("--size", type=int, nargs=2, default=(512, 512), metavar=("COLUMNS", "ROWS"))
+    parser.add_argument("--slices", type=int, default=200)
+    parser.add_argument("--labels", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cold", action="store_true", help="每次读取前把文件移出页缓存")
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录并在结束后删除)")
+    parser.add_argument("--output", default="benchmark_mask_load.json")
+    args = parser.parse_args(argv)
+
+    # 斜位网格 (绕 z 轴旋转10度)，sform/qform 的方向与原点都不是单位阵与零
+    direction = sitk.VersorTransform((0, 0, 1), np.deg2rad(10.0)).GetMatrix()
+    reference = ReferenceGeometry((args.size[0], args.size[1], args.slices), (0.8, 0.8, 1.5),
+                                  (-120.5, -95.25, -60.0), direction)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="volumer_mask_load_")
+    result = {"size": list(args.size), "slices": args.slices, "cold": args.cold, "variants": {}}
+    try:
+        mask = None
+        for name, (filename, patches) in VARIANTS.items():
+            path = os.path.join(workdir, filename)
+            if not os.path.exists(path):
+                if mask is None:
+                    mask = make_mask(os.path.join(workdir, "template.nii"), reference, labels=args.labels,
+                                     misalignment="rotate", fill=0.1)
+                write_variant(path, mask, patches)
+            result["variants"][name] = run_variant(path, args.repeat, args.cold)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<12} {:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+        "variant", "loader", "sitk_ms", "memmap_ms", "speedup", "origin", "spacing", "dir", "identical"))
+    for name, row in result["variants"].items():
+        memmap = row["memmap"]
+        print("{:<12} {:>8} {:>10.1f} {:>10.1f} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+            name, memmap["loader"], row["sitk_read"]["ms_median"], memmap["ms_median"], str(memmap["speedup"]),
+            str(memmap["origin"]), str(memmap["spacing"]), str(memmap["direction"]), str(memmap["identical"])))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print("结果已写入", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+# coding: utf8
+"""
+体积计算流程的基准测试
+
+用 benchmarks.synthetic 生成合成的DICOM序列与NIfTI掩膜，对每种几何关系分别测量
+各阶段 (序列文件列表、文件头、完整解码、掩膜加载、重采样与统计、get_volume) 的耗时与内存，
+并通过 FastAPI TestClient 测量 /traverse_folder 与 /calculate_volume 的端到端耗时
+结果写入JSON文件，可以用 --compare 与之前的结果对比
+
+用法:
+    python -m benchmarks.bench_pipeline --size 256 256 --slices 64 --output bench.json
+    python -m benchmarks.bench_pipeline --compare bench.json --output bench_new.json
+"""
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import SimpleITK as sitk
+from benchmarks.synthetic import MISALIGNMENTS, make_study
+from utils import config
+from utils.cache import get_mask_cache
+from utils.volumer import DicomVolumer, NiiVolumer
+
+# 采样常驻内存的间隔 (秒)
+RSS_SAMPLE_INTERVAL = 0.002
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    except OSError:
+        return None
+
+
+_libc = _load_libc()
+
+
+def release_free_memory():
+    # 回收垃圾对象并把空闲的堆内存归还操作系统 (glibc)，使常驻内存增量反映本次执行的分配
+    gc.collect()
+    if _libc is not None and hasattr(_libc, "malloc_trim"):
+        _libc.malloc_trim(0)
+
+
+def current_rss():
+    # 当前进程的常驻内存 (字节)，读取 /proc/self/statm，不可用时返回 None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """
+    在后台线程中定期采样常驻内存，记录代码块执行期间相对开始时的峰值增量
+    可以统计到 ITK 在 C++ 中分配的内存 (tracemalloc 只能统计 Python/NumPy 分配的内存)
+    """
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_delta = None
+        self._stop = threading.Event()
+
+    def _run(self, baseline):
+        peak = baseline
+        while not self._stop.wait(self.interval):
+            peak = max(peak, current_rss() or 0)
+        self.peak_delta = max(0, max(peak, current_rss() or 0) - baseline)
+
+    def __enter__(self):
+        release_free_memory()
+        baseline = current_rss()
+        if baseline is not None:
+            self._thread = threading.Thread(target=self._run, args=(baseline,), daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if hasattr(self, "_thread"):
+            self._stop.set()
+            self._thread.join()
+        return False
+
+
+def _quiet():
+    # 屏蔽体积计算中的 print 输出
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def profile(fn, repeat, setup=None):
+    """
+    执行 fn repeat 次记录耗时，再单独执行一次记录 tracemalloc 峰值与常驻内存峰值增量
+    :param setup: 每次执行前调用 (不计入耗时)，例如清空缓存
+    :return: (最后一次的返回值, 统计字典)
+    """
+    times = []
+    result = None
+    for _ in range(max(1, repeat)):
+        if setup:
+            setup()
+        with _quiet():
+            start = time.perf_counter()
+            result = fn()
+            times.append((time.perf_counter() - start) * 1000.0)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        with _quiet(), RssSampler() as sampler:
+            fn()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {
+        "ms_min": round(min(times), 3),
+        "ms_median": round(statistics.median(times), 3),
+        "ms_max": round(max(times), 3),
+        "tracemalloc_peak_bytes": traced_peak,
+        "rss_peak_delta_bytes": sampler.peak_delta,
+    }
+
+
+def _write_reference_nifti(path, geometry):
+    # NiiVolumer 只读取CT的文件头，写一个同网格的空图像即可
+    image = sitk.Image([int(v) for v in geometry.GetSize()], sitk.sitkUInt8)
+    image.SetSpacing(geometry.GetSpacing())
+    image.SetOrigin(geometry.GetOrigin())
+    image.SetDirection(geometry.GetDirection())
+    sitk.WriteImage(image, path)
+
+
+def run_stages(dicom_dir, roi_path, repeat):
+    """
+    分阶段测量单个序列的体积计算
+    """
+    clear_masks = get_mask_cache().clear
+    stages = {}
+    volumer = DicomVolumer()
+    dicom_files, stages["series_files"] = profile(lambda: volumer._get_dicom_files(dicom_dir), repeat)
+    geometry, stages["reference_geometry"] = profile(
+        lambda: volumer._load_dicom_geometry(dicom_dir, dicom_files), repeat)
+    _, stages["series_read"] = profile(lambda: volumer._load_dicom_images(dicom_dir, dicom_files), repeat)
+    mask, stages["mask_load"] = profile(lambda: DicomVolumer()._load_mask_image(roi_path), repeat, clear_masks)
+
+    counter = DicomVolumer()
+    _, stages["count_labels"] = profile(lambda: counter._count_mask_labels(mask, geometry), repeat)
+
+    dicom_volumer = DicomVolumer()
+    volumes, stages["dicom_get_volume"] = profile(
+        lambda: dicom_volumer.get_volume(dicom_dir, roi_path, dicom_files=dicom_files), repeat, clear_masks)
+
+    ct_path = os.path.join(os.path.dirname(roi_path), "ct.nii.gz")
+    _write_reference_nifti(ct_path, geometry)
+    nii_volumer = NiiVolumer()
+    _, stages["nii_get_volume"] = profile(lambda: nii_volumer.get_volume(ct_path, roi_path), repeat, clear_masks)
+
+    return {
+        "stages": stages,
+        # get_volume 内部各阶段的耗时 (毫秒)，来自最后一次执行的 Volumer.stats
+        "get_volume_breakdown": dicom_volumer.stats.get("stages", {}),
+        "resample_mode": dicom_volumer.stats.get("resample_mode"),
+        "mask_loader": dicom_volumer.stats.get("mask_loader"),
+        "voxels": dicom_volumer.stats.get("voxels", {}),
+        "voxel_counts": {str(label): bucket["voxel_count"] for label, bucket in volumes.items()},
+    }
+
+
+def _time_requests(send, count):
+    times, statuses = [], set()
+    with RssSampler() as sampler:
+        for index in range(count):
+            start = time.perf_counter()
+            response = send(index)
+            times.append((time.perf_counter() - start) * 1000.0)
+            body = response.json()
+            statuses.add(body.get("status") if isinstance(body, dict) else response.status_code)
+    return {
+        "requests": count,
+        "ms_min": round(min(times), 3),
+        "ms_median": round(statistics.median(times), 3),
+        "ms_max": round(max(times), 3),
+        "rss_peak_delta_bytes": sampler.peak_delta,
+        "statuses": sorted(str(s) for s in statuses),
+    }
+
+
+def run_endpoints(root, items, repeat):
+    """
+    通过 TestClient 测量端到端的接口耗时 (体积计算在进程池中执行，内存增量只包含服务进程)
+    """
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from httpserver.api.routes import router
+
+    app = FastAPI()
+    app.include_router(router)
+    roi_file = items[0][1]
+    results = {}
+    with TestClient(app) as client:
+        traverse = lambda index: client.post("/traverse_folder", json={"folder_path": root, "roi_file": roi_file})
+        # 第一次遍历需要建立序列索引，之后只检查目录修改时间
+        results["traverse_folder_cold"] = _time_requests(traverse, 1)
+        results["traverse_folder_warm"] = _time_requests(traverse, repeat)
+
+        def calculate(use_cache):
+            def send(index):
+                folder, roi = items[index % len(items)]
+                return client.post("/calculate_volume",
+                                   json={"folder_path": folder, "roi_file": roi, "use_cache": use_cache})
+            return send
+
+        # 第一次请求包含启动工作进程的时间
+        results["calculate_volume_first"] = _time_requests(calculate(False), 1)
+        results["calculate_volume"] = _time_requests(calculate(False), max(repeat, len(items)))
+        calculate(True)(0)
+        results["calculate_volume_cached"] = _time_requests(lambda index: calculate(True)(0), repeat)
+    return results
+
+
+def run(args, workdir):
+    scenarios = []
+    for misalignment in args.misalignment:
+        root = os.path.join(workdir, misalignment)
+        start = time.perf_counter()
+        items = make_study(root, patients=args.patients, size=tuple(args.size), slices=args.slices,
+                           labels=args.labels, misalignment=misalignment, mask_format=args.mask_format,
+                           compress=args.compress, fill=args.fill)
+        generate_ms = (time.perf_counter() - start) * 1000.0
+        print("[{}] 生成数据 {:.0f} ms".format(misalignment, generate_ms), file=sys.stderr)
+
+        dicom_dir, roi_file = items[0]
+        scenario = {"name": misalignment, "generate_ms": round(generate_ms, 3)}
+        scenario.update(run_stages(dicom_dir, os.path.join(os.path.dirname(dicom_dir), roi_file), args.repeat))
+        if not args.no_endpoints:
+            scenario["endpoints"] = run_endpoints(root, items, args.repeat)
+        scenarios.append(scenario)
+        print("[{}] {}".format(misalignment, ", ".join(
+            "{} {:.1f} ms".format(name, stats["ms_median"]) for name, stats in scenario["stages"].items())),
+            file=sys.stderr)
+    return scenarios
+
+
+def isolate_paths(workdir):
+    """
+    缓存、序列索引、任务数据库与上传暂存目录都放在数据目录中，不使用 (也不修改) 默认的 cache 目录，
+    同时关闭目录监视；config 的取值在导入时已确定，这里同时修改其属性，工作进程通过环境变量继承
+    """
+    cache_dir = os.path.join(workdir, "cache")
+    paths = {
+        "CACHE_DIR": cache_dir,
+        "SERIES_INDEX_PATH": os.path.join(cache_dir, "series_index.sqlite"),
+        "JOB_DB_PATH": os.path.join(cache_dir, "jobs.sqlite"),
+        "UPLOAD_SPOOL_DIR": os.path.join(cache_dir, "uploads"),
+        "WATCH_ROOT": "",
+    }
+    for name, value in paths.items():
+        os.environ["VOLUMER_" + name] = value
+        setattr(config, name, value)
+
+
+def _flatten(result):
+    # {"场景/阶段": 中位数耗时}
+    flat = {}
+    for scenario in result.get("scenarios", []):
+        for group in ("stages", "endpoints"):
+            for name, stats in scenario.get(group, {}).items():
+                flat["{}/{}".format(scenario["name"], name)] = stats["ms_median"]
+    return flat
+
+
+def compare(baseline, current, threshold):
+    """
+    对比两次结果的中位数耗时，打印变化并返回变慢超过 threshold 倍的项目
+    """
+    old, new = _flatten(baseline), _flatten(current)
+    regressions = []
+    print("{:<48} {:>12} {:>12} {:>8}".format("stage", "baseline_ms", "current_ms", "ratio"))
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = " <-"
+        print("{:<48} {:>12.2f} {:>12.2f} {:>8.2f}{}".format(key, old[key], new[key], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="体积计算流程基准测试 (合成数据)")
+    parser.add_argument("--size", type=int, nargs=2, default=[256, 256], metavar=("COLUMNS", "ROWS"))
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--labels", type=int, default=3)
+    parser.add_argument("--fill", type=float, default=0.02, help="标签合计占掩膜体积的比例")
+    parser.add_argument("--patients", type=int, default=2, help="每个场景生成的序列数")
+    parser.add_argument("--misalignment", nargs="+", choices=MISALIGNMENTS, default=list(MISALIGNMENTS))
+    parser.add_argument("--mask-format", choices=("nii", "nii.gz"), default="nii.gz")
+    parser.add_argument("--compress", action="store_true", help="压缩DICOM像素数据")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-endpoints", action="store_true", help="不测量HTTP接口")
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录并在结束后删除)")
+    parser.add_argument("--output", default="benchmark_result.json")
+    parser.add_argument("--compare", help="与之前的结果文件对比")
+    parser.add_argument("--threshold", type=float, default=1.2, help="变慢超过该倍数时以非零状态退出")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="volumer-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    isolate_paths(workdir)
+    try:
+        scenarios = run(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "simpleitk": sitk.Version.VersionString(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print("结果已写入 {}".format(args.output), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(baseline, result, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
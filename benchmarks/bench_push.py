@@ -0,0 +1,253 @@
+# coding: utf8
+"""
+批量计算结果推送方式的负载测试
+
+启动一个真实的服务进程，用合成数据组成 --rows 行的批量任务，分别测量：
+  per_row  每一行单独 POST /calculate_volume (模拟浏览器逐行 fetch，最多 --connections 个并发连接)
+  ndjson   一次 POST /calculate_volume_batch，按行读取 NDJSON
+  push     POST /jobs 提交任务，再通过一个 GET /jobs/{job_id}/events (Server-Sent Events) 接收全部结果
+记录每种方式的请求数、连接数、耗时与服务进程 (含工作进程) 的CPU时间
+各目录的结果事先计算并缓存，测量的主要是请求与推送本身的开销
+
+用法:
+    python -m benchmarks.bench_push --rows 1000 --output push.json
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.synthetic import make_study
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _process_cpu(pid):
+    # 进程的用户态与内核态CPU时间 (秒)
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def process_tree_cpu(pid):
+    """
+    进程及其所有子进程 (体积计算的工作进程) 的CPU时间合计 (秒)，需要 /proc
+    """
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    total, stack = 0.0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            total += _process_cpu(current)
+        except OSError:
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class Server:
+    """
+    在子进程中运行 uvicorn，缓存与任务数据库放在工作目录中
+    """
+    def __init__(self, workdir, workers, extra_env=None):
+        """
+        :param extra_env: 其他环境变量 (如 VOLUMER_VOLUME_QUEUE_DEPTH)
+        """
+        self.port = _free_port()
+        env = dict(os.environ, VOLUMER_CACHE_DIR=os.path.join(workdir, "cache"),
+                   VOLUMER_SERIES_INDEX_PATH=os.path.join(workdir, "cache", "series_index.sqlite"),
+                   VOLUMER_JOB_DB_PATH=os.path.join(workdir, "cache", "jobs.sqlite"),
+                   VOLUMER_UPLOAD_SPOOL_DIR=os.path.join(workdir, "cache", "uploads"),
+                   VOLUMER_VOLUME_WORKERS=str(workers), **(extra_env or {}))
+        code = ("import uvicorn; uvicorn.run('start_server:app', host='127.0.0.1', port={}, "
+                "log_level='warning', log_config=None, access_log=False)").format(self.port)
+        self.process = subprocess.Popen([sys.executable, "-c", code], cwd=REPO_ROOT, env=env,
+                                        stdout=subprocess.DEVNULL)
+        deadline = time.time() + 60
+        while True:
+            try:
+                self.request("GET", "/cache_stats")
+                return
+            except OSError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("服务启动失败")
+                time.sleep(0.2)
+
+    def connect(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+
+    def request(self, method, path, body=None, conn=None):
+        own = conn is None
+        conn = conn or self.connect()
+        try:
+            payload = json.dumps(body).encode("utf-8") if body is not None else None
+            conn.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            return json.loads(response.read())
+        finally:
+            if own:
+                conn.close()
+
+    def cpu(self):
+        return process_tree_cpu(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def run_per_row(server, rows, connections):
+    # 每行一个请求，多个线程各自保持一个长连接，模拟浏览器对同一主机的并发连接上限
+    lock = threading.Lock()
+    next_index = [0]
+    failed = [0]
+
+    def worker():
+        conn = server.connect()
+        try:
+            while True:
+                with lock:
+                    index = next_index[0]
+                    next_index[0] += 1
+                if index >= len(rows):
+                    return
+                result = server.request("POST", "/calculate_volume", rows[index], conn=conn)
+                if result.get("status") != "success":
+                    with lock:
+                        failed[0] += 1
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(connections, len(rows)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"requests": len(rows), "connections": len(threads), "results": len(rows), "failed": failed[0]}
+
+
+def run_ndjson(server, rows):
+    conn = server.connect()
+    try:
+        conn.request("POST", "/calculate_volume_batch", body=json.dumps({"dicom_directories": rows}),
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        results = [json.loads(line) for line in response if line.strip()]
+    finally:
+        conn.close()
+    failed = sum(result["status"] != "success" for result in results)
+    return {"requests": 1, "connections": 1, "results": len(results), "failed": failed}
+
+
+def run_push(server, rows):
+    job = server.request("POST", "/jobs", {"dicom_directories": rows})
+    conn = server.connect()
+    results, failed, event = 0, 0, None
+    try:
+        conn.request("GET", "/jobs/{}/events".format(job["job_id"]))
+        response = conn.getresponse()
+        for line in response:
+            line = line.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "item":
+                    results += 1
+                    failed += json.loads(line[len("data: "):])["status"] != "success"
+                elif event == "done":
+                    break
+    finally:
+        conn.close()
+    return {"requests": 2, "connections": 2, "results": results, "failed": failed}
+
+
+def measure(server, fn, *args):
+    cpu = server.cpu()
+    start = time.perf_counter()
+    result = fn(*args)
+    result["wall_s"] = time.perf_counter() - start
+    result["server_cpu_s"] = server.cpu() - cpu
+    return result
+
+
+def run(args, workdir):
+    items = make_study(os.path.join(workdir, "data"), patients=args.patients, size=(args.size, args.size),
+                       slices=args.slices, labels=args.labels)
+    rows = [{"folder_path": items[index % len(items)][0], "roi_file": items[index % len(items)][1]}
+            for index in range(args.rows)]
+    server = Server(workdir, args.workers)
+    try:
+        # 预先计算并缓存每个目录的结果，同时启动工作进程
+        for item in rows[:len(items)]:
+            server.request("POST", "/calculate_volume", item)
+        modes = {}
+        for mode in args.modes:
+            if mode == "per_row":
+                modes[mode] = measure(server, run_per_row, server, rows, args.connections)
+            elif mode == "ndjson":
+                modes[mode] = measure(server, run_ndjson, server, rows)
+            else:
+                modes[mode] = measure(server, run_push, server, rows)
+    finally:
+        server.stop()
+    return {"rows": args.rows, "patients": args.patients, "connections": args.connections, "modes": modes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量计算结果推送方式的负载测试 (合成数据)")
+    parser.add_argument("--rows", type=int, default=1000, help="批量任务的行数")
+    parser.add_argument("--patients", type=int, default=10, help="生成的序列数 (各行循环使用)")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--slices", type=int, default=16)
+    parser.add_argument("--labels", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2, help="服务的体积计算进程数")
+    parser.add_argument("--connections", type=int, default=6, help="per_row 的并发连接数 (浏览器对同一主机通常为6)")
+    parser.add_argument("--modes", nargs="+", choices=("per_row", "ndjson", "push"),
+                        default=["per_row", "ndjson", "push"])
+    parser.add_argument("--workdir", help="数据目录 (默认使用临时目录并在结束后删除)")
+    parser.add_argument("--output", default="benchmark_push.json")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="volumer_push_")
+    try:
+        result = run(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<10} {:>9} {:>12} {:>8} {:>8} {:>10} {:>14}".format(
+        "mode", "requests", "connections", "results", "failed", "wall_s", "server_cpu_s"))
+    for mode, row in result["modes"].items():
+        print("{:<10} {requests:>9} {connections:>12} {results:>8} {failed:>8} {wall_s:>10.2f} {server_cpu_s:>14.2f}"
+              .format(mode, **row))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print("结果已写入", args.output)
+
+
+if __name__ == "__main__":
+    main()
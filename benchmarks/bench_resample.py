@@ -0,0 +1,132 @@
+# coding: utf8
+"""
+掩膜映射到参考网格各路径的基准测试
+
+对每种网格关系 (对齐、轴置换、翻转、整数倍抽样、平移、需要重采样的斜向网格) 分别比较
+默认路径 (Volumer._count_mask_labels) 与强制整体重采样的耗时，并校验两者的标签直方图一致
+
+用法: python -m benchmarks.bench_resample [--size 256 256 200] [--repeat 3] [--json result.json]
+"""
+import argparse
+import json
+import sys
+import time
+import numpy as np
+import SimpleITK as sitk
+from utils.volumer import DicomVolumer, ReferenceGeometry
+
+
+def make_mask(size, labels=3, seed=0):
+    # 在 (x, y, z) 尺寸的网格中放置 labels 个长方体标签
+    rng = np.random.default_rng(seed)
+    array = np.zeros(size[::-1], dtype=np.uint8)
+    for label in range(1, labels + 1):
+        center = [rng.integers(s // 4, 3 * s // 4 + 1) for s in array.shape]
+        radius = [max(1, s // 6) for s in array.shape]
+        array[tuple(slice(max(0, c - r), c + r) for c, r in zip(center, radius))] = label
+    mask = sitk.GetImageFromArray(array)
+    mask.SetSpacing((0.8, 0.8, 1.25))
+    mask.SetOrigin((-102.4, -98.0, 40.0))
+    return mask
+
+
+def derived_reference(mask, axes=(0, 1, 2), signs=(1, 1, 1), steps=(1, 1, 1), shift=(0, 0, 0), jitter=0.0):
+    """
+    构造参考网格：参考轴 r 沿掩膜轴 axes[r] 方向 (signs[r] 为方向)，间距为掩膜的 steps[r] 倍，
+    原点位于掩膜索引 shift 处；jitter 为加到空间信息上的舍入误差
+    """
+    size = np.asarray(mask.GetSize())
+    spacing = np.asarray(mask.GetSpacing())
+    direction = np.asarray(mask.GetDirection()).reshape(3, 3)
+    shift = np.asarray(shift, dtype=np.float64)
+    for r, (axis, sign) in enumerate(zip(axes, signs)):
+        if sign < 0 and shift[axis] == 0:
+            shift[axis] = size[axis] - 1
+    reference_direction = np.stack([direction[:, axis] * sign for axis, sign in zip(axes, signs)], axis=1)
+    reference_spacing = np.array([spacing[axis] * step for axis, step in zip(axes, steps)])
+    reference_size = [int(size[axis] // step) for axis, step in zip(axes, steps)]
+    origin = np.asarray(mask.GetOrigin()) + direction.dot(spacing * shift)
+    return ReferenceGeometry(reference_size, reference_spacing * (1 + jitter), origin + jitter,
+                             reference_direction.ravel() + jitter * (np.arange(9) % 4 == 0))
+
+
+def oblique_reference(mask):
+    # 绕z轴旋转10度并错开半个体素，只能重采样
+    size, spacing = mask.GetSize(), mask.GetSpacing()
+    transform = sitk.VersorTransform((0, 0, 1), np.deg2rad(10.0))
+    origin = np.asarray(mask.GetOrigin()) + 0.5 * np.asarray(spacing)
+    return ReferenceGeometry(size, spacing, origin, transform.GetMatrix())
+
+
+def count_default(mask, reference):
+    volumer = DicomVolumer()
+    histogram = volumer._count_mask_labels(mask, reference)
+    return histogram, volumer.stats.get('resample_mode')
+
+
+def count_resampled(mask, reference):
+    # 强制对整个参考网格执行 ResampleImageFilter
+    volumer = DicomVolumer(crop=False)
+    histogram = volumer._count_region_labels(mask, reference, (0, 0, 0), reference.GetSize())
+    return histogram, volumer.stats.get('resample_mode')
+
+
+def best_time(fn, repeat):
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return min(times), result
+
+
+def nonzero_counts(histogram):
+    return {label: count for label, count in histogram.items() if count}
+
+
+def run(size, repeat):
+    mask = make_mask(size)
+    cases = [
+        ("aligned", derived_reference(mask, jitter=1e-6)),
+        ("permute", derived_reference(mask, axes=(1, 0, 2))),
+        ("flip", derived_reference(mask, signs=(1, -1, -1))),
+        ("subsample", derived_reference(mask, steps=(2, 2, 3))),
+        ("shift", derived_reference(mask, shift=(5, -7, 3))),
+        ("permute+flip+subsample", derived_reference(mask, axes=(2, 0, 1), signs=(-1, 1, 1), steps=(2, 1, 2))),
+        ("oblique", oblique_reference(mask)),
+    ]
+    results = []
+    for name, reference in cases:
+        default_ms, (default_histogram, mode) = best_time(lambda: count_default(mask, reference), repeat)
+        resample_ms, (resampled_histogram, _) = best_time(lambda: count_resampled(mask, reference), repeat)
+        results.append({
+            "case": name,
+            "reference_size": list(reference.GetSize()),
+            "resample_mode": mode,
+            "default_ms": round(default_ms, 3),
+            "resample_ms": round(resample_ms, 3),
+            "speedup": round(resample_ms / default_ms, 2) if default_ms else None,
+            "match": nonzero_counts(default_histogram) == nonzero_counts(resampled_histogram),
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="掩膜映射路径基准测试")
+    parser.add_argument("--size", type=int, nargs=3, default=[256, 256, 200], metavar=("X", "Y", "Z"))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="将结果写入JSON文件")
+    args = parser.parse_args(argv)
+
+    results = run(tuple(args.size), args.repeat)
+    print("{:<24} {:<32} {:>12} {:>12} {:>8} {}".format("case", "resample_mode", "default_ms", "resample_ms", "speedup", "match"))
+    for row in results:
+        print("{case:<24} {resample_mode:<32} {default_ms:>12.2f} {resample_ms:>12.2f} {speedup:>8} {match}".format(**row))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"size": args.size, "results": results}, f, indent=2, ensure_ascii=False)
+    return 0 if all(row["match"] for row in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
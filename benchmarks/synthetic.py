@@ -0,0 +1,175 @@
+# coding: utf8
+"""
+用 SimpleITK 生成基准测试用的合成数据：DICOM序列、对应的NIfTI掩膜与深层目录树
+掩膜可以相对DICOM网格平移、旋转、翻转或改变分辨率，以覆盖各条重采样路径
+"""
+import os
+import shutil
+import numpy as np
+import SimpleITK as sitk
+
+# 掩膜相对DICOM网格的几何关系
+MISALIGNMENTS = ("aligned", "shift", "rotate", "flip", "coarse", "fine")
+
+# 合成序列使用的UID前缀
+UID_ROOT = "1.2.826.0.1.3680043.2.1125.9"
+
+
+def make_series(out_dir, size=(256, 256), slices=64, spacing=(0.8, 0.8, 2.5),
+                origin=(-102.4, -102.4, 0.0), compress=False, seed=0, direction=None):
+    """
+    生成一个DICOM序列 (每层一个文件)，像素为随机的CT值
+    :param out_dir: 输出目录
+    :param size: 每层的 (列数, 行数)
+    :param slices: 层数
+    :param compress: 是否压缩像素数据
+    :param direction: 方向矩阵 (按行展开的9个数，列为行、列与层的方向)，默认为轴位
+    :return: 序列的参考网格 (sitk.Image，只含一层像素，用于取空间信息)
+    """
+    direction = np.asarray(direction if direction is not None else np.eye(3).ravel(), dtype=np.float64)
+    axes = direction.reshape(3, 3)
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    series_uid = "{}.{}".format(UID_ROOT, rng.integers(1 << 30))
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetUseCompression(compress)
+    for index in range(slices):
+        array = rng.integers(-1000, 1000, size=(1, size[1], size[0]), dtype=np.int16)
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(spacing)
+        position = tuple(float(v) for v in np.asarray(origin) + axes[:, 2] * spacing[2] * index)
+        image.SetOrigin(position)
+        image.SetDirection(direction.tolist())
+        image.SetMetaData("0008|0060", "CT")
+        image.SetMetaData("0020|000e", series_uid)
+        image.SetMetaData("0008|0018", "{}.{}".format(series_uid, index + 1))
+        image.SetMetaData("0020|0013", str(index + 1))
+        image.SetMetaData("0020|0032", "\\".join("{:.10g}".format(v) for v in position))
+        image.SetMetaData("0020|0037", "\\".join("{:.10g}".format(v) for v in list(axes[:, 0]) + list(axes[:, 1])))
+        image.SetMetaData("0028|0030", "{}\\{}".format(spacing[1], spacing[0]))
+        image.SetMetaData("0018|0050", str(spacing[2]))
+        writer.SetFileName(os.path.join(out_dir, "IM{:05d}.dcm".format(index)))
+        writer.Execute(image)
+
+    reference = sitk.Image(size[0], size[1], slices, sitk.sitkUInt8)
+    reference.SetSpacing(spacing)
+    reference.SetOrigin(origin)
+    reference.SetDirection(direction.tolist())
+    return reference
+
+
+def _mask_geometry(reference, misalignment):
+    # 计算掩膜的 (尺寸, 间距, 原点, 方向)
+    size = np.asarray(reference.GetSize())
+    spacing = np.asarray(reference.GetSpacing(), dtype=np.float64)
+    origin = np.asarray(reference.GetOrigin(), dtype=np.float64)
+    direction = np.asarray(reference.GetDirection(), dtype=np.float64).reshape(3, 3)
+    if misalignment == "aligned":
+        pass
+    elif misalignment == "shift":
+        # 层内平移半个体素，只能重采样
+        origin = origin + direction.dot(spacing * np.array([0.5, 0.5, 0.0]))
+    elif misalignment == "rotate":
+        # 绕网格中心在层内旋转5度
+        center = origin + direction.dot(spacing * (size - 1) / 2.0)
+        rotation = np.asarray(sitk.VersorTransform((0, 0, 1), np.deg2rad(5.0)).GetMatrix()).reshape(3, 3)
+        direction = rotation.dot(direction)
+        origin = center - direction.dot(spacing * (size - 1) / 2.0)
+    elif misalignment == "flip":
+        # 行方向与层方向反向存储，体素中心与DICOM网格重合
+        origin = origin + direction.dot(spacing * (size - 1) * np.array([0, 1, 1]))
+        direction = direction * np.array([1, -1, -1])
+    elif misalignment == "coarse":
+        # 掩膜分辨率为DICOM的一半，需要重采样
+        size = (size + 1) // 2
+        origin = origin + direction.dot(spacing * 0.5)
+        spacing = spacing * 2
+    elif misalignment == "fine":
+        # 掩膜分辨率为DICOM的两倍 (层内)，DICOM网格是掩膜网格的整数倍抽样
+        size = size * np.array([2, 2, 1])
+        spacing = spacing / np.array([2, 2, 1])
+    else:
+        raise ValueError("未知的几何关系: {}".format(misalignment))
+    return size, spacing, origin, direction
+
+
+def make_mask(path, reference, labels=3, misalignment="aligned", fill=0.02, seed=0):
+    """
+    生成与参考网格存在指定几何关系的标签掩膜
+    :param path: 输出文件 (.nii 或 .nii.gz)
+    :param reference: DICOM序列的参考网格
+    :param labels: 标签数
+    :param misalignment: MISALIGNMENTS 之一
+    :param fill: 所有标签合计占掩膜体积的比例
+    :return: 掩膜图像
+    """
+    size, spacing, origin, direction = _mask_geometry(reference, misalignment)
+    rng = np.random.default_rng(seed)
+    array = np.zeros(tuple(int(v) for v in size[::-1]), dtype=np.uint8)
+    # 每个标签是一个椭球，半径使所有标签的体积合计约为 fill
+    radius = np.asarray(array.shape) * (3.0 * fill / (4.0 * np.pi * max(1, labels))) ** (1.0 / 3.0)
+    grids = np.ogrid[tuple(slice(0, n) for n in array.shape)]
+    for label in range(1, labels + 1):
+        center = [rng.uniform(r, n - r) if n > 2 * r else n / 2.0 for n, r in zip(array.shape, radius)]
+        distance = sum(((g - c) / max(r, 0.5)) ** 2 for g, c, r in zip(grids, center, radius))
+        array[distance <= 1.0] = label
+
+    mask = sitk.GetImageFromArray(array)
+    mask.SetSpacing(spacing.tolist())
+    mask.SetOrigin(origin.tolist())
+    mask.SetDirection(direction.ravel().tolist())
+    sitk.WriteImage(mask, path)
+    return mask
+
+
+def make_study(root, patients=2, size=(256, 256), slices=64, labels=3, misalignment="aligned",
+               mask_format="nii.gz", compress=False, fill=0.02):
+    """
+    生成 root/pXXX/dicom + root/pXXX/roi.<mask_format> 的目录结构 (ROI位于DICOM目录的上一级)
+    :return: [(DICOM目录, ROI文件名)]
+    """
+    roi_file = "roi." + mask_format
+    items = []
+    for index in range(patients):
+        patient_dir = os.path.join(root, "p{:03d}".format(index))
+        dicom_dir = os.path.join(patient_dir, "dicom")
+        reference = make_series(dicom_dir, size=size, slices=slices, compress=compress, seed=index)
+        make_mask(os.path.join(patient_dir, roi_file), reference, labels=labels,
+                  misalignment=misalignment, fill=fill, seed=index)
+        items.append((dicom_dir, roi_file))
+    return items
+
+
+def make_tree(root, depth=4, fanout=4, series_every=2, slices=4, noise_files=2):
+    """
+    生成深层目录树：每个目录有 fanout 个子目录，最深一层的目录中每 series_every 个放一个DICOM序列
+    (复制同一个小序列的文件)，其余放 noise_files 个非DICOM文件；中间各层也放 noise_files 个非DICOM文件
+    :return: 包含DICOM序列的目录列表 (已排序)
+    """
+    template = os.path.join(root, "_template")
+    make_series(template, size=(8, 8), slices=slices)
+    template_files = sorted(os.listdir(template))
+    series_dirs = []
+    leaf_index = 0
+    level = [os.path.join(root, "tree")]
+    for current_depth in range(depth + 1):
+        next_level = []
+        for path in level:
+            os.makedirs(path, exist_ok=True)
+            is_leaf = current_depth == depth
+            if is_leaf and leaf_index % series_every == 0:
+                for name in template_files:
+                    shutil.copyfile(os.path.join(template, name), os.path.join(path, name))
+                series_dirs.append(path)
+            else:
+                for index in range(noise_files):
+                    with open(os.path.join(path, "note{}.txt".format(index)), "w") as f:
+                        f.write("not a dicom file\n" * 16)
+            if is_leaf:
+                leaf_index += 1
+            else:
+                next_level.extend(os.path.join(path, "d{}".format(index)) for index in range(fanout))
+        level = next_level
+    shutil.rmtree(template)
+    return sorted(series_dirs)
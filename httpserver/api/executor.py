@@ -0,0 +1,251 @@
+# coding: utf8
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import SimpleITK as sitk
+from utils import config
+from utils.pipeline import estimate_task_memory
+
+# 体积计算进程池与文件IO线程池，首次使用时创建
+_process_pool = None
+_io_pool = None
+
+
+def _init_worker(itk_threads):
+    # 多个工作进程并行时限制每个进程内ITK的线程数，避免CPU过度订阅
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(itk_threads)
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        workers = max(1, config.VOLUME_WORKERS)
+        itk_threads = max(1, (multiprocessing.cpu_count() or 1) // workers)
+        # 使用spawn启动工作进程，避免在多线程的服务进程中fork
+        _process_pool = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker,
+                                            initargs=(itk_threads,))
+    return _process_pool
+
+
+def get_io_pool():
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(max_workers=max(1, config.IO_WORKERS), thread_name_prefix="volumer-io")
+    return _io_pool
+
+
+def shutdown_pools():
+    global _process_pool, _io_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=False, cancel_futures=True)
+        _io_pool = None
+
+
+async def run_io(fn, *args):
+    # 在IO线程池中执行阻塞的文件操作，不阻塞事件循环
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_pool(), functools.partial(fn, *args))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _Waiter:
+    __slots__ = ("future", "memory", "bypassed")
+
+    def __init__(self, future, memory):
+        self.future = future
+        self.memory = memory
+        # 排在它后面、先于它开始执行的任务数
+        self.bypassed = 0
+
+
+class VolumeJobLimiter:
+    """
+    体积计算任务的准入控制：限制同时执行的任务数与估计内存的合计，并限制排队等待的请求数
+    排在前面的大任务因内存预算不足而等待时，后面放得下的小任务可以先执行；
+    同一个任务被越过 max_bypass 次后不再越过它，避免大任务一直等待
+    估计内存超过整个预算的任务在没有其他任务执行时单独执行
+    工作进程内掩膜缓存占用的内存 (由任务结果报告，见 report_mask_cache) 从预算中扣除
+    名额在进程池中的计算结束时才归还：等待结果的请求被取消时，已开始的计算仍占用内存
+    计数只在事件循环线程中修改，不需要加锁
+    """
+    def __init__(self, max_running, max_queued, memory_budget=0, max_bypass=8):
+        """
+        :param memory_budget: 执行中任务估计内存的合计上限 (字节)，0 表示不限制
+        """
+        self.max_running = max(1, max_running)
+        self.max_queued = max(0, max_queued)
+        self.memory_budget = max(0, memory_budget)
+        self.max_bypass = max(0, max_bypass)
+        self.running = 0
+        # 执行中任务的估计内存合计 (字节)
+        self.memory_reserved = 0
+        # 各工作进程最近报告的掩膜缓存占用 {pid: 字节数} 及其合计
+        self._mask_cache = {}
+        self.mask_cache_bytes = 0
+        # 所有等待中的任务数，以及其中受排队上限约束的请求数
+        self.waiting = 0
+        self.queued = 0
+        self._waiters = []
+
+    def _fits(self, memory):
+        if self.running >= self.max_running:
+            return False
+        if not self.memory_budget or self.running == 0:
+            return True
+        return self.memory_reserved + self.mask_cache_bytes + memory <= self.memory_budget
+
+    def _acquire(self, memory):
+        self.running += 1
+        self.memory_reserved += memory
+
+    def _release(self, memory):
+        self.running -= 1
+        self.memory_reserved -= memory
+        self._dispatch()
+
+    def _release_from_thread(self, loop, memory):
+        # 进程池的回调线程中调用，在事件循环线程中归还名额 (服务关闭、事件循环已停止时忽略)
+        try:
+            loop.call_soon_threadsafe(self._release, memory)
+        except RuntimeError:
+            pass
+
+    def report_mask_cache(self, pid, nbytes):
+        """
+        记录工作进程的掩膜缓存占用 (字节)，缓存减少时放行等待中的任务
+        """
+        previous = self._mask_cache.get(pid, 0)
+        self._mask_cache[pid] = nbytes
+        self.mask_cache_bytes += nbytes - previous
+        if nbytes < previous:
+            self._dispatch()
+
+    def _dispatch(self):
+        # 按到达顺序放行放得下的任务，第一个放不下的任务被越过的次数达到上限后停止
+        blocked = None
+        for waiter in list(self._waiters):
+            if self.running >= self.max_running:
+                break
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+                continue
+            if not self._fits(waiter.memory):
+                if blocked is None:
+                    blocked = waiter
+                continue
+            if blocked is not None:
+                if blocked.bypassed >= self.max_bypass:
+                    break
+                blocked.bypassed += 1
+            self._waiters.remove(waiter)
+            self._acquire(waiter.memory)
+            waiter.future.set_result(None)
+
+    async def run(self, fn, *args, reject_when_full=True, memory=0, on_start=None):
+        """
+        在进程池中执行 fn(*args)
+        :param reject_when_full: 排队请求数已满时是否抛出 QueueFullError (批量任务传 False，始终排队)
+        :param memory: 任务的估计内存 (字节)
+        :param on_start: 获得名额后、开始计算前调用的协程函数，返回 False 时不计算并返回 None (如任务已取消)
+        """
+        if not self._waiters and self._fits(memory):
+            self._acquire(memory)
+        else:
+            if reject_when_full and self.queued >= self.max_queued:
+                raise QueueFullError("体积计算任务已满，请稍后重试")
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), memory)
+            self._waiters.append(waiter)
+            self.waiting += 1
+            self.queued += reject_when_full
+            try:
+                self._dispatch()
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # 已被放行但请求被取消，归还名额
+                    self._release(memory)
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._dispatch()
+                raise
+            finally:
+                self.waiting -= 1
+                self.queued -= reject_when_full
+        loop = asyncio.get_running_loop()
+        try:
+            if on_start is not None and not await on_start():
+                self._release(memory)
+                return None
+            future = get_process_pool().submit(fn, *args)
+        except BaseException:
+            self._release(memory)
+            raise
+        # 计算结束 (或尚未开始即被取消) 时才归还名额，不随等待结果的协程一起归还
+        future.add_done_callback(lambda _: self._release_from_thread(loop, memory))
+        return await asyncio.wrap_future(future)
+
+    async def run_volume(self, fn, folder_path, roi_file, *args, reject_when_full=True, intensity=False,
+                         on_start=None):
+        """
+        先根据文件头估计内存 (在IO线程池中执行)，再按内存预算排队执行 fn(folder_path, roi_file, *args)
+        :param intensity: 任务是否统计CT值 (需要解码DICOM像素)，只用于估计内存
+        :param on_start: 见 run
+        """
+        memory = await run_io(estimate_task_memory, folder_path, roi_file, intensity) if self.memory_budget else 0
+        return await self.run(fn, folder_path, roi_file, *args, reject_when_full=reject_when_full, memory=memory,
+                              on_start=on_start)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_running": self.max_running,
+            "memory_budget": self.memory_budget,
+            "memory_reserved": self.memory_reserved,
+            "mask_cache_bytes": self.mask_cache_bytes,
+        }
+
+
+volume_limiter = VolumeJobLimiter(config.MAX_VOLUME_JOBS, config.VOLUME_QUEUE_DEPTH,
+                                  config.VOLUME_MEMORY_BUDGET, config.ADMISSION_MAX_BYPASS)
+
+
+class SingleFlight:
+    """
+    合并相同的并发计算：同一个键在计算完成前的后续调用等待同一个结果，不重复计算
+    只在事件循环线程中使用，不需要加锁
+    """
+    def __init__(self):
+        self._inflight = {}
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    async def run(self, key, fn):
+        """
+        :param key: 可哈希的键，相同的键视为相同的计算
+        :param fn: 无参数的协程函数，只在没有进行中的相同计算时调用
+        :return: (结果, 是否与进行中的计算合并)
+        """
+        future = self._inflight.get(key)
+        coalesced = future is not None
+        if not coalesced:
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._release(key, done))
+        # 某个请求被取消 (客户端断开) 时不取消共享的计算
+        return await asyncio.shield(future), coalesced
+
+    def _release(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
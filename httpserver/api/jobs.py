@@ -0,0 +1,138 @@
+# coding: utf8
+import time
+import asyncio
+from utils import config
+from utils.jobqueue import get_job_queue
+from utils.pipeline import run_volume_task
+from httpserver.api.executor import run_io, volume_limiter
+
+
+# 推送给前端的目录字段 (不含体积字典与各阶段统计)
+EVENT_FIELDS = ("index", "folder_path", "roi_file", "status", "message", "volume_result", "cached", "resample_mode")
+
+
+def item_event(item):
+    return {key: item.get(key) for key in EVENT_FIELDS}
+
+
+class JobRunner:
+    """
+    从任务队列数据库中领取待计算的目录，在进程池中计算后写回结果
+    每次最多领取 JOB_CLAIM_BATCH 个目录，其余目录留在数据库中保持待计算状态；
+    领取的目录在获得体积计算的名额时才标记为计算中 (JobQueue.start)，等待期间任务被取消时不再计算，
+    服务重启时等待中的目录重新置为待计算，不计入中断次数
+    已领取的目录减少一半时才再次领取，完成的结果攒在一起写回，减少数据库事务数
+    """
+    def __init__(self, collect):
+        """
+        :param collect: 汇总任务结果中统计信息的函数 collect(record, started)
+        """
+        self.queue = None
+        self.collect = collect
+        self.active = 0
+        self._wakeup = None
+        self._task = None
+        # 已完成但尚未写回数据库的 [(目录, 任务结果)]
+        self._completed = []
+        self._flushed = None
+        self._flush_task = None
+        # 订阅任务事件的连接 {任务ID: {asyncio.Queue}}
+        self._subscribers = {}
+
+    async def start(self):
+        # 将上次中断时正在计算的目录重新置为待计算，然后开始领取
+        self.queue = get_job_queue()
+        requeued = await run_io(self.queue.recover)
+        if requeued:
+            print(f"任务队列: 恢复 {requeued} 个未完成的目录")
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._loop())
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    def stop(self):
+        # 正在计算的目录保持计算中状态，下次启动时重新计算
+        for task in (self._task, self._flush_task):
+            if task is not None:
+                task.cancel()
+        self._task = self._flush_task = None
+
+    def notify(self):
+        # 提交新任务或有目录完成时唤醒领取循环
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def subscribe(self, job_id):
+        """
+        订阅任务的事件，返回的队列中依次放入 (事件名, 数据)：
+        item 为一个目录完成，done 为任务中的目录全部结束
+        """
+        events = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(events)
+        return events
+
+    def unsubscribe(self, job_id, events):
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is not None:
+            subscribers.discard(events)
+            if not subscribers:
+                del self._subscribers[job_id]
+
+    def publish(self, job_id, event, data):
+        for events in self._subscribers.get(job_id, ()):
+            events.put_nowait((event, data))
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            items = []
+            window = max(2 * volume_limiter.max_running, config.JOB_CLAIM_BATCH)
+            if self.active <= window // 2:
+                items = await run_io(self.queue.claim, window - self.active)
+            for item in items:
+                self.active += 1
+                asyncio.ensure_future(self._run(item))
+            if not items:
+                await self._wakeup.wait()
+
+    async def _run(self, item):
+        started = time.perf_counter()
+        try:
+            # 与单个请求共享并发上限，始终排队等待；获得名额后再次确认任务与目录未被取消
+            record = await volume_limiter.run_volume(
+                run_volume_task, item["folder_path"], item["roi_file"], item["label_values"], item["use_cache"],
+                item["intensity"], True, reject_when_full=False, intensity=item["intensity"],
+                on_start=lambda: run_io(self.queue.start, item["job_id"], item["index"]))
+            if record is None:
+                # 已取消，cancel 已写回目录状态
+                self.active -= 1
+                self.notify()
+                return
+            record = self.collect(record, started)
+        except Exception as e:
+            record = {"status": "error", "message": f"体积计算失败: {str(e)}"}
+        self._completed.append((item, record))
+        self._flushed.set()
+
+    async def _flush_loop(self):
+        # 写回期间完成的目录在下一次一起写回
+        while True:
+            await self._flushed.wait()
+            self._flushed.clear()
+            completed, self._completed = self._completed, []
+            try:
+                states = await run_io(self.queue.complete_many,
+                                      [(item["job_id"], item["index"], record) for item, record in completed])
+            except Exception as e:
+                # 写回失败的目录保持计算中状态，下次启动时重新计算
+                print(f"任务队列: 写回结果失败: {str(e)}")
+                states = {}
+            for item, record in completed:
+                self.publish(item["job_id"], "item", item_event(dict(record, index=item["index"],
+                                                                     folder_path=item["folder_path"],
+                                                                     roi_file=item["roi_file"])))
+            for job_id, (job_status, unfinished) in states.items():
+                if not unfinished:
+                    self.publish(job_id, "done", {"status": job_status})
+            self.active -= len(completed)
+            self.notify()
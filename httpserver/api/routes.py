@@ -1,12 +1,45 @@
 import os
-from utils.filehelper import get_secondary_folders
-from utils.volumer import get_volumer
+import json
+import time
+import asyncio
+from utils import metrics
+from utils.seriesindex import get_series_index
+from utils.export import EXPORT_FORMATS
+from utils.jobqueue import ITEM_FINISHED, ITEM_STATUSES, JOB_ACTIVE, get_job_queue
+from utils.pipeline import load_label_summary, run_volume_task
+from utils.upload import SeriesUpload, UploadError, cleanup_spool
+from utils import config
+from httpserver.api.executor import QueueFullError, SingleFlight, run_io, shutdown_pools, volume_limiter
+from httpserver.api.jobs import JobRunner, item_event
+from httpserver.api.watch import WatchService
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from fastapi.routing import APIRoute
+
+
+class TimedRoute(APIRoute):
+    """
+    记录每个接口的处理耗时到 volumer_request_seconds (流式接口只计到开始返回响应)
+    """
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        endpoint = self.path
+
+        async def timed_handler(request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                metrics.request_seconds.observe(time.perf_counter() - start, endpoint=endpoint, status=str(status))
+
+        return timed_handler
 
 
 # 创建API路由器
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
 # 存储选择的文件夹路径和内容
 selected_folder = None
@@ -14,6 +47,43 @@ folder_contents = []
 
 dicom_directories = []  # 存储DICOM目录数据
 
+# 各工作进程最近一次上报的掩膜缓存统计 {pid: stats}
+worker_mask_cache_stats = {}
+
+# 合并相同目录、ROI文件与标签的并发体积计算请求
+volume_flights = SingleFlight()
+
+
+def _collect_task_stats(record, started, include_stats=False):
+    """
+    汇总任务结果中附带的缓存统计与各阶段耗时，并从返回给客户端的结果中移除
+    :param started: 提交任务时的 time.perf_counter()，用于计算排队等待的时间
+    :param include_stats: 是否在结果中保留本次任务的各阶段统计
+    """
+    worker = record.pop("worker", None)
+    if worker:
+        worker_mask_cache_stats[worker["pid"]] = worker["mask_cache"]
+        # 掩膜缓存常驻在工作进程中，从内存预算中扣除
+        volume_limiter.report_mask_cache(worker["pid"], worker["mask_cache"]["bytes"])
+    stats = record.pop("stats", None)
+    if stats:
+        # 从提交到返回的时间中除去工作进程内的执行时间，即排队与进程间传输的时间
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        stats["stages"]["queue_wait"] = max(0.0, elapsed_ms - stats["stages"].get("task", 0.0))
+        metrics.record_task_stats(stats)
+        if stats.get("result_cache_hit") is not None:
+            metrics.record_cache_lookup("result", stats["result_cache_hit"])
+        if include_stats:
+            record["stats"] = stats
+    return record
+
+
+# 任务队列中的目录保留各阶段统计，随结果一起保存
+job_runner = JobRunner(lambda record, started: _collect_task_stats(record, started, True))
+
+# 监视目录 (VOLUMER_WATCH_ROOT)，新到达的序列追加到监视任务中
+watch_service = WatchService(job_runner)
+
 @router.get("/")
 def read_root():
     # 重定向到静态HTML文件
@@ -28,7 +98,7 @@ async def traverse_folder(request: Request):
     folder_path = data.get("folder_path")
     roi_file = data.get("roi_file")
     
-    if not folder_path or not os.path.isdir(folder_path):
+    if not folder_path or not await run_io(os.path.isdir, folder_path):
         return JSONResponse(content={"status": "error", "message": "无效的文件夹路径"})
     
     if not roi_file:
@@ -37,25 +107,16 @@ async def traverse_folder(request: Request):
     # 遍历文件夹查找DICOM目录
     dicom_directories = []
     try:
-        # 简单实现：假设所有子文件夹都是DICOM目录
-        folders, msg, succ = get_secondary_folders(folder_path)
-        if not succ:
-            return JSONResponse(content={"status": "error", "message": msg})
-        for dir_path in folders:
+        # 增量扫描DICOM序列索引，只重新读取修改过的目录 (在IO线程池中执行，不阻塞事件循环)
+        series_list = await run_io(get_series_index().scan, folder_path)
+        for series in series_list:
             dicom_directories.append({
-                    "folder_path": dir_path,
+                    "folder_path": series["folder"],
                     "roi_file": roi_file,
+                    "series_uid": series["series_uid"],
+                    "slice_count": series["slice_count"],
                     "volume_result": None
                 })
-        # 简单实现：假设所有子文件夹都是DICOM目录
-        # for root, dirs, files in os.walk(folder_path):
-        #     for dir_name in dirs:
-        #         dir_path = os.path.join(root, dir_name)
-        #         dicom_directories.append({
-        #             "folder_path": dir_path,
-        #             "roi_file": roi_file,
-        #             "volume_result": None
-        #         })
         
         return JSONResponse(content={
             "status": "success",
@@ -65,6 +126,35 @@ async def traverse_folder(request: Request):
     except Exception as e:
         return JSONResponse(content={"status": "error", "message": f"遍历文件夹失败: {str(e)}"})
 
+@router.post("/traverse_folder_stream")
+async def traverse_folder_stream(request: Request):
+    """
+    流式遍历文件夹：每找到一个DICOM目录就以NDJSON返回一行，适用于目录数量很多的根目录
+    """
+    data = await request.json()
+    folder_path = data.get("folder_path")
+    roi_file = data.get("roi_file")
+
+    if not folder_path or not await run_io(os.path.isdir, folder_path):
+        return JSONResponse(content={"status": "error", "message": "无效的文件夹路径"})
+
+    if not roi_file:
+        return JSONResponse(content={"status": "error", "message": "ROI文件名不能为空"})
+
+    def stream_folders():
+        # 同步生成器由 StreamingResponse 放在线程池中迭代，不阻塞事件循环
+        global dicom_directories
+        found = []
+        for series in get_series_index().iter_scan(folder_path):
+            item = {"folder_path": series["folder"], "roi_file": roi_file,
+                    "series_uid": series["series_uid"], "slice_count": series["slice_count"],
+                    "volume_result": None}
+            found.append(item)
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+        dicom_directories = found
+
+    return StreamingResponse(stream_folders(), media_type="application/x-ndjson")
+
 @router.post("/calculate_volume")
 async def calculate_volume(request: Request):
     # 获取请求数据
@@ -72,37 +162,383 @@ async def calculate_volume(request: Request):
     folder_path = data.get("folder_path")
     roi_file = data.get("roi_file")
     
-    if not folder_path or not os.path.isdir(folder_path):
+    if not folder_path or not await run_io(os.path.isdir, folder_path):
         return JSONResponse(content={"status": "error", "message": "无效的文件夹路径"})
     
     if not roi_file:
         return JSONResponse(content={"status": "error", "message": "ROI文件名不能为空"})
 
-    # 修正roi_file相较于folder_path的路径
-    parent_dir = os.path.dirname(folder_path)
-    roi_file = os.path.join(parent_dir, roi_file)
-    
+    include_stats = bool(data.get("include_stats"))
+    label_values = data.get("label_values")
+    use_cache = data.get("use_cache", True)
+    # 同时统计各标签的CT值 (需要解码DICOM像素)
+    intensity = bool(data.get("include_intensity"))
+
+    async def compute():
+        # 调用医学影像处理库来计算体积 (在进程池中执行，相同目录与ROI文件未修改时直接返回缓存结果)
+        started = time.perf_counter()
+        return _collect_task_stats(await volume_limiter.run_volume(
+            run_volume_task, folder_path, roi_file, label_values, use_cache, intensity, False, include_stats,
+            intensity=intensity), started, True)
+
+    # 相同的请求正在计算时等待同一个结果，不重复加载与重采样
+    key = (os.path.normpath(folder_path), roi_file, json.dumps(label_values), bool(use_cache), intensity,
+           include_stats)
     try:
-        # 调用医学影像处理库来计算体积
-        volumer = get_volumer(file_type='dicom')
-        data_dict = volumer.get_volume(dicom_dir=folder_path, roi=roi_file)
-        if not data_dict or len(data_dict) == 0:
-            volume_result = "未计算出体积信息"
-        else:
-            volume_result = ""
-            if len(data_dict) == 1:
-                volume_result = f"{data_dict[list(data_dict.keys())[0]]['volume_mm3']:.3f}"
-            else:
-                for label, bucket in data_dict.items():
-                    volume_result += f"label: {label}, bucket: {bucket['volume_mm3']:.3f}mm³\n"
-        
-        return JSONResponse(content={
+        record, coalesced = await volume_flights.run(key, compute)
+        if coalesced:
+            metrics.coalesced_requests_total.inc(endpoint="/calculate_volume")
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, headers={"Retry-After": "5"},
+                            content={"status": "error", "message": str(e)})
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": f"体积计算失败: {str(e)}"})
+
+    if record["status"] != "success":
+        content = {"status": "error", "message": record["message"]}
+    else:
+        content = {
             "status": "success",
             "message": "体积计算成功",
-            "volume_result": volume_result,
-        })
+            "volume_result": record["volume_result"],
+            "cached": record["cached"],
+            "resample_mode": record["resample_mode"],
+            "coalesced": coalesced,
+        }
+        if intensity:
+            # [[标签, {voxel_count, volume_mm3, ..., mean_hu, min_hu, max_hu, std_hu}]]
+            content["volumes"] = record["volumes"]
+    if include_stats:
+        # 各阶段耗时 (毫秒)、读取字节数与体素数
+        content["stats"] = record.get("stats")
+    return JSONResponse(content=content)
+
+@router.post("/calculate_volume_batch")
+async def calculate_volume_batch(request: Request):
+    """
+    批量计算体积：任务分发到进程池并行执行，按完成顺序以NDJSON逐行返回每个目录的结果
+    单个目录失败时在对应行中返回错误信息，不影响其他目录
+    """
+    data = await request.json()
+    items = data.get("dicom_directories")
+    if items is None:
+        # 未指定时使用 /traverse_folder 遍历得到的目录列表
+        items = dicom_directories
+    if not items:
+        return JSONResponse(content={"status": "error", "message": "没有需要计算的DICOM目录"})
+    label_values = data.get("label_values")
+    use_cache = data.get("use_cache", True)
+    include_stats = bool(data.get("include_stats"))
+    intensity = bool(data.get("include_intensity"))
+
+    async def stream_results():
+        futures = {}
+        started = time.perf_counter()
+        for index, item in enumerate(items):
+            # 批量任务始终排队等待，与单个请求共享并发上限
+            future = asyncio.ensure_future(volume_limiter.run_volume(
+                run_volume_task, item.get("folder_path"), item.get("roi_file"),
+                label_values, use_cache, intensity, False, include_stats, reject_when_full=False,
+                intensity=intensity))
+            futures[future] = index
+        try:
+            pending = set(futures)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    index = futures[future]
+                    try:
+                        record = _collect_task_stats(future.result(), started, include_stats)
+                    except Exception as e:
+                        record = {
+                            "folder_path": items[index].get("folder_path"),
+                            "roi_file": items[index].get("roi_file"),
+                            "status": "error",
+                            "message": f"体积计算失败: {str(e)}",
+                        }
+                    record["index"] = index
+                    yield json.dumps(record, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端断开时取消尚未开始的任务
+            for future in futures:
+                future.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@router.get("/label_summary")
+async def label_summary(folder_path: str, roi_file: str):
+    """
+    已缓存的标签摘要：完整的标签直方图、体素体积、DICOM网格，以及 (启用时) 各标签的包围盒与CT值统计
+    只检查目录与ROI文件的指纹，不读取图像；尚未计算或文件已修改时返回 404
+    """
+    try:
+        summary = await run_io(load_label_summary, folder_path, roi_file)
+    except OSError as e:
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"无法读取文件: {str(e)}"})
+    if summary is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "标签摘要不存在，请先计算体积"})
+    return {"status": "success", "folder_path": folder_path, "roi_file": roi_file, "summary": summary}
+
+@router.post("/upload_volume")
+async def upload_volume(request: Request):
+    """
+    上传DICOM序列 (zip压缩包，字段 archive) 与ROI文件 (字段 roi) 并计算体积
+    请求体边接收边写入临时目录并解压，每个文件到达后立即检查文件头，序列不一致时在上传过程中返回 400；
+    上传结束后计算体积，返回格式与 /calculate_volume 相同，临时文件随后删除
+    可选表单字段：label_values (JSON数组)、include_intensity、include_stats
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and config.UPLOAD_MAX_BYTES \
+            and int(content_length) > config.UPLOAD_MAX_BYTES:
+        return JSONResponse(status_code=413, content={"status": "error", "message": "上传内容超过大小限制"})
+
+    upload = None
+    try:
+        upload = await run_io(SeriesUpload, request.headers.get("content-type"))
+        async for chunk in request.stream():
+            await run_io(upload.feed, chunk)
+        await run_io(upload.finish)
+        upload_info = upload.summary()
+        label_values = upload.label_values()
+        intensity = upload.flag("include_intensity")
+        include_stats = upload.flag("include_stats")
+
+        # 临时目录在计算后删除，不读写结果缓存
+        started = time.perf_counter()
+        record = _collect_task_stats(await volume_limiter.run_volume(
+            run_volume_task, upload.dicom_dir, upload.roi_file, label_values, False, intensity, False,
+            include_stats, intensity=intensity), started, True)
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"status": "error", "message": str(e)})
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, headers={"Retry-After": "5"},
+                            content={"status": "error", "message": str(e)})
     except Exception as e:
-        return JSONResponse(content={"status": "error", "message": f"体积计算失败: {str(e)}"})
+        return JSONResponse(content={"status": "error", "message": f"上传失败: {str(e)}"})
+    finally:
+        if upload is not None:
+            await run_io(upload.cleanup)
+
+    if record["status"] != "success":
+        return JSONResponse(content={"status": "error", "message": record["message"]})
+    content = {
+        "status": "success",
+        "message": "体积计算成功",
+        "volume_result": record["volume_result"],
+        "resample_mode": record["resample_mode"],
+        "geometry": record["geometry"],
+        # 接收的字节数、DICOM文件数、跳过的非DICOM文件数与序列UID
+        "upload": upload_info,
+    }
+    if intensity:
+        content["volumes"] = record["volumes"]
+    if include_stats:
+        content["stats"] = record.get("stats")
+    return JSONResponse(content=content)
+
+@router.get("/watch")
+def watch_status():
+    """
+    监视目录的状态：监视方式、登记的目录数、等待稳定的目录数与已提交计算的序列数
+    结果保存在任务 job_id 中，通过 /jobs/{job_id}/results 查询、/jobs/{job_id}/export 导出
+    """
+    return watch_service.stats()
+
+@router.get("/cache_stats")
+def cache_stats():
+    """
+    缓存统计：掩膜缓存为各工作进程的合计，结果缓存为服务启动以来的命中次数
+    """
+    mask_cache = {
+        key: sum(stats[key] for stats in worker_mask_cache_stats.values())
+        for key in ("hits", "misses", "evictions", "entries", "bytes")
+    }
+    mask_cache["workers"] = len(worker_mask_cache_stats)
+    result_cache = {
+        "hits": metrics.cache_requests_total.value(cache="result", result="hit"),
+        "misses": metrics.cache_requests_total.value(cache="result", result="miss"),
+    }
+    return {"mask_cache": mask_cache, "result_cache": result_cache}
+
+@router.get("/queue_stats")
+def queue_stats():
+    """
+    体积计算的准入状态：执行中与排队的任务数、内存预算与执行中任务的估计内存合计 (字节)
+    """
+    stats = volume_limiter.stats()
+    stats["job_items_claimed"] = job_runner.active
+    stats["coalescing"] = volume_flights.inflight
+    return stats
+
+@router.get("/metrics")
+def get_metrics():
+    """
+    Prometheus 文本格式的性能指标：各阶段耗时与接口耗时直方图、读取字节数、体素数、缓存命中率与任务数
+    """
+    for field in ("entries", "bytes", "evictions"):
+        metrics.mask_cache_usage.set(sum(stats[field] for stats in worker_mask_cache_stats.values()), field=field)
+    metrics.volume_jobs.set(volume_limiter.running, state="running")
+    metrics.volume_jobs.set(volume_limiter.waiting, state="waiting")
+    metrics.memory_budget.set(volume_limiter.memory_budget, state="budget")
+    metrics.memory_budget.set(volume_limiter.memory_reserved, state="reserved")
+    metrics.memory_budget.set(volume_limiter.mask_cache_bytes, state="mask_cache")
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.post("/jobs")
+async def submit_job(request: Request):
+    """
+    提交体积计算任务：目录保存到任务队列数据库后立即返回任务ID，由后台按顺序计算
+    服务重启后继续计算未完成的目录，已完成的目录不再重复计算
+    """
+    data = await request.json()
+    items = data.get("dicom_directories")
+    if items is None:
+        # 未指定时使用 /traverse_folder 遍历得到的目录列表
+        items = dicom_directories
+    if not items:
+        return JSONResponse(content={"status": "error", "message": "没有需要计算的DICOM目录"})
+    job_id = await run_io(get_job_queue().submit, items, data.get("label_values"), data.get("use_cache", True),
+                          bool(data.get("include_intensity")))
+    job_runner.notify()
+    return JSONResponse(content={"status": "success", "message": "任务已提交", "job_id": job_id, "total": len(items)})
+
+@router.get("/jobs")
+async def list_jobs(limit: int = 50):
+    # 最近提交的任务及其进度
+    return {"jobs": await run_io(get_job_queue().list_jobs, limit)}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    # 任务进度：各状态的目录数与完成比例
+    job = await run_io(get_job_queue().get_job, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在"})
+    return job
+
+def _parse_statuses(status):
+    # 逗号分隔的目录状态，未指定时返回 None (全部状态)
+    statuses = [value for value in status.split(",") if value] if status else None
+    if statuses and any(value not in ITEM_STATUSES for value in statuses):
+        raise ValueError(f"无效的状态: {status}")
+    return statuses
+
+@router.get("/jobs/{job_id}/results")
+async def get_job_results(job_id: str, offset: int = 0, limit: int = 1000, status: str = None,
+                          folder_prefix: str = None):
+    """
+    按序号分页返回任务中各目录的状态与结果
+    :param status: 只返回指定状态的目录，多个状态以逗号分隔
+    :param folder_prefix: 只返回以该前缀开头的目录
+    """
+    queue = get_job_queue()
+    try:
+        statuses = _parse_statuses(status)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+    if await run_io(queue.get_job, job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在"})
+    items = await run_io(lambda: list(queue.iter_items(job_id, statuses, offset, limit, folder_prefix)))
+    return {"job_id": job_id, "offset": offset, "items": items}
+
+@router.get("/jobs/{job_id}/export")
+async def export_job(job_id: str, format: str = "csv", status: str = None, folder_prefix: str = None):
+    """
+    以CSV或XLSX流式导出任务结果：每个标签一行，包含体素数、mm³/cm³/mL、DICOM网格与耗时
+    结果从数据库逐行读取并分块返回，内存占用与行数无关
+    :param status: 只导出指定状态的目录，多个状态以逗号分隔
+    :param folder_prefix: 只导出以该前缀开头的目录
+    """
+    if format not in EXPORT_FORMATS:
+        return JSONResponse(status_code=400, content={"status": "error", "message": f"不支持的导出格式: {format}"})
+    queue = get_job_queue()
+    try:
+        statuses = _parse_statuses(status)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+    if await run_io(queue.get_job, job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在"})
+    iter_export, media_type = EXPORT_FORMATS[format]
+    # 同步生成器由 StreamingResponse 放在线程池中迭代，不阻塞事件循环
+    chunks = iter_export(queue.iter_items(job_id, statuses, folder_prefix=folder_prefix))
+    headers = {"Content-Disposition": f'attachment; filename="volumes_{job_id}.{format}"'}
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    # 取消尚未开始计算的目录
+    if not await run_io(get_job_queue().cancel, job_id):
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在"})
+    job = await run_io(get_job_queue().get_job, job_id)
+    job_runner.publish(job_id, "cancelled", job)
+    if not job["counts"]["running"]:
+        job_runner.publish(job_id, "done", {"status": job["status"]})
+    return {"status": "success", "message": "任务已取消", "job": job}
+
+def _sse(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data, ensure_ascii=False))
+
+# 推送连接空闲时发送注释行的间隔 (秒)，避免被代理断开
+SSE_HEARTBEAT_SECONDS = 15
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    以 Server-Sent Events 推送任务进度：连接后先发送 job (任务进度) 与已完成目录的 item 事件，
+    之后每完成一个目录推送一个 item 事件，全部结束时推送 done 事件
+    一个连接即可接收整个任务的结果，重新连接时会补发已完成的目录
+    """
+    queue = get_job_queue()
+    if await run_io(queue.get_job, job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在"})
+
+    async def stream_events():
+        # 先订阅再读取已完成的目录，两者之间完成的目录按序号去重
+        events = job_runner.subscribe(job_id)
+        try:
+            job = await run_io(queue.get_job, job_id)
+            yield _sse("job", job)
+            sent = set()
+            offset = 0
+            while True:
+                page = await run_io(lambda: list(queue.iter_items(job_id, ITEM_FINISHED, offset, 500)))
+                for item in page:
+                    sent.add(item["index"])
+                    yield _sse("item", item_event(item))
+                if len(page) < 500:
+                    break
+                offset += len(page)
+            if job["status"] != JOB_ACTIVE and not job["counts"]["running"]:
+                yield _sse("done", {"status": job["status"]})
+                return
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event == "item" and data["index"] in sent:
+                    continue
+                yield _sse(event, data)
+                if event == "done":
+                    return
+        finally:
+            job_runner.unsubscribe(job_id, events)
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.on_event("startup")
+async def on_startup():
+    # 删除上次异常退出时遗留的上传临时目录
+    await run_io(cleanup_spool)
+    await job_runner.start()
+    await watch_service.start()
+
+@router.on_event("shutdown")
+def on_shutdown():
+    watch_service.stop()
+    job_runner.stop()
+    shutdown_pools()
 
 # 保留旧的端点以兼容可能的遗留代码
 @router.post("/select_folder")
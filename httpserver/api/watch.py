@@ -0,0 +1,66 @@
+# coding: utf8
+import os
+import asyncio
+import hashlib
+from utils import config
+from utils.jobqueue import get_job_queue
+from utils.watcher import FolderWatcher
+from httpserver.api.executor import run_io
+
+
+def watch_job_id(root, roi_file, intensity):
+    # 同一监视配置的结果始终写入同一个任务，服务重启后继续追加
+    digest = hashlib.sha1("{}\n{}\n{}".format(root, roi_file, int(intensity)).encode("utf-8")).hexdigest()
+    return "watch_" + digest[:16]
+
+
+class WatchService:
+    """
+    监视 WATCH_ROOT，传输完成的序列追加到监视任务中，由任务队列 (JobRunner) 在体积计算进程池中计算，
+    结果通过 /jobs/{job_id}/results 与 /jobs/{job_id}/export 查询与导出
+    """
+    def __init__(self, job_runner):
+        self.job_runner = job_runner
+        self.watcher = None
+        self.job_id = None
+        self.roi_file = None
+        self.intensity = False
+        self._loop = None
+
+    async def start(self):
+        root, roi_file = config.WATCH_ROOT, config.WATCH_ROI_FILE
+        if not root:
+            return
+        if not roi_file or not await run_io(os.path.isdir, root):
+            print(f"目录监视: 监视目录 '{root}' 不存在或未设置ROI文件名 (VOLUMER_WATCH_ROI_FILE)，不监视")
+            return
+        root = os.path.abspath(root)
+        self.roi_file, self.intensity = roi_file, config.WATCH_INTENSITY
+        self.job_id = watch_job_id(root, roi_file, self.intensity)
+        self._loop = asyncio.get_running_loop()
+        queue = get_job_queue()
+        signatures = await run_io(queue.watch_signatures, root)
+        # 首次监视时 (没有任何记录) 已存在的序列只记录状态，重启后未记录的序列都是新到达的
+        self.watcher = FolderWatcher(root, roi_file, self._on_settled, signatures=signatures,
+                                     on_baseline=queue.save_watch_signatures,
+                                     include_existing=config.WATCH_INCLUDE_EXISTING or bool(signatures))
+        self.watcher.start()
+        print(f"目录监视: {root} (ROI文件 {roi_file}，任务 {self.job_id})")
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def _on_settled(self, entries):
+        # 在监视线程中调用：追加到任务并唤醒任务队列
+        items = [{"folder_path": folder, "roi_file": self.roi_file, "signature": signature}
+                 for folder, signature in entries]
+        get_job_queue().append(self.job_id, items, use_cache=True, intensity=self.intensity)
+        self._loop.call_soon_threadsafe(self.job_runner.notify)
+
+    def stats(self):
+        if self.watcher is None:
+            return {"enabled": False}
+        return dict(self.watcher.stats(), enabled=True, job_id=self.job_id, roi_file=self.roi_file,
+                    intensity=self.intensity)
@@ -8,9 +8,12 @@ document.addEventListener('DOMContentLoaded', function() {
     const errorMessage = document.getElementById('error-message');
     const dicomTableBody = document.getElementById('dicom-table-body');
     const exportBtn = document.getElementById('export-btn');
+    const batchBtn = document.getElementById('batch-btn');
 
     // 存储DICOM目录数据
     let dicomData = [];
+    // 最近一次批量计算的任务ID
+    let currentJobId = null;
 
     // 隐藏所有消息
     function hideMessages() {
@@ -37,94 +40,122 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     // 遍历文件夹并获取DICOM目录
-    function traverseFolder(folderPath, roiFile) {
+    // 使用 /traverse_folder_stream：服务端每找到一个DICOM目录返回一行NDJSON，表格随之逐行追加
+    async function traverseFolder(folderPath, roiFile) {
         loader.style.display = 'block';
         hideMessages();
+        dicomData = [];
+        currentJobId = null;
+        renderDicomTable(true);
 
-        fetch('/traverse_folder', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                folder_path: folderPath,
-                roi_file: roiFile
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
-            loader.style.display = 'none';
-            if (data.status === 'success') {
-                dicomData = data.dicom_directories;
+        try {
+            const response = await fetch('/traverse_folder_stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    folder_path: folderPath,
+                    roi_file: roiFile
+                })
+            });
+            // 参数无效时返回普通的JSON错误
+            if (!(response.headers.get('content-type') || '').includes('application/x-ndjson')) {
+                const data = await response.json();
+                loader.style.display = 'none';
                 renderDicomTable();
-                showSuccessMessage(`成功遍历文件夹，找到 ${dicomData.length} 个DICOM目录`);
-            } else {
                 showErrorMessage(data.message);
+                return;
             }
-        })
-        .catch(error => {
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                const lines = buffer.split('\n');
+                buffer = done ? '' : lines.pop();
+                // 同一次读取到的多行在文档片段中一起追加
+                const fragment = document.createDocumentFragment();
+                lines.filter(line => line.trim()).forEach(line => {
+                    const item = JSON.parse(line);
+                    dicomData.push(item);
+                    fragment.appendChild(buildDicomRow(item, dicomData.length - 1));
+                });
+                if (dicomData.length > 0 && dicomTableBody.querySelector('.empty-row')) {
+                    dicomTableBody.innerHTML = '';
+                }
+                dicomTableBody.appendChild(fragment);
+                if (done) {
+                    break;
+                }
+            }
+            loader.style.display = 'none';
+            if (dicomData.length === 0) {
+                renderDicomTable();
+            }
+            showSuccessMessage(`成功遍历文件夹，找到 ${dicomData.length} 个DICOM目录`);
+        } catch (error) {
             loader.style.display = 'none';
             showErrorMessage(`遍历文件夹失败: ${error.message}`);
-        });
+        }
+    }
+
+    // 构建DICOM目录表格的一行
+    function buildDicomRow(item, index) {
+        const row = document.createElement('tr');
+        // 确定状态类
+        let statusClass = 'status-pending';
+        if (item.is_processing) {
+            statusClass = 'status-processing';
+        } else if (item.volume_result) {
+            statusClass = 'status-completed';
+        }
+
+        row.innerHTML = `
+            <td><span class="status-dot ${statusClass}" id="status-${index}"></span></td>
+            <td>${item.folder_path}</td>
+            <td>${item.roi_file}</td>
+            <td>
+                <button class="btn calculate-btn" data-index="${index}" ${item.is_processing ? 'disabled' : ''}>计算体积</button>
+            </td>
+            <td id="result-${index}">${item.volume_result || '-'}</td>
+        `;
+        return row;
     }
 
-    // 渲染DICOM目录表格
-    function renderDicomTable() {
+    // 渲染DICOM目录表格 (遍历中逐行追加，之后只更新对应的行)
+    // scanning 为 true 时表示遍历刚开始，空表格显示"正在遍历"
+    function renderDicomTable(scanning) {
         dicomTableBody.innerHTML = '';
 
         if (dicomData.length === 0) {
             const row = document.createElement('tr');
-            row.innerHTML = '<td colspan="4" style="text-align: center;">未找到DICOM目录</td>';
+            row.className = 'empty-row';
+            row.innerHTML = `<td colspan="4" style="text-align: center;">${scanning ? '正在遍历...' : '未找到DICOM目录'}</td>`;
             dicomTableBody.appendChild(row);
             return;
         }
 
-        dicomData.forEach((item, index) => {
-            const row = document.createElement('tr');
-            // 确定状态类
-            let statusClass = 'status-pending';
-            if (item.is_processing) {
-                statusClass = 'status-processing';
-            } else if (item.volume_result) {
-                statusClass = 'status-completed';
-            }
-            
-            row.innerHTML = `
-                <td><span class="status-dot ${statusClass}" id="status-${index}"></span></td>
-                <td>${item.folder_path}</td>
-                <td>${item.roi_file}</td>
-                <td>
-                    <button class="btn calculate-btn" data-index="${index}" ${item.is_processing ? 'disabled' : ''}>计算体积</button>
-                </td>
-                <td id="result-${index}">${item.volume_result || '-'}</td>
-            `;
-            dicomTableBody.appendChild(row);
-        });
-
-        // 绑定计算体积按钮事件
-        document.querySelectorAll('.calculate-btn').forEach(btn => {
-            btn.addEventListener('click', function() {
-                const index = parseInt(this.getAttribute('data-index'));
-                calculateVolume(index);
-            });
-        });
+        // 先在文档片段中构建所有行，只触发一次重排
+        const fragment = document.createDocumentFragment();
+        dicomData.forEach((item, index) => fragment.appendChild(buildDicomRow(item, index)));
+        dicomTableBody.appendChild(fragment);
     }
 
+    // 计算体积按钮的点击事件委托到表格 (不为每一行单独绑定)
+    dicomTableBody.addEventListener('click', function(event) {
+        const btn = event.target.closest('.calculate-btn');
+        if (btn && !btn.disabled) {
+            calculateVolume(parseInt(btn.getAttribute('data-index')));
+        }
+    });
+
     // 计算体积
     function calculateVolume(index) {
         const item = dicomData[index];
-        const resultCell = document.getElementById(`result-${index}`);
-        const calculateBtn = document.querySelector(`.calculate-btn[data-index="${index}"]`);
-        const statusDot = document.getElementById(`status-${index}`);
-
-        // 更新状态
-        item.is_processing = true;
-        statusDot.className = 'status-dot status-processing';
-        
-        // 禁用按钮
-        calculateBtn.disabled = true;
-        calculateBtn.textContent = '计算中...';
-        resultCell.textContent = '计算中...';
+        markProcessing(index);
 
         fetch('/calculate_volume', {
             method: 'POST',
@@ -138,50 +169,152 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => response.json())
         .then(data => {
-            // 更新状态
-            item.is_processing = false;
-            const statusDot = document.getElementById(`status-${index}`);
-            
-            // 恢复按钮状态
-            calculateBtn.disabled = false;
-            calculateBtn.textContent = '计算体积';
-
+            applyVolumeResult(index, data);
             if (data.status === 'success') {
-                // 更新结果
-                dicomData[index].volume_result = data.volume_result;
-                resultCell.textContent = data.volume_result;
-                resultCell.className = 'result-success';
-                statusDot.className = 'status-dot status-completed';
                 showSuccessMessage('体积计算成功');
             } else {
-                resultCell.textContent = '计算失败';
-                resultCell.className = 'result-error';
-                statusDot.className = 'status-dot status-pending';
                 showErrorMessage(`体积计算失败: ${data.message}`);
             }
         })
         .catch(error => {
-            // 更新状态
-            item.is_processing = false;
-            const statusDot = document.getElementById(`status-${index}`);
-            statusDot.className = 'status-dot status-pending';
-            
-            // 恢复按钮状态
-            calculateBtn.disabled = false;
-            calculateBtn.textContent = '计算体积';
+            applyVolumeResult(index, { status: 'error', message: error.message });
+            showErrorMessage(`体积计算失败: ${error.message}`);
+        });
+    }
 
+    // 标记某一行为计算中
+    function markProcessing(index) {
+        const item = dicomData[index];
+        const resultCell = document.getElementById(`result-${index}`);
+        const calculateBtn = document.querySelector(`.calculate-btn[data-index="${index}"]`);
+        const statusDot = document.getElementById(`status-${index}`);
+
+        item.is_processing = true;
+        statusDot.className = 'status-dot status-processing';
+        calculateBtn.disabled = true;
+        calculateBtn.textContent = '计算中...';
+        resultCell.textContent = '计算中...';
+    }
+
+    // 将计算结果更新到对应的行
+    function applyVolumeResult(index, data) {
+        const item = dicomData[index];
+        const resultCell = document.getElementById(`result-${index}`);
+        const calculateBtn = document.querySelector(`.calculate-btn[data-index="${index}"]`);
+        const statusDot = document.getElementById(`status-${index}`);
+
+        // 更新状态
+        item.is_processing = false;
+
+        // 恢复按钮状态
+        calculateBtn.disabled = false;
+        calculateBtn.textContent = '计算体积';
+
+        if (data.status === 'success') {
+            // 更新结果
+            item.volume_result = data.volume_result;
+            resultCell.textContent = data.volume_result;
+            resultCell.className = 'result-success';
+            statusDot.className = 'status-dot status-completed';
+        } else {
             resultCell.textContent = '计算失败';
             resultCell.className = 'result-error';
-            showErrorMessage(`体积计算失败: ${error.message}`);
+            statusDot.className = 'status-dot status-pending';
+        }
+    }
+
+    // 批量计算全部目录：提交为后台任务，通过一个 Server-Sent Events 连接接收每个目录的结果并更新对应的行
+    async function calculateAll() {
+        if (dicomData.length === 0) {
+            showErrorMessage('没有需要计算的目录');
+            return;
+        }
+        hideMessages();
+        batchBtn.disabled = true;
+        dicomData.forEach((item, index) => markProcessing(index));
+
+        try {
+            const response = await fetch('/jobs', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    dicom_directories: dicomData.map(item => ({
+                        folder_path: item.folder_path,
+                        roi_file: item.roi_file
+                    }))
+                })
+            });
+            const data = await response.json();
+            if (data.status !== 'success') {
+                throw new Error(data.message);
+            }
+            currentJobId = data.job_id;
+            watchJob(data.job_id);
+        } catch (error) {
+            resetProcessing(error.message);
+            showErrorMessage(`批量计算失败: ${error.message}`);
+            batchBtn.disabled = false;
+        }
+    }
+
+    // 接收任务事件：item 更新一行，done 表示任务结束 (断线时浏览器自动重连，服务端补发已完成的目录)
+    function watchJob(jobId) {
+        const source = new EventSource(`/jobs/${jobId}/events`);
+        // 本任务中计算失败的行 (按序号记录，重新连接时补发的事件不会重复计数)
+        const failedIndexes = new Set();
+        source.addEventListener('item', event => {
+            const data = JSON.parse(event.data);
+            if (data.status === 'success') {
+                failedIndexes.delete(data.index);
+            } else {
+                failedIndexes.add(data.index);
+            }
+            if (data.status === 'cancelled') {
+                applyVolumeResult(data.index, { status: 'error', message: '已取消' });
+            } else {
+                applyVolumeResult(data.index, data);
+            }
+        });
+        source.addEventListener('done', event => {
+            source.close();
+            // 没有收到结果的行也计为失败
+            dicomData.forEach((item, index) => {
+                if (item.is_processing) {
+                    failedIndexes.add(index);
+                }
+            });
+            resetProcessing('已取消');
+            batchBtn.disabled = false;
+            const failed = failedIndexes.size;
+            if (failed > 0) {
+                showErrorMessage(`批量计算完成，${failed} 个目录计算失败`);
+            } else {
+                showSuccessMessage('批量计算完成');
+            }
         });
     }
 
-    // 导出CSV
+    // 将仍处于计算中的行恢复为未计算
+    function resetProcessing(message) {
+        dicomData.forEach((item, index) => {
+            if (item.is_processing) {
+                applyVolumeResult(index, { status: 'error', message: message });
+            }
+        });
+    }
+
+    // 导出CSV：批量计算过的结果由服务端流式导出 (包含各标签的体积与网格信息)，否则导出页面中的数据
     function exportToCsv() {
         if (dicomData.length === 0) {
             showErrorMessage('没有数据可导出');
             return;
         }
+        if (currentJobId) {
+            window.location.href = `/jobs/${currentJobId}/export?format=csv`;
+            return;
+        }
 
         // 构建CSV内容
         let csvContent = '子文件夹全路径,ROI文件名,计算结果(单位: mm³)\n';
@@ -231,4 +364,9 @@ document.addEventListener('DOMContentLoaded', function() {
     if (exportBtn) {
         exportBtn.addEventListener('click', exportToCsv);
     }
+
+    // 绑定批量计算按钮事件
+    if (batchBtn) {
+        batchBtn.addEventListener('click', calculateAll);
+    }
 });
\ No newline at end of file
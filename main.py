@@ -1,6 +1,7 @@
 #coding: utf8
 import tkinter as tk
 import os
+import multiprocessing
 import threading
 import webbrowser
 from fastapi import FastAPI
@@ -107,4 +108,6 @@ def create_gui():
 
 # 启动应用
 if __name__ == "__main__":
+    # 打包后的程序中，spawn 启动的体积计算进程在此返回，不再重复启动界面或服务
+    multiprocessing.freeze_support()
     create_gui()
\ No newline at end of file
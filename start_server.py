@@ -1,4 +1,5 @@
 import os
+import multiprocessing
 import threading
 import webbrowser
 import time
@@ -52,6 +53,8 @@ def start_server():
 
 # 启动应用
 if __name__ == "__main__":
+    # 打包后的程序中，spawn 启动的体积计算进程在此返回，不再重复启动界面或服务
+    multiprocessing.freeze_support()
     print("医学影像体积计算服务器")
     print("1. 启动服务器并打开浏览器")
     print("2. 仅启动服务器")
@@ -0,0 +1,24 @@
+# coding: utf8
+import os
+import sys
+import pytest
+
+# 测试从仓库根目录导入 utils 与 benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import cache, seriesindex
+from utils.cache import ResultCache
+from utils.seriesindex import SeriesIndex
+
+
+@pytest.fixture
+def isolated_cache(tmp_path, monkeypatch):
+    """
+    结果缓存、序列索引与掩膜缓存使用测试的临时目录，不读写仓库中的 cache/
+    :return: 结果缓存
+    """
+    result_cache = ResultCache(str(tmp_path / "cache" / "results"), 1 << 30)
+    monkeypatch.setattr(cache, "_result_cache", result_cache)
+    monkeypatch.setattr(seriesindex, "_series_index", SeriesIndex(str(tmp_path / "cache" / "series_index.sqlite")))
+    cache.get_mask_cache().clear()
+    return result_cache
@@ -0,0 +1,144 @@
+# coding: utf8
+"""
+体积计算的准入控制 (VolumeJobLimiter)：内存预算下的越过与排队、排队上限，
+以及名额在计算结束时 (而不是等待结果的协程被取消时) 才归还
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from httpserver.api import executor
+from httpserver.api.executor import QueueFullError, VolumeJobLimiter
+
+
+@pytest.fixture(autouse=True)
+def thread_pool(monkeypatch):
+    # 用线程池代替进程池，任务函数可以等待测试中的事件
+    pool = ThreadPoolExecutor(max_workers=8)
+    monkeypatch.setattr(executor, "get_process_pool", lambda: pool)
+    yield pool
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Tasks:
+    """
+    每个任务开始时记录名称，然后等待对应的事件
+    """
+    def __init__(self):
+        self.started = []
+        self.events = {}
+
+    def run(self, limiter, name, memory, **kwargs):
+        event = self.events[name] = threading.Event()
+
+        def work():
+            self.started.append(name)
+            event.wait(10)
+            return name
+        return asyncio.ensure_future(limiter.run(work, memory=memory, **kwargs))
+
+    def finish(self, name):
+        self.events[name].set()
+
+
+async def _settle():
+    # 让线程池中的任务开始执行、完成回调回到事件循环
+    await asyncio.sleep(0.05)
+
+
+def test_small_tasks_bypass_blocked_task_up_to_limit():
+    async def scenario():
+        limiter = VolumeJobLimiter(max_running=4, max_queued=8, memory_budget=100, max_bypass=1)
+        tasks = Tasks()
+        first = tasks.run(limiter, "a", 60)
+        large = tasks.run(limiter, "b", 50)
+        small = tasks.run(limiter, "c", 30)
+        tiny = tasks.run(limiter, "d", 5)
+        await _settle()
+        # c 越过放不下的 b；b 已被越过一次，d 不能再越过
+        assert tasks.started == ["a", "c"]
+        assert limiter.memory_reserved == 90 and limiter.waiting == 2
+
+        tasks.finish("a")
+        await first
+        await _settle()
+        assert sorted(tasks.started[2:]) == ["b", "d"]
+        for name in "bcd":
+            tasks.finish(name)
+        assert await asyncio.gather(large, small, tiny) == ["b", "c", "d"]
+        assert limiter.running == 0 and limiter.memory_reserved == 0
+    asyncio.run(scenario())
+
+
+def test_queue_depth_rejects_requests_but_not_jobs():
+    async def scenario():
+        limiter = VolumeJobLimiter(max_running=1, max_queued=1)
+        tasks = Tasks()
+        running = tasks.run(limiter, "a", 0)
+        queued = tasks.run(limiter, "b", 0)
+        await _settle()
+        with pytest.raises(QueueFullError):
+            await limiter.run(lambda: None)
+        # 批量任务不受排队上限约束
+        job = tasks.run(limiter, "c", 0, reject_when_full=False)
+        await _settle()
+        assert limiter.waiting == 2 and limiter.queued == 1
+        for name in "abc":
+            tasks.finish(name)
+        assert await asyncio.gather(running, queued, job) == ["a", "b", "c"]
+    asyncio.run(scenario())
+
+
+def test_cancelled_request_keeps_reservation_until_computation_ends():
+    async def scenario():
+        limiter = VolumeJobLimiter(max_running=2, max_queued=8, memory_budget=100)
+        tasks = Tasks()
+        request = tasks.run(limiter, "a", 80)
+        await _settle()
+        request.cancel()
+        await _settle()
+        # 客户端断开后计算仍在进行，内存仍被占用，放不下的任务继续等待
+        assert limiter.running == 1 and limiter.memory_reserved == 80
+        waiting = tasks.run(limiter, "b", 40)
+        await _settle()
+        assert tasks.started == ["a"]
+
+        tasks.finish("a")
+        await _settle()
+        assert tasks.started == ["a", "b"]
+        tasks.finish("b")
+        assert await waiting == "b"
+        assert limiter.running == 0 and limiter.memory_reserved == 0
+    asyncio.run(scenario())
+
+
+def test_on_start_can_skip_computation():
+    async def scenario():
+        limiter = VolumeJobLimiter(max_running=1, max_queued=8, memory_budget=100)
+        calls = []
+
+        async def cancelled():
+            return False
+        assert await limiter.run(calls.append, "x", memory=50, on_start=cancelled) is None
+        assert calls == [] and limiter.running == 0 and limiter.memory_reserved == 0
+    asyncio.run(scenario())
+
+
+def test_mask_cache_is_charged_to_budget():
+    async def scenario():
+        limiter = VolumeJobLimiter(max_running=4, max_queued=8, memory_budget=100)
+        tasks = Tasks()
+        limiter.report_mask_cache(1234, 70)
+        first = tasks.run(limiter, "a", 20)
+        second = tasks.run(limiter, "b", 20)
+        await _settle()
+        assert tasks.started == ["a"]
+        # 缓存被淘汰后放行等待中的任务
+        limiter.report_mask_cache(1234, 10)
+        await _settle()
+        assert tasks.started == ["a", "b"]
+        for name in "ab":
+            tasks.finish(name)
+        await asyncio.gather(first, second)
+        assert limiter.stats()["mask_cache_bytes"] == 10
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+# coding: utf8
+"""
+只重采样掩膜包围盒覆盖的子区域 (crop) 时，直方图、体积与各标签包围盒应与整个参考网格重采样的结果完全相同，
+分块重采样 (memory_limit 较小) 与两种掩膜加载方式下也是如此
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import MISALIGNMENTS, make_mask
+from utils.volumer import DicomVolumer, ReferenceGeometry
+
+REFERENCE = ReferenceGeometry((40, 36, 20), (0.9, 0.8, 2.0), (-18.0, -14.0, -20.0),
+                              sitk.VersorTransform((0, 0, 1), np.deg2rad(8.0)).GetMatrix())
+
+
+def _run(path, **kwargs):
+    volumer = DicomVolumer(label_boxes=True, **kwargs)
+    volumes = volumer.get_volume("", path, geometry=REFERENCE)
+    return volumes, volumer.summary, volumer.stats
+
+
+@pytest.mark.parametrize("misalignment", MISALIGNMENTS)
+@pytest.mark.parametrize("use_memmap", [True, False])
+@pytest.mark.parametrize("memory_limit", [None, 4096])
+def test_crop_matches_full_grid(tmp_path, misalignment, use_memmap, memory_limit):
+    path = str(tmp_path / "roi.nii")
+    # 标签较小，包围盒只覆盖参考网格的一部分
+    make_mask(path, REFERENCE, labels=3, misalignment=misalignment, fill=0.05)
+
+    full_volumes, full_summary, _ = _run(path, crop=False, use_memmap=False)
+    volumes, summary, stats = _run(path, crop=True, use_memmap=use_memmap, memory_limit=memory_limit)
+    assert volumes == full_volumes
+    assert summary["histogram"] == full_summary["histogram"]
+    assert summary["bboxes"] == full_summary["bboxes"]
+    if stats["resample_mode"].startswith("crop"):
+        # 裁剪的子区域小于参考网格
+        assert np.prod(stats["crop_region"]["size"]) < np.prod(REFERENCE.GetSize())
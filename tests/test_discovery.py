@@ -0,0 +1,58 @@
+# coding: utf8
+"""
+并行遍历 (iter_dicom_folders) 找到的DICOM目录与逐级遍历相同；
+discovery 阶段只计遍历本身的耗时，不包括调用方处理每个结果的时间
+"""
+import time
+import pytest
+from benchmarks.synthetic import make_tree
+from utils import filehelper
+from utils.filehelper import iter_dicom_folders
+
+# 调用方处理每个结果的时间 (秒)
+CONSUMER_DELAY = 0.02
+
+
+class StageRecorder:
+    def __init__(self):
+        self.observed = []
+
+    def observe(self, value, stage):
+        self.observed.append((stage, value))
+
+    def total(self, stage):
+        return sum(value for name, value in self.observed if name == stage)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = str(tmp_path)
+    return root, make_tree(root, depth=3, fanout=3, series_every=2, slices=2)
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    recorder = StageRecorder()
+    monkeypatch.setattr(filehelper, "stage_seconds", recorder)
+    return recorder
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_finds_every_series(tree, stages, workers):
+    root, expected = tree
+    found = []
+    for path in iter_dicom_folders(root, workers=workers):
+        found.append(path)
+        time.sleep(CONSUMER_DELAY)
+    assert sorted(found) == expected
+    # 遍历只记录一次，且不包括调用方的处理时间
+    assert [name for name, _ in stages.observed] == ["discovery"]
+    assert stages.total("discovery") < CONSUMER_DELAY * len(expected)
+
+
+def test_early_exit_records_discovery(tree, stages):
+    root, expected = tree
+    iterator = iter_dicom_folders(root, workers=2)
+    assert next(iterator) in expected
+    iterator.close()
+    assert [name for name, _ in stages.observed] == ["discovery"]
@@ -0,0 +1,114 @@
+# coding: utf8
+"""
+任务结果的CSV/XLSX导出：每个标签一行，内容与任务结果一致；失败的目录输出一行，
+文本中的逗号、引号、换行与XML特殊字符不破坏文件结构，分块输出后拼接的结果完整
+"""
+import csv
+import io
+import zipfile
+from xml.etree import ElementTree
+import pytest
+from benchmarks.synthetic import make_study
+from utils import export
+from utils.export import COLUMN_TYPES, COLUMNS, iter_csv, iter_xlsx
+from utils.jobqueue import JobQueue
+from utils.pipeline import run_volume_task
+
+SHEET_NS = {"s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+ERROR_MESSAGE = '体积计算失败: "a, b"\n<&>\x01'
+
+
+@pytest.fixture
+def job(tmp_path, isolated_cache, monkeypatch):
+    # 每行输出一次，检查分块拼接的结果
+    monkeypatch.setattr(export, "CHUNK_ROWS", 1)
+    items = make_study(str(tmp_path / "study"), patients=2, size=(20, 16), slices=6, labels=3,
+                       misalignment="shift", mask_format="nii", fill=0.3)
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    job_id = queue.submit([{"folder_path": folder, "roi_file": roi_file} for folder, roi_file in items]
+                          + [{"folder_path": "/missing, \"dir\"", "roi_file": "roi.nii"}])
+    results = []
+    for item in queue.claim(10):
+        assert queue.start(job_id, item["index"])
+        if item["index"] < len(items):
+            record = run_volume_task(item["folder_path"], item["roi_file"], intensity=item["index"] == 0,
+                                     keep_volumes=True)
+        else:
+            record = {"folder_path": item["folder_path"], "roi_file": item["roi_file"],
+                      "status": "error", "message": ERROR_MESSAGE}
+        results.append((job_id, item["index"], record))
+    queue.complete_many(results)
+    return list(queue.iter_items(job_id))
+
+
+def _expected_rows(items):
+    rows = []
+    for item in items:
+        volumes = item.get("volumes") or [[None, {}]]
+        for label, bucket in volumes:
+            rows.append(dict(folder_path=item["folder_path"], status=item["status"], label=label,
+                             voxel_count=bucket.get("voxel_count"), volume_mm3=bucket.get("volume_mm3"),
+                             mean_hu=bucket.get("mean_hu")))
+    return rows
+
+
+def _parse(value, kind):
+    # CSV中的文本按列类型还原，空字符串为 None
+    if value == "":
+        return None
+    return {"int": int, "float": float, "bool": lambda text: text == "True", "str": str}[kind](value)
+
+
+def test_csv_contents(job):
+    chunks = list(iter_csv(iter(job)))
+    assert len(chunks) > 2
+    text = b"".join(chunks).decode("utf-8")
+    assert text.startswith("\ufeff")
+    reader = csv.DictReader(io.StringIO(text[1:], newline=""))
+    assert reader.fieldnames == COLUMNS
+    rows = [{name: _parse(row[name], kind) for name, kind in COLUMN_TYPES} for row in reader]
+
+    expected = _expected_rows(job)
+    assert len(rows) == len(expected)
+    for row, want in zip(rows, expected):
+        for name, value in want.items():
+            assert row[name] == value
+    assert rows[-1]["message"] == ERROR_MESSAGE
+    # 只有统计了CT值的目录有CT值列
+    assert all((row["mean_hu"] is not None) == (row["folder_path"] == job[0]["folder_path"]) for row in rows[:-1])
+    assert all(row["size_x"] == 20 and row["size_z"] == 6 for row in rows[:-1])
+
+
+def _cell_value(cell):
+    kind = cell.get("t")
+    if kind == "inlineStr":
+        return cell.find("s:is/s:t", SHEET_NS).text or ""
+    value = cell.find("s:v", SHEET_NS)
+    if value is None:
+        return None
+    if kind == "b":
+        return value.text == "1"
+    number = float(value.text)
+    return int(number) if number.is_integer() and "." not in value.text else number
+
+
+def test_xlsx_contents(job):
+    chunks = list(iter_xlsx(iter(job)))
+    assert len(chunks) > 2
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert "xl/workbook.xml" in archive.namelist()
+        sheet = ElementTree.fromstring(archive.read("xl/worksheets/sheet1.xml"))
+    rows = [[_cell_value(cell) for cell in row.findall("s:c", SHEET_NS)]
+            for row in sheet.findall("s:sheetData/s:row", SHEET_NS)]
+    assert rows[0] == COLUMNS
+    rows = [dict(zip(COLUMNS, row)) for row in rows[1:]]
+
+    expected = _expected_rows(job)
+    assert len(rows) == len(expected)
+    for row, want in zip(rows, expected):
+        for name, value in want.items():
+            assert row[name] == value
+        assert row["cached"] in (None, False, True)
+    # XML 不允许的控制字符被去掉，其余字符原样保留
+    assert rows[-1]["message"] == ERROR_MESSAGE.replace("\x01", "")
@@ -0,0 +1,79 @@
+# coding: utf8
+"""
+体素中心重合时的数组快速路径 (grid_index_mapping 的轴置换、翻转、整数倍抽样与平移)
+应与 ResampleImageFilter 最近邻重采样到参考网格的结果逐体素一致
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import MISALIGNMENTS, make_mask
+from utils.volumer import (DicomVolumer, ReferenceGeometry, grid_index_mapping, label_histogram,
+                           mapped_reference_view)
+
+REFERENCE = ReferenceGeometry((36, 30, 16), (0.8, 0.7, 2.5), (-12.0, -9.0, -16.0),
+                              sitk.VersorTransform((0, 0, 1), np.deg2rad(12.0)).GetMatrix())
+# 体素中心与参考网格重合的几何关系
+FAST_PATHS = ("aligned", "flip", "fine", "permute", "subregion")
+
+
+def _make_mask(path, case):
+    if case in MISALIGNMENTS:
+        make_mask(path, REFERENCE, labels=3, misalignment=case, fill=0.2)
+        return
+    mask = make_mask(path, REFERENCE, labels=3, misalignment="aligned", fill=0.2)
+    if case == "permute":
+        # 交换 x、y 轴的存储顺序，物理位置不变
+        mask = sitk.PermuteAxes(mask, [1, 0, 2])
+    elif case == "subregion":
+        # 整数个体素的平移，部分参考网格落在掩膜范围外
+        mask = mask[3:, 2:, 1:]
+    sitk.WriteImage(mask, path)
+
+
+def _resample(mask):
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(REFERENCE.GetSize())
+    resampler.SetOutputSpacing(REFERENCE.GetSpacing())
+    resampler.SetOutputOrigin(REFERENCE.GetOrigin())
+    resampler.SetOutputDirection(REFERENCE.GetDirection())
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetOutputPixelType(mask.GetPixelID())
+    return sitk.GetArrayFromImage(resampler.Execute(mask))
+
+
+def _boxes(array):
+    boxes = []
+    for label in np.unique(array[array != 0]):
+        zs, ys, xs = np.nonzero(array == label)
+        boxes.append([int(label), [int(xs.min()), int(ys.min()), int(zs.min())],
+                      [int(xs.max()), int(ys.max()), int(zs.max())]])
+    return boxes
+
+
+@pytest.mark.parametrize("case", MISALIGNMENTS + ("permute", "subregion"))
+@pytest.mark.parametrize("use_memmap", [True, False])
+def test_matches_resample_filter(tmp_path, case, use_memmap):
+    path = str(tmp_path / "roi.nii")
+    _make_mask(path, case)
+    # 按保存后的文件计算 (NIfTI 中的原点为 float32)
+    mask = sitk.ReadImage(path)
+    expected = _resample(mask)
+
+    mapping = grid_index_mapping(mask, REFERENCE)
+    assert (mapping is not None) == (case in FAST_PATHS)
+    if mapping is not None:
+        view, start_index = mapped_reference_view(sitk.GetArrayViewFromImage(mask), mask.GetSize(),
+                                                  REFERENCE.GetSize(), mapping)
+        x0, y0, z0 = start_index
+        nz, ny, nx = view.shape
+        # 视图覆盖的子区域逐体素相同，其余体素在掩膜范围外，重采样结果为背景
+        np.testing.assert_array_equal(view, expected[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx])
+        assert expected.sum() == view.sum()
+
+    volumer = DicomVolumer(use_memmap=use_memmap, crop=False, label_boxes=True)
+    volumer.get_volume("", path, geometry=REFERENCE)
+    mode = volumer.stats["resample_mode"]
+    assert (mode == "aligned" or mode.startswith("array:")) == (case in FAST_PATHS)
+    assert volumer.summary["histogram"] == [[label, count] for label, count in
+                                            sorted(label_histogram(expected).items())]
+    assert volumer.summary["bboxes"] == _boxes(expected)
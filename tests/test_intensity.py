@@ -0,0 +1,50 @@
+# coding: utf8
+"""
+各标签CT值统计 (IntensityStats 在统计直方图的同一遍中累计) 应与
+ImageSeriesReader 读取图像、重采样掩膜后逐标签直接计算的结果一致
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import MISALIGNMENTS, make_mask, make_series
+from utils.volumer import DicomVolumer
+
+
+@pytest.fixture(scope="module")
+def series(tmp_path_factory):
+    series_dir = str(tmp_path_factory.mktemp("series"))
+    reference = make_series(series_dir, size=(32, 28), slices=12, spacing=(0.8, 0.9, 2.0))
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(series_dir))
+    return series_dir, reference, reader.Execute()
+
+
+def _naive_intensity(image, mask):
+    resampled = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0, mask.GetPixelID())
+    labels = sitk.GetArrayFromImage(resampled)
+    values = sitk.GetArrayFromImage(image).astype(np.float64)
+    results = {}
+    for label in np.unique(labels[labels != 0]):
+        selected = values[labels == label]
+        results[int(label)] = {"voxel_count": int(selected.size), "mean_hu": selected.mean(),
+                               "min_hu": selected.min(), "max_hu": selected.max(), "std_hu": selected.std()}
+    return results
+
+
+@pytest.mark.parametrize("misalignment", MISALIGNMENTS)
+@pytest.mark.parametrize("memory_limit", [None, 2048])
+def test_matches_naive_statistics(tmp_path, series, misalignment, memory_limit):
+    series_dir, reference, image = series
+    path = str(tmp_path / "roi.nii")
+    make_mask(path, reference, labels=3, misalignment=misalignment, fill=0.2)
+    expected = _naive_intensity(image, sitk.ReadImage(path))
+
+    volumer = DicomVolumer(memory_limit=memory_limit, crop=True)
+    volumes = volumer.get_volume(series_dir, path, intensity=True)
+    assert sorted(volumes) == sorted(expected)
+    for label, bucket in volumes.items():
+        assert bucket["voxel_count"] == expected[label]["voxel_count"]
+        assert bucket["min_hu"] == expected[label]["min_hu"]
+        assert bucket["max_hu"] == expected[label]["max_hu"]
+        assert bucket["mean_hu"] == pytest.approx(expected[label]["mean_hu"], rel=1e-9, abs=1e-9)
+        assert bucket["std_hu"] == pytest.approx(expected[label]["std_hu"], rel=1e-6, abs=1e-6)
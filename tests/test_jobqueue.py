@@ -0,0 +1,64 @@
+# coding: utf8
+"""
+任务队列：领取的目录在开始计算时才计入计算次数，重启与取消只影响尚未开始的目录
+"""
+import pytest
+from utils.jobqueue import (ITEM_CANCELLED, ITEM_ERROR, ITEM_PENDING, ITEM_QUEUED, ITEM_RUNNING, JOB_CANCELLED,
+                            JobQueue)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite"), max_attempts=3)
+
+
+def _submit(queue, count):
+    return queue.submit([{"folder_path": "/data/p{:03d}/dicom".format(index), "roi_file": "roi.nii.gz"}
+                         for index in range(count)])
+
+
+def _statuses(queue, job_id):
+    return {item["index"]: item for item in queue.iter_items(job_id)}
+
+
+def test_claimed_items_survive_restarts(queue):
+    job_id = _submit(queue, 40)
+    for _ in range(3):
+        claimed = queue.claim(32)
+        assert len(claimed) == 32
+        assert all(item["status"] == ITEM_QUEUED for item in _statuses(queue, job_id).values()
+                   if item["index"] < 32)
+        # 只有第一个目录开始计算，其余目录还在等待名额时服务重启
+        assert queue.start(job_id, claimed[0]["index"])
+        queue.recover()
+
+    items = _statuses(queue, job_id)
+    # 三次计算都被中断的目录标记为失败，从未开始计算的目录仍待计算且不计入次数
+    assert items[0]["status"] == ITEM_ERROR
+    assert items[0]["attempts"] == 3
+    assert all(items[index]["status"] == ITEM_PENDING and items[index]["attempts"] == 0 for index in range(1, 40))
+    assert len(queue.claim(100)) == 39
+
+
+def test_cancel_skips_claimed_items(queue):
+    job_id = _submit(queue, 40)
+    claimed = queue.claim(100)
+    assert len(claimed) == 40
+    running = claimed[:2]
+    for item in running:
+        assert queue.start(job_id, item["index"])
+
+    assert queue.cancel(job_id)
+    job = queue.get_job(job_id)
+    assert job["status"] == JOB_CANCELLED
+    assert job["counts"][ITEM_RUNNING] == 2
+    assert job["counts"][ITEM_CANCELLED] == 38
+    assert job["counts"][ITEM_QUEUED] == 0
+    # 已领取但尚未开始的目录在获得名额时不再计算
+    assert not queue.start(job_id, claimed[2]["index"])
+
+    # 正在计算的目录完成后写回结果，任务中不再有未完成的目录
+    states = queue.complete_many([(job_id, item["index"], {"status": "success", "message": "ok"})
+                                  for item in running])
+    assert states[job_id] == (JOB_CANCELLED, False)
+    assert queue.claim(100) == []
@@ -0,0 +1,39 @@
+# coding: utf8
+"""
+标签摘要：任意标签子集由缓存的摘要计算的体积，应与完整结果中对应的标签以及直接计算该子集的结果完全相同
+"""
+import numpy as np
+import pytest
+from benchmarks.synthetic import MISALIGNMENTS, make_study
+from utils.pipeline import calculate_folder_volume, load_label_summary, resolve_roi_path
+from utils.volumer import DicomVolumer
+
+LABELS = 4
+SUBSETS = ([1], [2, 4], [4, 3, 1], [3, 99])
+
+
+@pytest.mark.parametrize("misalignment", MISALIGNMENTS)
+def test_subsets_match_full_summary(tmp_path, isolated_cache, misalignment):
+    [(folder, roi_file)] = make_study(str(tmp_path / "study"), patients=1, size=(24, 20), slices=10,
+                                      labels=LABELS, misalignment=misalignment, mask_format="nii", fill=0.3)
+    roi_path = resolve_roi_path(folder, roi_file)
+
+    full = calculate_folder_volume(folder, roi_path)
+    assert not full["cached"]
+    assert sorted(full["volumes"]) == list(range(1, LABELS + 1))
+    summary = load_label_summary(folder, roi_file)
+    geometry = summary["geometry"]
+    assert sum(count for _, count in summary["histogram"]) == np.prod(geometry["size"])
+
+    for subset in SUBSETS:
+        result = calculate_folder_volume(folder, roi_path, label_values=subset)
+        assert result["cached"]
+        assert result["resample_mode"] == full["resample_mode"]
+        assert list(result["volumes"]) == subset
+        # 直接计算该子集，不经过缓存
+        assert result["volumes"] == DicomVolumer().get_volume(folder, roi_path, label_values=subset)
+        for label in subset:
+            if label in full["volumes"]:
+                assert result["volumes"][label] == full["volumes"][label]
+            else:
+                assert result["volumes"][label]["voxel_count"] == 0
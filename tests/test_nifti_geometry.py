@@ -0,0 +1,63 @@
+# coding: utf8
+"""
+内存映射读取的掩膜 (memmap_nifti) 的空间信息与 sform/qform 的选择应与 sitk.ReadImage 一致，
+默认 (use_memmap=True) 与 sitk 读取的体积计算结果完全相同
+"""
+import struct
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import make_mask
+from utils.nifti import memmap_nifti
+from utils.volumer import DicomVolumer, ReferenceGeometry
+
+# NIfTI-1 文件头中 qform_code、sform_code (int16) 与 qoffset (3个float32) 的偏移
+XFORM_CODES_OFFSET = 252
+QOFFSET_OFFSET = 268
+
+REFERENCE = ReferenceGeometry((48, 40, 24), (0.8, 0.9, 2.0), (-20.0, -15.0, -10.0),
+                              sitk.VersorTransform((0, 0, 1), np.deg2rad(10.0)).GetMatrix())
+
+
+def _write_mask(path, qform_code, sform_code, qform_shift=None):
+    # ITK 写入的 sform 与 qform 相同，按需要修改变换代码并平移 qform 的原点
+    make_mask(path, REFERENCE, labels=2, misalignment="shift", fill=0.2)
+    with open(path, "r+b") as f:
+        f.seek(XFORM_CODES_OFFSET)
+        f.write(struct.pack("<hh", qform_code, sform_code))
+        if qform_shift is not None:
+            f.seek(QOFFSET_OFFSET)
+            qoffset = np.asarray(struct.unpack("<3f", f.read(12))) + np.asarray(qform_shift)
+            f.seek(QOFFSET_OFFSET)
+            f.write(struct.pack("<3f", *qoffset))
+
+
+@pytest.mark.parametrize("qform_code, sform_code, qform_shift", [
+    (1, 1, None),
+    (0, 1, None),
+    (1, 0, None),
+    # qform 与 sform 不同：sform_code 为1 (SCANNER_ANAT) 时 ITK 使用 sform，否则使用 qform
+    (1, 1, (6.0, -4.0, 8.0)),
+    (1, 2, (6.0, -4.0, 8.0)),
+    (2, 3, (6.0, -4.0, 8.0)),
+    (1, 4, (6.0, -4.0, 8.0)),
+    (0, 2, (6.0, -4.0, 8.0)),
+])
+def test_memmap_matches_sitk(tmp_path, qform_code, sform_code, qform_shift):
+    path = str(tmp_path / "roi.nii")
+    _write_mask(path, qform_code, sform_code, qform_shift)
+    expected = sitk.ReadImage(path)
+
+    mapped = memmap_nifti(path)
+    assert mapped is not None
+    array, (size, spacing, origin, direction) = mapped
+    assert tuple(size) == expected.GetSize()
+    np.testing.assert_allclose(spacing, expected.GetSpacing(), atol=1e-5)
+    np.testing.assert_allclose(origin, expected.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(direction, expected.GetDirection(), atol=1e-5)
+    np.testing.assert_array_equal(array, sitk.GetArrayViewFromImage(expected))
+
+    # 默认的内存映射路径与 sitk.ReadImage 路径的体积完全相同
+    memmap = DicomVolumer(use_memmap=True, label_boxes=False).get_volume("", path, geometry=REFERENCE)
+    reference = DicomVolumer(use_memmap=False, label_boxes=False).get_volume("", path, geometry=REFERENCE)
+    assert memmap == reference
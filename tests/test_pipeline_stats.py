@@ -0,0 +1,22 @@
+# coding: utf8
+"""
+任务统计：请求统计时 (trace_memory) 返回标签统计的内存峰值，未请求时不启用 tracemalloc
+"""
+import tracemalloc
+import pytest
+from benchmarks.synthetic import make_study
+from utils.pipeline import run_volume_task
+
+
+@pytest.mark.parametrize("trace_memory", [False, True])
+def test_label_count_peak_bytes(tmp_path, isolated_cache, trace_memory):
+    [(folder, roi_file)] = make_study(str(tmp_path / "study"), patients=1, size=(24, 20), slices=8, labels=2,
+                                      misalignment="shift", mask_format="nii", fill=0.2)
+    record = run_volume_task(folder, roi_file, use_cache=False, trace_memory=trace_memory)
+    assert record["status"] == "success"
+    stats = record["stats"]
+    assert ("label_count_peak_bytes" in stats) == trace_memory
+    if trace_memory:
+        assert stats["label_count_peak_bytes"] > 0
+    # 只在标签统计期间跟踪内存分配
+    assert not tracemalloc.is_tracing()
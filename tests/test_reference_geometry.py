@@ -0,0 +1,41 @@
+# coding: utf8
+"""
+read_series_geometry 只读取文件头得到的网格应与 ImageSeriesReader 解码整个序列的结果一致
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import make_series
+from utils.volumer import read_series_geometry
+
+# 绕 (1, 1, 0) 方向旋转20度的斜位序列
+OBLIQUE = np.asarray(sitk.VersorTransform((1 / np.sqrt(2), 1 / np.sqrt(2), 0), np.deg2rad(20.0)).GetMatrix())
+
+
+def _series_reader_geometry(files):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(files)
+    image = reader.Execute()
+    return image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()
+
+
+@pytest.mark.parametrize("name, slices, direction, reverse", [
+    ("axial", 8, None, False),
+    ("reversed", 8, None, True),
+    ("oblique", 8, OBLIQUE, False),
+    ("single", 1, None, False),
+])
+def test_matches_series_reader(tmp_path, name, slices, direction, reverse):
+    series_dir = str(tmp_path / name)
+    make_series(series_dir, size=(16, 12), slices=slices, spacing=(0.7, 0.9, 2.0), direction=direction)
+    files = list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(series_dir))
+    if reverse:
+        # 文件按相反的顺序传入：层方向取反
+        files = files[::-1]
+
+    size, spacing, origin, direction = _series_reader_geometry(files)
+    geometry = read_series_geometry(files)
+    assert geometry.GetSize() == size
+    np.testing.assert_allclose(geometry.GetSpacing(), spacing, atol=1e-6)
+    np.testing.assert_allclose(geometry.GetOrigin(), origin, atol=1e-6)
+    np.testing.assert_allclose(geometry.GetDirection(), direction, atol=1e-6)
@@ -0,0 +1,66 @@
+# coding: utf8
+"""
+结果缓存按DICOM目录与ROI文件的指纹失效：修改ROI、修改/增加/删除DICOM文件后重新计算，
+掩膜缓存 (.nii.gz 经 sitk.ReadImage 读取) 也不会返回修改前的掩膜
+"""
+import os
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import make_mask, make_study
+from utils.pipeline import calculate_folder_volume, resolve_roi_path
+from utils.volumer import read_series_geometry
+
+
+def _bump_mtime(path):
+    # 文件系统的时间戳精度可能较粗，显式推后修改时间，保证指纹变化
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+
+def _reference(folder):
+    return read_series_geometry(list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder)))
+
+
+@pytest.fixture(params=["nii", "nii.gz"])
+def study(request, tmp_path, isolated_cache):
+    [(folder, roi_file)] = make_study(str(tmp_path / "study"), patients=1, size=(24, 20), slices=8, labels=2,
+                                      misalignment="shift", mask_format=request.param, fill=0.2)
+    roi_path = resolve_roi_path(folder, roi_file)
+    first = calculate_folder_volume(folder, roi_path)
+    assert not first["cached"]
+    assert calculate_folder_volume(folder, roi_path)["cached"]
+    return folder, roi_path, first
+
+
+def test_roi_change_invalidates(study):
+    folder, roi_path, first = study
+    make_mask(roi_path, _reference(folder), labels=3, misalignment="shift", fill=0.3, seed=7)
+    _bump_mtime(roi_path)
+
+    result = calculate_folder_volume(folder, roi_path)
+    assert not result["cached"]
+    assert sorted(result["volumes"]) == [1, 2, 3]
+    assert result["volumes"] != first["volumes"]
+    assert calculate_folder_volume(folder, roi_path)["cached"]
+
+
+@pytest.mark.parametrize("change", ["modify", "add", "remove"])
+def test_dicom_change_invalidates(study, change):
+    folder, roi_path, first = study
+    files = sorted(os.listdir(folder))
+    if change == "modify":
+        _bump_mtime(os.path.join(folder, files[0]))
+    elif change == "add":
+        with open(os.path.join(folder, "notes.txt"), "w") as f:
+            f.write("x")
+    else:
+        # 去掉最后一层，参考网格变小
+        os.remove(os.path.join(folder, files[-1]))
+
+    result = calculate_folder_volume(folder, roi_path)
+    assert not result["cached"]
+    if change == "remove":
+        assert result["geometry"]["size"][2] == first["geometry"]["size"][2] - 1
+    else:
+        assert result["volumes"] == first["volumes"]
+    assert calculate_folder_volume(folder, roi_path)["cached"]
@@ -0,0 +1,59 @@
+# coding: utf8
+"""
+多线程逐层解码 (read_series_array) 的数组与网格应与 ImageSeriesReader.Execute() 逐体素一致，
+压缩与未压缩、斜位、文件顺序相反与单层的序列，以及不同的线程数与预读文件数下都是如此
+"""
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import make_series
+from utils import config
+from utils.volumer import DicomVolumer, read_series_array
+
+OBLIQUE = np.asarray(sitk.VersorTransform((1 / np.sqrt(2), 1 / np.sqrt(2), 0), np.deg2rad(20.0)).GetMatrix())
+
+
+def _series_reader(files):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(files)
+    return reader.Execute()
+
+
+def _assert_same(array, geometry, expected):
+    assert geometry.GetSize() == expected.GetSize()
+    np.testing.assert_allclose(geometry.GetSpacing(), expected.GetSpacing(), atol=1e-6)
+    np.testing.assert_allclose(geometry.GetOrigin(), expected.GetOrigin(), atol=1e-6)
+    np.testing.assert_allclose(geometry.GetDirection(), expected.GetDirection(), atol=1e-6)
+    expected_array = sitk.GetArrayViewFromImage(expected)
+    assert array.dtype == expected_array.dtype
+    np.testing.assert_array_equal(array, expected_array)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("name, slices, direction, reverse", [
+    ("axial", 9, None, False),
+    ("reversed", 9, None, True),
+    ("oblique", 9, OBLIQUE, False),
+    ("single", 1, None, False),
+])
+@pytest.mark.parametrize("workers, prefetch", [(1, 0), (4, 0), (4, 3)])
+def test_matches_series_reader(tmp_path, compress, name, slices, direction, reverse, workers, prefetch):
+    series_dir = str(tmp_path / name)
+    make_series(series_dir, size=(16, 12), slices=slices, spacing=(0.7, 0.9, 2.0), direction=direction,
+                compress=compress)
+    files = list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(series_dir))
+    if reverse:
+        files = files[::-1]
+    array, geometry = read_series_array(files, workers=workers, prefetch=prefetch)
+    _assert_same(array, geometry, _series_reader(files))
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_load_dicom_images(tmp_path, monkeypatch, workers):
+    # 线程数为1时使用 ImageSeriesReader，否则由解码的数组构建图像，两者相同
+    series_dir = str(tmp_path / "series")
+    make_series(series_dir, size=(16, 12), slices=6, spacing=(0.7, 0.9, 2.0), direction=OBLIQUE, compress=True)
+    monkeypatch.setattr(config, "DICOM_DECODE_WORKERS", workers)
+    image = DicomVolumer()._load_dicom_images(series_dir)
+    expected = _series_reader(list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(series_dir)))
+    _assert_same(sitk.GetArrayViewFromImage(image), image, expected)
@@ -0,0 +1,131 @@
+# coding: utf8
+"""
+相同请求的合并 (SingleFlight)：进行中的相同键只计算一次，失败与取消不影响其他等待者，
+完成后的键不再合并；/calculate_volume 的并发相同请求只提交一次体积计算
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pytest
+from fastapi import FastAPI
+from httpserver.api import executor, routes
+from httpserver.api.executor import SingleFlight
+
+
+class Computation:
+    """
+    记录调用次数的协程函数，在 release 之前一直等待
+    """
+    def __init__(self, result="ok", error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.released = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.released.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_calls_share_one_computation():
+    async def scenario():
+        flights = SingleFlight()
+        first, other = Computation("a"), Computation("b")
+        calls = [asyncio.ensure_future(flights.run("k", first)) for _ in range(3)]
+        calls.append(asyncio.ensure_future(flights.run("other", other)))
+        await asyncio.sleep(0)
+        assert flights.inflight == 2
+        first.released.set()
+        other.released.set()
+        results = await asyncio.gather(*calls)
+        assert results == [("a", False), ("a", True), ("a", True), ("b", False)]
+        assert first.calls == 1 and other.calls == 1
+        assert flights.inflight == 0
+
+        # 完成后相同的键重新计算
+        again = Computation("c")
+        again.released.set()
+        assert await flights.run("k", again) == ("c", False)
+        assert again.calls == 1
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_waiter_and_releases_key():
+    async def scenario():
+        flights = SingleFlight()
+        failing = Computation(error=ValueError("boom"))
+        calls = [asyncio.ensure_future(flights.run("k", failing)) for _ in range(2)]
+        await asyncio.sleep(0)
+        failing.released.set()
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert failing.calls == 1 and flights.inflight == 0
+
+        retry = Computation("ok")
+        retry.released.set()
+        assert await flights.run("k", retry) == ("ok", False)
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_computation():
+    async def scenario():
+        flights = SingleFlight()
+        computation = Computation("ok")
+        first = asyncio.ensure_future(flights.run("k", computation))
+        second = asyncio.ensure_future(flights.run("k", computation))
+        await asyncio.sleep(0)
+        # 发起计算的请求断开，计算继续，合并的请求仍得到结果
+        first.cancel()
+        await asyncio.sleep(0)
+        assert flights.inflight == 1
+        computation.released.set()
+        assert await second == ("ok", True)
+        assert first.cancelled() and computation.calls == 1
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # 用线程池代替进程池，体积计算替换为等待事件的函数
+    pool = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(executor, "get_process_pool", lambda: pool)
+    app = FastAPI()
+    app.include_router(routes.router)
+    yield app
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def test_calculate_volume_coalesces_identical_requests(tmp_path, app, monkeypatch):
+    folder = tmp_path / "p000" / "dicom"
+    folder.mkdir(parents=True)
+    calls = []
+    release = threading.Event()
+
+    def fake_task(folder_path, roi_file, label_values, *args):
+        calls.append(label_values)
+        release.wait(10)
+        return {"status": "success", "volume_result": str(label_values), "cached": False, "resample_mode": "full"}
+    monkeypatch.setattr(routes, "run_volume_task", fake_task)
+    monkeypatch.setattr(routes.volume_limiter, "memory_budget", 0)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            def post(label_values):
+                return asyncio.ensure_future(client.post("/calculate_volume", json={
+                    "folder_path": str(folder), "roi_file": "roi.nii", "label_values": label_values}))
+            requests = [post([1]), post([1]), post([1]), post([2])]
+            await asyncio.sleep(0.2)
+            release.set()
+            return [response.json() for response in await asyncio.gather(*requests)]
+
+    results = asyncio.run(scenario())
+    assert sorted(calls, key=str) == [[1], [2]]
+    assert [result["volume_result"] for result in results] == ["[1]", "[1]", "[1]", "[2]"]
+    assert sorted(result["coalesced"] for result in results[:3]) == [False, True, True]
+    assert not results[3]["coalesced"]
+    assert routes.volume_flights.inflight == 0
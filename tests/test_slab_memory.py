@@ -0,0 +1,66 @@
+# coding: utf8
+"""
+重采样结果超过 VOLUME_MEMORY_LIMIT 时沿z轴分块：子进程中内存峰值的增长应在上限以内，
+各标签的体素数与不分块时完全一致
+"""
+import json
+import os
+import subprocess
+import sys
+import pytest
+from benchmarks.synthetic import make_mask
+from utils.volumer import ReferenceGeometry
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 参考网格 512x512x320 (uint8 重采样结果 80 MiB)，掩膜为其一半分辨率
+REFERENCE_SIZE = (512, 512, 320)
+MEMORY_LIMIT = 8 * 1024 * 1024
+
+# 在子进程中运行，避免测试进程已有的内存影响峰值；掩膜先读入进程内缓存，
+# 测量的只是重采样与统计
+CHILD = """
+import json, sys
+import SimpleITK as sitk
+from utils.volumer import DicomVolumer, ReferenceGeometry, label_histogram
+
+def rss(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+
+geometry = ReferenceGeometry.from_dict(json.loads(sys.argv[2]))
+limit = int(sys.argv[3])
+volumer = DicomVolumer(use_memmap=False, crop=False, label_boxes=False, memory_limit=limit)
+# 预先加载重采样与统计用到的代码，不计入增长
+mask = volumer._load_mask_image(sys.argv[1])
+label_histogram(sitk.GetArrayViewFromImage(volumer._resample_region(mask, geometry, (0, 0, 0), (8, 8, 1))))
+baseline = rss("VmRSS")
+# 把 VmHWM 重置为当前的 VmRSS
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+sliced = volumer.get_volume("", sys.argv[1], geometry=geometry)
+result = {"growth": rss("VmHWM") - baseline, "mode": volumer.stats["resample_mode"], "sliced": sliced}
+full = DicomVolumer(use_memmap=False, crop=False, label_boxes=False, memory_limit=1 << 40)
+result["full"] = full.get_volume("", sys.argv[1], geometry=geometry)
+result["full_mode"] = full.stats["resample_mode"]
+print(json.dumps(result))
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="需要 Linux 的 /proc 统计内存峰值")
+def test_slab_resampling_stays_under_limit(tmp_path):
+    reference = ReferenceGeometry(REFERENCE_SIZE, (0.7, 0.7, 1.0), (-180.0, -180.0, -160.0),
+                                  (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    mask_path = str(tmp_path / "roi.nii.gz")
+    make_mask(mask_path, reference, labels=4, misalignment="coarse", fill=0.2)
+
+    output = subprocess.run([sys.executable, "-c", CHILD, mask_path, json.dumps(reference.to_dict()),
+                             str(MEMORY_LIMIT)], cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    assert result["mode"] == "slab"
+    assert result["full_mode"] == "full"
+    assert 0 <= result["growth"] < MEMORY_LIMIT
+    assert {label: bucket["voxel_count"] for label, bucket in result["sliced"].items()} == \
+        {label: bucket["voxel_count"] for label, bucket in result["full"].items()}
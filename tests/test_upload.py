@@ -0,0 +1,207 @@
+# coding: utf8
+"""
+上传DICOM压缩包与ROI文件：分块到达的请求体边接收边解压，结果与直接计算相同；
+压缩包与表单中的路径不能写到临时目录之外，超过单次上传限制返回 413，临时空间不足返回 503，
+结束或失败后临时目录被删除且预留的空间全部归还
+"""
+import asyncio
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pytest
+from fastapi import FastAPI
+from benchmarks.synthetic import make_study
+from httpserver.api import executor, routes
+from utils import config, upload
+from utils.pipeline import calculate_folder_volume, format_volume_result, resolve_roi_path
+from utils.upload import SeriesUpload, SpoolQuota, UploadError
+
+BOUNDARY = "volumer-test-boundary"
+CONTENT_TYPE = "multipart/form-data; boundary=" + BOUNDARY
+
+
+class _Unseekable(io.RawIOBase):
+    # zipfile 写入不可 seek 的对象时在数据之后写数据描述符
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+@pytest.fixture
+def study(tmp_path, isolated_cache):
+    [(folder, roi_file)] = make_study(str(tmp_path / "study"), patients=1, size=(20, 16), slices=6, labels=2,
+                                      misalignment="rotate", mask_format="nii.gz", fill=0.3)
+    return folder, resolve_roi_path(folder, roi_file)
+
+
+def _zip(folder, compression, seekable=True, names=None):
+    """
+    :param names: 可选的 {原文件名: 压缩包中的条目名}
+    """
+    out = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(out, "w", compression=compression) as archive:
+        for name in sorted(os.listdir(folder)):
+            archive.write(os.path.join(folder, name), (names or {}).get(name, "series/" + name))
+        archive.writestr("series/notes.txt", "not a dicom file")
+        archive.writestr("__MACOSX/series/._IM00000.dcm", "resource fork")
+    return bytes(out.getvalue() if seekable else out.data)
+
+
+def _body(archive, roi_path, roi_name="roi.nii.gz", fields=None):
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            BOUNDARY, name, value).encode("utf-8"))
+    parts.append('--{}\r\nContent-Disposition: form-data; name="archive"; filename="series.zip"\r\n'
+                 'Content-Type: application/zip\r\n\r\n'.format(BOUNDARY).encode("utf-8") + archive + b"\r\n")
+    with open(roi_path, "rb") as f:
+        parts.append('--{}\r\nContent-Disposition: form-data; name="roi"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(BOUNDARY, roi_name).encode("utf-8")
+                     + f.read() + b"\r\n")
+    parts.append("--{}--\r\n".format(BOUNDARY).encode("utf-8"))
+    return b"".join(parts)
+
+
+def _feed(series_upload, body, chunk_size=997):
+    for start in range(0, len(body), chunk_size):
+        series_upload.feed(body[start:start + chunk_size])
+    series_upload.finish()
+
+
+def _files(root):
+    return sorted(os.path.relpath(os.path.join(path, name), root)
+                  for path, _, names in os.walk(root) for name in names)
+
+
+@pytest.mark.parametrize("compression, seekable", [
+    (zipfile.ZIP_DEFLATED, True),
+    (zipfile.ZIP_STORED, True),
+    # 数据描述符：deflate 条目仍然流式解压，存储条目在上传结束后按中央目录解压
+    (zipfile.ZIP_DEFLATED, False),
+    (zipfile.ZIP_STORED, False),
+])
+def test_streamed_extraction(tmp_path, study, compression, seekable):
+    folder, roi_path = study
+    spool = tmp_path / "spool"
+    quota = SpoolQuota(0)
+    series_upload = SeriesUpload(CONTENT_TYPE, spool_dir=str(spool), quota=quota)
+    _feed(series_upload, _body(_zip(folder, compression, seekable), roi_path))
+
+    assert series_upload.slice_count == len(os.listdir(folder))
+    # notes.txt 被删除，__MACOSX 中的文件不解压
+    assert series_upload.skipped == 1
+    assert series_upload.summary()["roi_file"] == "roi.nii.gz"
+    assert len(os.listdir(series_upload.dicom_dir)) == series_upload.slice_count
+    expected = calculate_folder_volume(folder, roi_path, use_cache=False)["volumes"]
+    uploaded = calculate_folder_volume(series_upload.dicom_dir,
+                                       resolve_roi_path(series_upload.dicom_dir, series_upload.roi_file),
+                                       use_cache=False)["volumes"]
+    assert uploaded == expected
+    assert quota.used == series_upload.bytes > 0
+
+    series_upload.cleanup()
+    assert not os.path.exists(series_upload.upload_dir)
+    assert quota.used == 0
+
+
+def test_paths_stay_inside_upload_dir(tmp_path, study):
+    folder, roi_path = study
+    names = sorted(os.listdir(folder))
+    # 条目名与ROI文件名中的上级目录、绝对路径与反斜杠只保留最后一级
+    hostile = {names[0]: "../../escape.dcm", names[1]: str(tmp_path / "absolute.dcm"),
+               names[2]: "..\\..\\windows.dcm"}
+    spool = tmp_path / "spool"
+    series_upload = SeriesUpload(CONTENT_TYPE, spool_dir=str(spool), quota=SpoolQuota(0))
+    before = _files(str(tmp_path))
+    _feed(series_upload, _body(_zip(folder, zipfile.ZIP_DEFLATED, names=hostile), roi_path,
+                               roi_name="../../../roi.nii.gz"))
+
+    assert series_upload.slice_count == len(names)
+    created = set(_files(str(tmp_path))) - set(before)
+    upload_dir = os.path.relpath(series_upload.upload_dir, str(tmp_path))
+    assert created and all(path.startswith(upload_dir + os.sep) for path in created)
+    extracted = os.listdir(series_upload.dicom_dir)
+    for name in ("escape.dcm", "absolute.dcm", "windows.dcm"):
+        assert sum(entry.endswith("_" + name) for entry in extracted) == 1
+    assert series_upload.roi_file == os.path.join("roi", "roi.nii.gz")
+    series_upload.cleanup()
+
+
+@pytest.mark.parametrize("max_bytes, quota_bytes, status_code", [
+    # 单次上传的大小限制
+    (4096, 0, 413),
+    # 所有上传共用的临时空间
+    (0, 4096, 503),
+])
+def test_size_limits(tmp_path, study, max_bytes, quota_bytes, status_code):
+    folder, roi_path = study
+    quota = SpoolQuota(quota_bytes)
+    series_upload = SeriesUpload(CONTENT_TYPE, spool_dir=str(tmp_path / "spool"), max_bytes=max_bytes, quota=quota)
+    with pytest.raises(UploadError) as error:
+        _feed(series_upload, _body(_zip(folder, zipfile.ZIP_DEFLATED), roi_path))
+    assert error.value.status_code == status_code
+    assert series_upload.bytes <= (max_bytes or quota_bytes)
+    series_upload.cleanup()
+    assert quota.used == 0
+    assert not os.path.exists(series_upload.upload_dir)
+
+
+@pytest.fixture
+def client_app(tmp_path, monkeypatch):
+    # 用线程池代替进程池；临时目录与临时空间使用测试目录
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(executor, "get_process_pool", lambda: pool)
+    monkeypatch.setattr(config, "UPLOAD_SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(upload, "_quota", SpoolQuota(0))
+    app = FastAPI()
+    app.include_router(routes.router)
+    yield app
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _post(app, body, chunked=False):
+    async def chunks():
+        # 分块传输，请求中没有 Content-Length
+        for start in range(0, len(body), 997):
+            yield body[start:start + 997]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/upload_volume", content=chunks() if chunked else body,
+                                     headers={"content-type": CONTENT_TYPE})
+    return asyncio.run(scenario())
+
+
+def test_upload_endpoint(tmp_path, study, client_app, monkeypatch):
+    folder, roi_path = study
+    body = _body(_zip(folder, zipfile.ZIP_DEFLATED), roi_path, fields={"label_values": "[2]"})
+    response = _post(client_app, body)
+    assert response.status_code == 200
+    content = response.json()
+    assert content["status"] == "success"
+    expected = calculate_folder_volume(folder, roi_path, label_values=[2], use_cache=False)["volumes"]
+    assert content["volume_result"] == format_volume_result(expected)
+    assert content["upload"]["slice_count"] == len(os.listdir(folder))
+    # 临时目录已删除，预留的空间全部归还
+    assert os.listdir(str(tmp_path / "spool")) == []
+    assert upload.get_spool_quota().used == 0
+
+    # 声明的长度超过限制时不读取请求体
+    monkeypatch.setattr(config, "UPLOAD_MAX_BYTES", len(body) - 1)
+    response = _post(client_app, body)
+    assert response.status_code == 413
+    # 压缩包中的文件超过限制时在接收过程中返回 413
+    monkeypatch.setattr(config, "UPLOAD_MAX_BYTES", 4096)
+    response = _post(client_app, body, chunked=True)
+    assert response.status_code == 413
+    assert os.listdir(str(tmp_path / "spool")) == []
+    assert upload.get_spool_quota().used == 0
@@ -0,0 +1,101 @@
+# coding: utf8
+"""
+目录监视重启后：已计算 (签名相同) 或只记录签名的序列仍登记为序列，
+stats() 中的序列数正确，ROI文件被替换时重新计算对应的序列
+"""
+import os
+import threading
+import time
+import pytest
+import SimpleITK as sitk
+from benchmarks.synthetic import make_mask, make_study
+from utils.volumer import read_series_geometry
+from utils.watcher import FolderWatcher
+
+TIMEOUT = 10.0
+
+
+class Settled:
+    """
+    收集 on_settled 与 on_baseline 回调的结果
+    """
+    def __init__(self):
+        self.settled = {}
+        self.baseline = {}
+        self._lock = threading.Lock()
+
+    def on_settled(self, entries):
+        with self._lock:
+            self.settled.update(entries)
+
+    def on_baseline(self, entries):
+        with self._lock:
+            self.baseline.update(entries)
+
+
+def _wait(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def _start(root, backend, settled, **kwargs):
+    watcher = FolderWatcher(root, "roi.nii.gz", settled.on_settled, on_baseline=settled.on_baseline,
+                            backend=backend, settle_seconds=0.1, poll_seconds=0.05, poll_max_seconds=0.1,
+                            workers=2, **kwargs)
+    watcher.start()
+    assert watcher.ready.wait(TIMEOUT)
+    return watcher
+
+
+def _replace_roi(dicom_dir, roi_path):
+    # 写入临时文件后替换，与传输工具的行为相同 (目录的修改时间随之变化)
+    files = list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dicom_dir))
+    tmp_path = os.path.join(os.path.dirname(roi_path), "roi.tmp.nii.gz")
+    make_mask(tmp_path, read_series_geometry(files), labels=3, misalignment="shift", fill=0.3, seed=11)
+    os.replace(tmp_path, roi_path)
+
+
+@pytest.fixture
+def study(tmp_path):
+    root = str(tmp_path / "watch")
+    items = make_study(root, patients=2, size=(12, 10), slices=3, labels=2, mask_format="nii.gz")
+    return root, [(dicom_dir, os.path.join(os.path.dirname(dicom_dir), roi_file)) for dicom_dir, roi_file in items]
+
+
+@pytest.mark.parametrize("backend", ["poll", "inotify"])
+@pytest.mark.parametrize("include_existing", [True, False])
+def test_roi_change_after_restart(study, backend, include_existing):
+    root, items = study
+    first = Settled()
+    watcher = _start(root, backend, first, include_existing=include_existing)
+    try:
+        if include_existing:
+            # 第一次启动时计算已存在的序列
+            assert _wait(lambda: len(first.settled) == len(items))
+        else:
+            assert len(first.baseline) == len(items)
+        assert watcher.stats()["series"] == len(items)
+    finally:
+        watcher.stop()
+    signatures = dict(first.settled if include_existing else first.baseline)
+    assert sorted(signatures) == sorted(dicom_dir for dicom_dir, _ in items)
+
+    # 重启：签名相同的序列不再计算，但仍登记为序列
+    second = Settled()
+    watcher = _start(root, backend, second, signatures=signatures, include_existing=True)
+    try:
+        assert watcher.stats()["series"] == len(items)
+        time.sleep(0.3)
+        assert second.settled == {}
+
+        dicom_dir, roi_path = items[0]
+        _replace_roi(dicom_dir, roi_path)
+        assert _wait(lambda: dicom_dir in second.settled)
+        assert second.settled[dicom_dir] != signatures[dicom_dir]
+        assert list(second.settled) == [dicom_dir]
+    finally:
+        watcher.stop()
@@ -0,0 +1,180 @@
+# coding: utf8
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from utils import config
+
+
+def file_fingerprint(path):
+    """
+    文件指纹: (绝对路径, 大小, 修改时间)，文件被修改后指纹随之变化
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def series_fingerprint(dicom_dir):
+    """
+    DICOM目录指纹: 目录下所有文件的 (文件名, 大小, 修改时间)，只做 stat 不读取文件内容
+    """
+    dicom_dir = os.path.abspath(dicom_dir)
+    entries = []
+    with os.scandir(dicom_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                entries.append([entry.name, st.st_size, st.st_mtime_ns])
+    entries.sort()
+    return [dicom_dir, entries]
+
+
+def summary_key(dicom_dir, roi_file):
+    """
+    标签摘要的缓存键: DICOM目录指纹 + ROI文件指纹，与请求的标签无关
+    """
+    payload = json.dumps([series_fingerprint(dicom_dir), file_fingerprint(roi_file), "label_summary"])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    磁盘上的体积结果缓存，每个结果保存为一个 JSON 文件
+    命中时更新文件修改时间，总大小超过上限时按修改时间淘汰最久未使用的条目
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            if self._total_bytes is None or self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            # 淘汰到上限的 90%，避免每次写入都触发扫描
+            target = self.max_bytes * 0.9
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        self._total_bytes = total
+
+
+class MemoryLRUCache:
+    """
+    进程内按字节数限制大小的LRU缓存，并统计命中/未命中/淘汰次数
+    单个条目超过上限时不缓存
+    """
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        # 清空所有条目，保留命中统计
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_result_cache = None
+_mask_cache = None
+
+
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(os.path.join(config.CACHE_DIR, "results"), config.RESULT_CACHE_MAX_BYTES)
+    return _result_cache
+
+
+def image_nbytes(image):
+    # sitk.Image 像素缓冲区的字节数
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+def get_mask_cache():
+    global _mask_cache
+    if _mask_cache is None:
+        _mask_cache = MemoryLRUCache(config.MASK_CACHE_MAX_BYTES, image_nbytes)
+    return _mask_cache
@@ -0,0 +1,131 @@
+# coding: utf8
+"""
+运行参数配置，均可通过同名的 VOLUMER_* 环境变量覆盖
+"""
+import os
+
+
+def _env_str(name, default):
+    return os.environ.get("VOLUMER_" + name, default)
+
+
+def _env_int(name, default):
+    value = os.environ.get("VOLUMER_" + name)
+    return int(value) if value else default
+
+
+def _env_float(name, default):
+    value = os.environ.get("VOLUMER_" + name)
+    return float(value) if value else default
+
+
+def _default_memory_budget():
+    # 物理内存的一半，无法获取时为 4 GB
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 * 1024 * 1024
+
+
+# 本地缓存目录 (结果缓存等)
+CACHE_DIR = _env_str("CACHE_DIR", "cache")
+
+# 体积结果缓存的磁盘占用上限 (字节)，超出后按最近最少使用淘汰
+RESULT_CACHE_MAX_BYTES = _env_int("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# 体积计算进程池的工作进程数
+VOLUME_WORKERS = _env_int("VOLUME_WORKERS", os.cpu_count() or 1)
+
+# 同时执行的体积计算任务数上限
+MAX_VOLUME_JOBS = _env_int("MAX_VOLUME_JOBS", VOLUME_WORKERS)
+
+# 等待执行的体积计算请求数上限，超出后新请求返回 503
+VOLUME_QUEUE_DEPTH = _env_int("VOLUME_QUEUE_DEPTH", 32)
+
+# 目录遍历等文件IO任务的线程数
+IO_WORKERS = _env_int("IO_WORKERS", 4)
+
+# 查找DICOM目录时并行遍历目录的线程数
+DISCOVERY_WORKERS = _env_int("DISCOVERY_WORKERS", 8)
+
+# 判断目录是否为DICOM序列时最多检查的文件数
+DICOM_PROBE_FILES = _env_int("DICOM_PROBE_FILES", 4)
+
+# 解码DICOM像素时的线程数 (每个体积计算进程内)，SimpleITK 解码时释放GIL
+# 只有统计CT值时需要解码像素，体积计算只读取文件头
+# 默认与ITK线程数一样按体积计算进程数平分CPU (最多8个)，避免多个进程同时解码时CPU过度订阅；
+# 至少2个线程，进程数等于CPU数时一层解码的同时另一层可以等待文件读取
+DICOM_DECODE_WORKERS = _env_int("DICOM_DECODE_WORKERS",
+                                min(8, max(2, (os.cpu_count() or 1) // max(1, VOLUME_WORKERS))))
+
+# 解码DICOM像素时提前读入文件内容的文件数，0 表示不预读
+DICOM_PREFETCH_FILES = _env_int("DICOM_PREFETCH_FILES", 16)
+
+# DICOM序列索引数据库 (SQLite) 路径
+SERIES_INDEX_PATH = _env_str("SERIES_INDEX_PATH", os.path.join(CACHE_DIR, "series_index.sqlite"))
+
+# 进程内掩膜图像缓存的内存上限 (字节)
+MASK_CACHE_MAX_BYTES = _env_int("MASK_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+
+# 体积计算时重采样结果的内存上限 (字节)，超出时沿z轴分块重采样与统计
+VOLUME_MEMORY_LIMIT = _env_int("VOLUME_MEMORY_LIMIT", 512 * 1024 * 1024)
+
+# 重采样前先按掩膜非零区域的包围盒裁剪参考网格，只重采样包含标签的子区域
+CROP_RESAMPLING = _env_int("CROP_RESAMPLING", 1) != 0
+
+# 裁剪时包围盒在参考网格中向外扩展的体素数
+CROP_MARGIN = _env_int("CROP_MARGIN", 2)
+
+# 判断掩膜与参考网格对应关系时允许的偏差 (掩膜体素数)：参考网格的每个体素中心与对应的掩膜体素中心
+# 相差不超过该值时视为重合，直接在数组上统计而不重采样 (小于0.5时与最近邻重采样的结果一致)
+GEOMETRY_TOLERANCE = _env_float("GEOMETRY_TOLERANCE", 1e-3)
+
+# 统计标签时同时计算各标签在DICOM网格上的包围盒，保存在标签摘要中 (每个非零体素额外取一次坐标)
+LABEL_BOXES = _env_int("LABEL_BOXES", 0) != 0
+
+# 上传的DICOM压缩包与ROI文件的临时目录，计算结束后删除
+UPLOAD_SPOOL_DIR = _env_str("UPLOAD_SPOOL_DIR", os.path.join(CACHE_DIR, "uploads"))
+
+# 单次上传在临时目录中的占用上限 (字节，压缩包与解压后的文件合计)，超出时返回 413
+UPLOAD_MAX_BYTES = _env_int("UPLOAD_MAX_BYTES", 4 * 1024 * 1024 * 1024)
+
+# 所有同时进行的上传在临时目录中的占用合计上限 (字节)，超出时返回 503
+UPLOAD_SPOOL_MAX_BYTES = _env_int("UPLOAD_SPOOL_MAX_BYTES", 16 * 1024 * 1024 * 1024)
+
+# 体积计算任务队列数据库 (SQLite) 路径
+JOB_DB_PATH = _env_str("JOB_DB_PATH", os.path.join(CACHE_DIR, "jobs.sqlite"))
+
+# 任务中的目录在计算中被服务重启中断的次数上限，超出后标记为失败而不再重新计算
+JOB_MAX_ATTEMPTS = _env_int("JOB_MAX_ATTEMPTS", 3)
+
+# 任务队列每次最多领取的目录数 (至少为体积计算并发上限的两倍)，已领取的目录减少一半时再次领取
+JOB_CLAIM_BATCH = _env_int("JOB_CLAIM_BATCH", 32)
+
+
+# 同时执行的体积计算任务按文件头估计的内存合计上限 (字节)，超出时排队等待，0 表示不限制
+VOLUME_MEMORY_BUDGET = _env_int("VOLUME_MEMORY_BUDGET", _default_memory_budget())
+
+# 因内存预算等待的任务最多被后面的小任务越过的次数
+ADMISSION_MAX_BYPASS = _env_int("ADMISSION_MAX_BYPASS", 8)
+
+# 监视目录：该目录下新到达或修改过的DICOM序列传输完成后自动计算体积，为空时不监视
+WATCH_ROOT = _env_str("WATCH_ROOT", "")
+
+# 监视目录时使用的ROI文件名 (位于DICOM目录的上一级)
+WATCH_ROI_FILE = _env_str("WATCH_ROI_FILE", "")
+
+# 监视目录时是否同时统计各标签的CT值
+WATCH_INTENSITY = _env_int("WATCH_INTENSITY", 0) != 0
+
+# 首次监视时是否计算已存在的序列 (否则只记录其当前状态，之后修改时再计算)
+WATCH_INCLUDE_EXISTING = _env_int("WATCH_INCLUDE_EXISTING", 0) != 0
+
+# 监视方式：auto (优先 inotify，不可用时轮询)、inotify 或 poll
+WATCH_BACKEND = _env_str("WATCH_BACKEND", "auto")
+
+# 目录在该时间 (秒) 内没有变化后才视为传输完成
+WATCH_SETTLE_SECONDS = _env_float("WATCH_SETTLE_SECONDS", 30.0)
+
+# 轮询时目录的最短与最长检查间隔 (秒)，未变化的目录检查间隔逐步加倍
+WATCH_POLL_SECONDS = _env_float("WATCH_POLL_SECONDS", 10.0)
+WATCH_POLL_MAX_SECONDS = _env_float("WATCH_POLL_MAX_SECONDS", 300.0)
@@ -0,0 +1,186 @@
+# coding: utf8
+"""
+体积结果的导出：每个标签一行，以CSV或XLSX流式输出
+逐行生成并按块返回字节，内存占用与行数无关
+"""
+import io
+import csv
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# 导出的列及其类型 (str、int、float、bool)
+COLUMN_TYPES = [
+    ("folder_path", "str"), ("roi_file", "str"), ("status", "str"), ("message", "str"),
+    ("label", "int"), ("voxel_count", "int"),
+    ("volume_mm3", "float"), ("volume_cm3", "float"), ("volume_ml", "float"),
+    ("mean_hu", "float"), ("min_hu", "float"), ("max_hu", "float"), ("std_hu", "float"),
+    ("size_x", "int"), ("size_y", "int"), ("size_z", "int"),
+    ("spacing_x", "float"), ("spacing_y", "float"), ("spacing_z", "float"), ("voxel_volume_mm3", "float"),
+    ("resample_mode", "str"), ("cached", "bool"), ("task_ms", "float"), ("queue_wait_ms", "float"),
+]
+COLUMNS = [name for name, _ in COLUMN_TYPES]
+
+# 每生成多少行返回一次数据
+CHUNK_ROWS = 500
+
+
+def record_rows(record):
+    """
+    将一个目录的计算结果展开为行：每个标签一行，失败或没有标签时输出一行
+    :param record: 任务结果，volumes 为 [[标签, 体积]] 列表；未统计CT值时CT值各列为空
+    """
+    geometry = record.get("geometry") or {}
+    size = geometry.get("size") or [None] * 3
+    spacing = geometry.get("spacing") or [None] * 3
+    stages = (record.get("stats") or {}).get("stages", {})
+    base = {
+        "folder_path": record.get("folder_path"),
+        "roi_file": record.get("roi_file"),
+        "status": record.get("status"),
+        "message": record.get("message"),
+        "size_x": size[0], "size_y": size[1], "size_z": size[2],
+        "spacing_x": spacing[0], "spacing_y": spacing[1], "spacing_z": spacing[2],
+        "voxel_volume_mm3": geometry.get("voxel_volume_mm3"),
+        "resample_mode": record.get("resample_mode"),
+        "cached": record.get("cached"),
+        "task_ms": round(stages["task"], 3) if "task" in stages else None,
+        "queue_wait_ms": round(stages["queue_wait"], 3) if "queue_wait" in stages else None,
+    }
+    volumes = record.get("volumes") or []
+    if not volumes:
+        yield dict(base, label=None, voxel_count=None, volume_mm3=None, volume_cm3=None, volume_ml=None,
+                   mean_hu=None, min_hu=None, max_hu=None, std_hu=None)
+    for label, bucket in volumes:
+        yield dict(base, label=label, voxel_count=bucket["voxel_count"], volume_mm3=bucket["volume_mm3"],
+                   volume_cm3=bucket["volume_cm3"], volume_ml=bucket["volume_ml"],
+                   mean_hu=bucket.get("mean_hu"), min_hu=bucket.get("min_hu"), max_hu=bucket.get("max_hu"),
+                   std_hu=bucket.get("std_hu"))
+
+
+def iter_csv(records):
+    """
+    :param records: 任务结果的迭代器
+    :return: CSV内容 (UTF-8 BOM，便于Excel识别编码) 的字节块迭代器
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    pending = 0
+    yield "\ufeff".encode("utf-8")
+    for record in records:
+        for row in record_rows(record):
+            writer.writerow(row)
+            pending += 1
+        if pending >= CHUNK_ROWS:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkWriter:
+    """
+    只支持 write 的输出对象，zipfile 写入不可 seek 的对象时使用数据描述符，可以边压缩边输出
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>')
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>')
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="volumes" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>')
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '</Relationships>')
+_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+_SHEET_TAIL = '</sheetData></worksheet>'
+
+# XML 1.0 不允许的控制字符
+_INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return '<c t="b"><v>{}</v></c>'.format(int(value))
+    if isinstance(value, (int, float)):
+        return "<c><v>{!r}</v></c>".format(value)
+    text = escape(_INVALID_XML_CHARS.sub("", str(value)))
+    return '<c t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'.format(text)
+
+
+def _xlsx_row(values):
+    return "<row>" + "".join(_xlsx_cell(value) for value in values) + "</row>"
+
+
+def iter_xlsx(records):
+    """
+    生成只有一个工作表的XLSX文件，字符串以内联方式写入单元格，不需要共享字符串表
+    :param records: 任务结果的迭代器
+    :return: XLSX内容的字节块迭代器
+    """
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _ROOT_RELS)
+        archive.writestr("xl/workbook.xml", _WORKBOOK)
+        archive.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        yield out.drain()
+        # 工作表大小未知，使用 zip64 以支持超过 4 GB 的内容
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((_SHEET_HEAD + _xlsx_row(COLUMNS)).encode("utf-8"))
+            pending = 0
+            for record in records:
+                rows = [_xlsx_row([row[name] for name in COLUMNS]) for row in record_rows(record)]
+                sheet.write("".join(rows).encode("utf-8"))
+                pending += len(rows)
+                if pending >= CHUNK_ROWS:
+                    yield out.drain()
+                    pending = 0
+            sheet.write(_SHEET_TAIL.encode("utf-8"))
+    yield out.drain()
+
+
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv; charset=utf-8"),
+    "xlsx": (iter_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
@@ -1,6 +1,14 @@
 # coding: utf8
 import os
+import time
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils import config
+from utils.metrics import bytes_read_total, observe_stage, stage_seconds
+
+# DICOM文件在128字节的前导区之后是 "DICM" 标识
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
 
 
 # 指定第几级目录下的全路径列表
@@ -33,30 +41,79 @@ def get_folders_by_level(root, level=-1):
     return paths, "success", True
 
 
-# 获取末级目录的全路径
-def get_secondary_folders(root):
+def is_dicom_file(path):
     """
-    获取最后一级的文件夹路径地址
-    :param root:
-    :return:
+    通过第128字节处的 "DICM" 标识判断是否为DICOM文件，只读取文件开头的132字节
     """
-    # check the root path exists or not
-    if not os.path.exists(root):
-        return [], "root={} not exists".format(root), False
+    try:
+        with open(path, "rb") as f:
+            header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    bytes_read_total.inc(len(header), source="dicom_probe")
+    return header[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
 
-    # TODO maybe there should have a white list
 
-    folders = []
-    for full_path, dir_name, filenames in os.walk(root):
-        # print("full_path={}, dir_name={}, filenames={}".format(full_path, dir_name, filenames))
-        if dir_name:
-            continue
-        if full_path in folders:
-            continue
-        folders.append(full_path)
-
-    # return the target folders within `root`
-    return folders, "success", True
+def _scan_directory(path, probe_files):
+    """
+    列出目录下的子目录，并检查最多 probe_files 个文件判断该目录是否包含DICOM文件
+    :return: (目录, 子目录列表, 是否为DICOM目录)
+    """
+    subdirs, is_series, probed = [], False, 0
+    with observe_stage("scan_directory"):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif not is_series and probed < probe_files and entry.is_file():
+                            probed += 1
+                            is_series = is_dicom_file(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            # 无权限或目录已被删除
+            pass
+    return path, subdirs, is_series
+
+
+def iter_dicom_folders(root, workers=None, probe_files=None):
+    """
+    多线程并行遍历 root，逐个返回包含DICOM文件的目录 (返回顺序不固定)
+    :param root: 根目录
+    :param workers: 并行遍历的线程数
+    :param probe_files: 每个目录最多检查的文件数
+    """
+    workers = workers or config.DISCOVERY_WORKERS
+    probe_files = probe_files or config.DICOM_PROBE_FILES
+    root = os.path.abspath(root)
+    seen = {root}
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="volumer-scan")
+    # discovery 阶段只计遍历本身的耗时，不包括生成器暂停、调用方处理结果的时间
+    elapsed = 0.0
+    try:
+        pending = {pool.submit(_scan_directory, root, probe_files)}
+        while pending:
+            start = time.perf_counter()
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            found = []
+            for future in done:
+                path, subdirs, is_series = future.result()
+                for subdir in subdirs:
+                    if subdir in seen:
+                        continue
+                    seen.add(subdir)
+                    pending.add(pool.submit(_scan_directory, subdir, probe_files))
+                if is_series:
+                    found.append(path)
+            elapsed += time.perf_counter() - start
+            for path in found:
+                yield path
+    finally:
+        # 调用方提前结束遍历时取消尚未执行的任务
+        pool.shutdown(wait=False, cancel_futures=True)
+        stage_seconds.observe(elapsed, stage="discovery")
 
 
 # 删除以 prefix 为开头的文件
@@ -0,0 +1,360 @@
+# coding: utf8
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextlib
+from utils import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    label_values TEXT,
+    use_cache INTEGER NOT NULL,
+    intensity INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    folder_path TEXT NOT NULL,
+    roi_file TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    result TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_items_status ON job_items (status, job_id, idx);
+CREATE TABLE IF NOT EXISTS watch_folders (
+    folder TEXT PRIMARY KEY,
+    signature TEXT NOT NULL,
+    job_id TEXT,
+    idx INTEGER,
+    updated_at REAL NOT NULL
+);
+"""
+
+# 任务状态: active 有未完成的目录, done 全部完成, cancelled 已取消
+JOB_ACTIVE, JOB_DONE, JOB_CANCELLED = "active", "done", "cancelled"
+# 目录状态: queued 已被领取、等待体积计算的名额 (尚未开始计算)
+ITEM_PENDING, ITEM_QUEUED, ITEM_RUNNING, ITEM_SUCCESS, ITEM_ERROR, ITEM_CANCELLED = \
+    "pending", "queued", "running", "success", "error", "cancelled"
+ITEM_STATUSES = (ITEM_PENDING, ITEM_QUEUED, ITEM_RUNNING, ITEM_SUCCESS, ITEM_ERROR, ITEM_CANCELLED)
+ITEM_UNFINISHED = (ITEM_PENDING, ITEM_QUEUED, ITEM_RUNNING)
+ITEM_FINISHED = (ITEM_SUCCESS, ITEM_ERROR, ITEM_CANCELLED)
+
+
+class JobQueue:
+    """
+    本地SQLite中的体积计算任务队列
+    每个任务包含多个目录，工作者按提交顺序领取待计算的目录 (claim)，真正开始计算时再标记为计算中 (start)
+    并写回结果；服务重启后把中断时已领取或正在计算的目录重新置为待计算，已完成的目录不再重复计算
+    """
+    def __init__(self, db_path, max_attempts=None):
+        self.db_path = db_path
+        self.max_attempts = max_attempts or config.JOB_MAX_ATTEMPTS
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            # 之前版本创建的数据库没有 intensity 列
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "intensity" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN intensity INTEGER NOT NULL DEFAULT 0")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下提交时不再每次同步到磁盘，进程崩溃不会丢失已提交的结果 (断电时最多重新计算最后几个目录)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def submit(self, items, label_values=None, use_cache=True, intensity=False):
+        """
+        提交一个任务
+        :param items: [{"folder_path", "roi_file"}]
+        :param intensity: 是否同时统计各标签的CT值
+        :return: 任务ID
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT INTO jobs (id, status, label_values, use_cache, intensity, total, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, JOB_ACTIVE, json.dumps(label_values), int(bool(use_cache)), int(bool(intensity)),
+                          len(items), now, now))
+            conn.executemany("INSERT INTO job_items (job_id, idx, folder_path, roi_file, status) VALUES (?, ?, ?, ?, ?)",
+                             [(job_id, index, item.get("folder_path") or "", item.get("roi_file") or "", ITEM_PENDING)
+                              for index, item in enumerate(items)])
+        return job_id
+
+    def append(self, job_id, items, label_values=None, use_cache=True, intensity=False):
+        """
+        向指定ID的任务追加目录 (任务不存在时创建)，任务已结束时重新置为 active
+        用于监视目录：所有自动计算的序列都在同一个任务中，可以统一查询与导出
+        :param items: [{"folder_path", "roi_file", "signature"}]，带 signature 时同时记录目录的签名
+        :return: 追加的目录序号列表
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT total FROM jobs WHERE id = ?", (job_id, )).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO jobs (id, status, label_values, use_cache, intensity, total, created_at, "
+                             "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (job_id, JOB_ACTIVE, json.dumps(label_values), int(bool(use_cache)), int(bool(intensity)),
+                              0, now, now))
+                start = 0
+            else:
+                start = row["total"]
+            indices = list(range(start, start + len(items)))
+            conn.execute("UPDATE jobs SET status = ?, total = total + ?, updated_at = ? WHERE id = ?",
+                         (JOB_ACTIVE, len(items), now, job_id))
+            conn.executemany("INSERT INTO job_items (job_id, idx, folder_path, roi_file, status) VALUES (?, ?, ?, ?, ?)",
+                             [(job_id, index, item.get("folder_path") or "", item.get("roi_file") or "", ITEM_PENDING)
+                              for index, item in zip(indices, items)])
+            conn.executemany("INSERT OR REPLACE INTO watch_folders (folder, signature, job_id, idx, updated_at) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(item["folder_path"], item["signature"], job_id, index, now)
+                              for index, item in zip(indices, items) if item.get("signature")])
+        return indices
+
+    def watch_signatures(self, root):
+        """
+        :return: {目录: 签名} root 下已记录的目录签名
+        """
+        prefix = root.rstrip(os.sep) + os.sep
+        with self._connect() as conn:
+            return {row["folder"]: row["signature"] for row in conn.execute(
+                "SELECT folder, signature FROM watch_folders WHERE folder = ? OR substr(folder, 1, ?) = ?",
+                (root, len(prefix), prefix))}
+
+    def save_watch_signatures(self, entries):
+        """
+        只记录目录的签名而不计算 (监视开始时已存在的序列)
+        :param entries: [(目录, 签名)]
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO watch_folders (folder, signature, job_id, idx, updated_at) "
+                             "VALUES (?, ?, NULL, NULL, ?)", [(folder, signature, now) for folder, signature in entries])
+
+    def claim(self, limit):
+        """
+        按任务提交顺序领取最多 limit 个待计算的目录，并标记为已领取 (不计入计算次数，开始计算时调用 start)
+        :return: [{"job_id", "index", "folder_path", "roi_file", "label_values", "use_cache", "intensity"}]
+        """
+        rows = []
+        with self._lock, self._connect() as conn:
+            # 逐个任务按序号读取，使用 (status, job_id, idx) 索引，不需要对所有待计算的目录排序
+            jobs = conn.execute("SELECT id, label_values, use_cache, intensity FROM jobs WHERE status = ? "
+                                "ORDER BY created_at", (JOB_ACTIVE, )).fetchall()
+            for job in jobs:
+                if len(rows) >= limit:
+                    break
+                for row in conn.execute("SELECT idx, folder_path, roi_file FROM job_items "
+                                        "WHERE status = ? AND job_id = ? ORDER BY idx LIMIT ?",
+                                        (ITEM_PENDING, job["id"], limit - len(rows))):
+                    rows.append((job, row))
+            conn.executemany("UPDATE job_items SET status = ? WHERE job_id = ? AND idx = ? AND status = ?",
+                             [(ITEM_QUEUED, job["id"], row["idx"], ITEM_PENDING) for job, row in rows])
+        return [{
+            "job_id": job["id"],
+            "index": row["idx"],
+            "folder_path": row["folder_path"],
+            "roi_file": row["roi_file"],
+            "label_values": json.loads(job["label_values"]),
+            "use_cache": bool(job["use_cache"]),
+            "intensity": bool(job["intensity"]),
+        } for job, row in rows]
+
+    def start(self, job_id, index):
+        """
+        已领取的目录即将开始计算：标记为计算中并增加计算次数
+        :return: 是否可以开始 (任务已取消或目录已不是已领取状态时返回 False，不应计算)
+        """
+        with self._lock, self._connect() as conn:
+            return conn.execute("UPDATE job_items SET status = ?, started_at = ?, attempts = attempts + 1 "
+                                "WHERE job_id = ? AND idx = ? AND status = ? "
+                                "AND EXISTS (SELECT 1 FROM jobs WHERE id = ? AND status = ?)",
+                                (ITEM_RUNNING, time.time(), job_id, index, ITEM_QUEUED, job_id, JOB_ACTIVE)
+                                ).rowcount == 1
+
+    def complete_many(self, results):
+        """
+        在一个事务中写回多个目录的计算结果
+        :param results: [(任务ID, 目录序号, 任务结果)]
+        :return: {任务ID: (任务状态, 任务中是否还有未完成的目录)}
+        """
+        now = time.time()
+        rows = []
+        for job_id, index, record in results:
+            status = ITEM_SUCCESS if record.get("status") == "success" else ITEM_ERROR
+            result = {key: value for key, value in record.items()
+                      if key not in ("folder_path", "roi_file", "status", "message")}
+            rows.append((status, record.get("message"), json.dumps(result, ensure_ascii=False), now,
+                         job_id, index, ITEM_RUNNING))
+        states = {}
+        with self._lock, self._connect() as conn:
+            conn.executemany("UPDATE job_items SET status = ?, message = ?, result = ?, finished_at = ? "
+                             "WHERE job_id = ? AND idx = ? AND status = ?", rows)
+            for job_id in {job_id for job_id, _, _ in results}:
+                unfinished = self._refresh_job(conn, job_id, now)
+                row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id, )).fetchone()
+                states[job_id] = (row["status"] if row else None), unfinished
+        return states
+
+    @staticmethod
+    def _refresh_job(conn, job_id, now):
+        # 是否还有未完成的目录
+        unfinished = conn.execute("SELECT EXISTS (SELECT 1 FROM job_items WHERE job_id = ? AND status IN (?, ?, ?))",
+                                  (job_id, ) + ITEM_UNFINISHED).fetchone()[0] != 0
+        status = JOB_ACTIVE if unfinished else JOB_DONE
+        conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                     (status, now, job_id, JOB_ACTIVE))
+        return unfinished
+
+    def recover(self):
+        """
+        服务启动时调用：将上次中断时已领取或正在计算的目录重新置为待计算，
+        正在计算时已被中断 max_attempts 次的目录标记为失败，避免反复导致进程崩溃
+        (只领取而未开始计算的目录不计入中断次数)
+        :return: 重新排队的目录数
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE job_items SET status = ?, message = ?, finished_at = ? "
+                         "WHERE status = ? AND attempts >= ?",
+                         (ITEM_ERROR, "体积计算多次被中断", now, ITEM_RUNNING, self.max_attempts))
+            requeued = conn.execute("UPDATE job_items SET status = ? WHERE status IN (?, ?)",
+                                    (ITEM_PENDING, ITEM_QUEUED, ITEM_RUNNING)).rowcount
+            for row in conn.execute("SELECT id FROM jobs WHERE status = ?", (JOB_ACTIVE, )).fetchall():
+                self._refresh_job(conn, row["id"], now)
+        return requeued
+
+    def cancel(self, job_id):
+        """
+        取消任务中尚未开始计算的目录 (包括已领取的目录，正在计算的目录完成后仍会写回结果)
+        :return: 是否存在该任务
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id, )).fetchone() is None:
+                return False
+            conn.execute("UPDATE job_items SET status = ?, finished_at = ? WHERE job_id = ? AND status IN (?, ?)",
+                         (ITEM_CANCELLED, now, job_id, ITEM_PENDING, ITEM_QUEUED))
+            conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                         (JOB_CANCELLED, now, job_id, JOB_ACTIVE))
+        return True
+
+    @staticmethod
+    def _job_from_row(row, counts):
+        finished = sum(counts.get(status, 0) for status in ITEM_FINISHED)
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "label_values": json.loads(row["label_values"]),
+            "use_cache": bool(row["use_cache"]),
+            "intensity": bool(row["intensity"]),
+            "total": row["total"],
+            "counts": {status: counts.get(status, 0) for status in ITEM_STATUSES},
+            "progress": finished / row["total"] if row["total"] else 1.0,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def get_job(self, job_id):
+        """
+        :return: 任务信息与各状态的目录数，不存在时返回 None
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id, )).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status",
+                                       (job_id, )).fetchall())
+        return self._job_from_row(row, counts)
+
+    def list_jobs(self, limit=50):
+        # 最近提交的任务在前
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit, )).fetchall()
+            counts = {}
+            for job_id, status, count in conn.execute(
+                    "SELECT job_id, status, COUNT(*) FROM job_items WHERE job_id IN (SELECT id FROM jobs "
+                    "ORDER BY created_at DESC LIMIT ?) GROUP BY job_id, status", (limit, )):
+                counts.setdefault(job_id, {})[status] = count
+        return [self._job_from_row(row, counts.get(row["id"], {})) for row in rows]
+
+    @staticmethod
+    def _item_from_row(row):
+        item = {
+            "index": row["idx"],
+            "folder_path": row["folder_path"],
+            "roi_file": row["roi_file"],
+            "status": row["status"],
+            "message": row["message"],
+            "attempts": row["attempts"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+        }
+        if row["result"]:
+            item.update(json.loads(row["result"]))
+        return item
+
+    def iter_items(self, job_id, statuses=None, offset=0, limit=None, folder_prefix=None, page_size=500):
+        """
+        按序号返回任务中的目录及其结果
+        按序号分页读取，每页使用单独的连接，可以在不同线程中逐步迭代且不会长时间占用数据库
+        :param statuses: 只返回这些状态的目录 (None表示全部)
+        :param folder_prefix: 只返回以该前缀开头的目录
+        """
+        sql = "SELECT * FROM job_items WHERE job_id = ? AND idx > ?"
+        args = [job_id]
+        if statuses:
+            sql += " AND status IN ({})".format(",".join("?" * len(statuses)))
+            args.extend(statuses)
+        if folder_prefix:
+            sql += " AND substr(folder_path, 1, ?) = ?"
+            args.extend([len(folder_prefix), folder_prefix])
+        sql += " ORDER BY idx LIMIT ? OFFSET ?"
+        last_index = -1
+        remaining = limit
+        while remaining is None or remaining > 0:
+            count = page_size if remaining is None else min(page_size, remaining)
+            with self._connect() as conn:
+                rows = conn.execute(sql, [args[0], last_index] + args[1:] + [count, offset]).fetchall()
+            for row in rows:
+                yield self._item_from_row(row)
+            if len(rows) < count:
+                break
+            # 之后的页从上一页最后一个序号之后开始
+            offset = 0
+            last_index = rows[-1]["idx"]
+            if remaining is not None:
+                remaining -= len(rows)
+
+
+_job_queue = None
+
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue(config.JOB_DB_PATH)
+    return _job_queue
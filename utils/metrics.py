@@ -0,0 +1,194 @@
+# coding: utf8
+"""
+进程内的性能指标 (计数器、仪表与直方图)，以 Prometheus 文本格式导出
+工作进程中的体积计算只把各阶段耗时记录在结果里，由服务进程调用 record_task_stats 计入指标
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# 耗时直方图的默认分桶 (秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            for name, pairs, value in self._samples():
+                lines.append("{}{} {}".format(name, _format_labels(pairs), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [各分桶的计数 (不累计), 总和, 次数]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", pairs + [("le", _format_value(bound))], cumulative
+            yield self.name + "_sum", pairs, total
+            yield self.name + "_count", pairs, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.histogram("volumer_stage_seconds", "各处理阶段的耗时 (秒)", ("stage",))
+request_seconds = REGISTRY.histogram("volumer_request_seconds", "HTTP接口的处理耗时 (秒)", ("endpoint", "status"))
+bytes_read_total = REGISTRY.counter("volumer_bytes_read_total", "读取的输入文件字节数", ("source",))
+voxels_total = REGISTRY.counter("volumer_voxels_total", "重采样与统计的体素数", ("kind",))
+cache_requests_total = REGISTRY.counter("volumer_cache_requests_total", "缓存查询次数", ("cache", "result"))
+cache_hit_ratio = REGISTRY.gauge("volumer_cache_hit_ratio", "服务启动以来的缓存命中率", ("cache",))
+mask_cache_usage = REGISTRY.gauge("volumer_mask_cache", "各工作进程掩膜缓存的合计 (条目数、字节数、淘汰次数)", ("field",))
+volume_jobs = REGISTRY.gauge("volumer_volume_jobs", "执行中与等待中的体积计算任务数", ("state",))
+memory_budget = REGISTRY.gauge("volumer_memory_budget_bytes", "体积计算的内存预算、执行中任务的估计内存合计与工作进程的掩膜缓存",
+                               ("state",))
+coalesced_requests_total = REGISTRY.counter("volumer_coalesced_requests_total",
+                                            "与进行中的相同计算合并、未单独计算的请求数", ("endpoint",))
+
+
+@contextmanager
+def timed(stages, name):
+    """
+    将代码块的耗时 (毫秒) 累加到 stages[name]，用于按请求返回各阶段耗时
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - start) * 1000.0
+
+
+@contextmanager
+def observe_stage(name):
+    # 将代码块的耗时直接计入本进程的 volumer_stage_seconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=name)
+
+
+def record_cache_lookup(cache, hit):
+    cache_requests_total.inc(cache=cache, result="hit" if hit else "miss")
+    hits = cache_requests_total.value(cache=cache, result="hit")
+    misses = cache_requests_total.value(cache=cache, result="miss")
+    cache_hit_ratio.set(hits / float(hits + misses), cache=cache)
+
+
+def record_task_stats(stats):
+    """
+    将一次体积计算返回的统计计入本进程的指标
+    :param stats: {"stages": {阶段: 毫秒}, "bytes_read": {来源: 字节}, "voxels": {类型: 体素数}, "mask_cache_hit": bool}
+    """
+    for stage, elapsed_ms in stats.get("stages", {}).items():
+        stage_seconds.observe(elapsed_ms / 1000.0, stage=stage)
+    for source, size in stats.get("bytes_read", {}).items():
+        bytes_read_total.inc(size, source=source)
+    for kind, count in stats.get("voxels", {}).items():
+        voxels_total.inc(count, kind=kind)
+    if stats.get("mask_cache_hit") is not None:
+        record_cache_lookup("mask", stats["mask_cache_hit"])
@@ -0,0 +1,168 @@
+# coding: utf8
+"""
+未压缩NIfTI (.nii) 文件的内存映射读取：自行解析NIfTI-1/2文件头，由 sform/qform 计算空间信息，
+用 np.memmap 直接映射体素数据
+"""
+import os
+import struct
+import numpy as np
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+# sform_code 为 SCANNER_ANAT 时ITK优先使用 sform
+NIFTI_XFORM_SCANNER_ANAT = 1
+
+# NIfTI datatype 代码 -> numpy 类型
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+
+def read_nifti_header(file_path):
+    """
+    解析单文件NIfTI-1/2 (.nii) 文件头中与体素数据布局相关的字段
+    :return: {"version", "byteorder", "shape": (x, y, z, ...), "dtype", "vox_offset", "scl_slope", "scl_inter",
+              "pixdim", "qform_code", "sform_code", "quatern": (b, c, d), "qoffset": (x, y, z), "srow": 3x4}，
+             不是单文件NIfTI时返回 None
+    """
+    with open(file_path, "rb") as f:
+        header = f.read(NIFTI2_HEADER_SIZE)
+    if len(header) < NIFTI1_HEADER_SIZE:
+        return None
+
+    for byteorder in ("<", ">"):
+        sizeof_hdr = struct.unpack(byteorder + "i", header[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            if header[344:348] != b"n+1\x00":
+                return None
+            dim = struct.unpack(byteorder + "8h", header[40:56])
+            datatype = struct.unpack(byteorder + "h", header[70:72])[0]
+            vox_offset = int(struct.unpack(byteorder + "f", header[108:112])[0])
+            scl_slope, scl_inter = struct.unpack(byteorder + "2f", header[112:120])
+            pixdim = struct.unpack(byteorder + "8f", header[76:108])
+            qform_code, sform_code = struct.unpack(byteorder + "2h", header[252:256])
+            quatern = struct.unpack(byteorder + "6f", header[256:280])
+            srow = struct.unpack(byteorder + "12f", header[280:328])
+            version = 1
+            break
+        if sizeof_hdr == NIFTI2_HEADER_SIZE and len(header) == NIFTI2_HEADER_SIZE:
+            if header[4:8] != b"n+2\x00":
+                return None
+            datatype = struct.unpack(byteorder + "h", header[12:14])[0]
+            dim = struct.unpack(byteorder + "8q", header[16:80])
+            vox_offset = struct.unpack(byteorder + "q", header[168:176])[0]
+            scl_slope, scl_inter = struct.unpack(byteorder + "2d", header[176:192])
+            pixdim = struct.unpack(byteorder + "8d", header[104:168])
+            qform_code, sform_code = struct.unpack(byteorder + "2i", header[344:352])
+            quatern = struct.unpack(byteorder + "6d", header[352:400])
+            srow = struct.unpack(byteorder + "12d", header[400:496])
+            version = 2
+            break
+    else:
+        return None
+
+    if datatype not in NIFTI_DTYPES or not 1 <= dim[0] <= 7:
+        return None
+    return {
+        "version": version,
+        "byteorder": byteorder,
+        "shape": tuple(int(v) for v in dim[1:dim[0] + 1]),
+        "dtype": np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(byteorder),
+        "vox_offset": vox_offset,
+        "scl_slope": float(scl_slope),
+        "scl_inter": float(scl_inter),
+        "pixdim": tuple(float(v) for v in pixdim),
+        "qform_code": int(qform_code),
+        "sform_code": int(sform_code),
+        "quatern": tuple(float(v) for v in quatern[:3]),
+        "qoffset": tuple(float(v) for v in quatern[3:]),
+        "srow": np.asarray(srow, dtype=np.float64).reshape(3, 4),
+    }
+
+
+def _quatern_to_rotation(b, c, d, qfac):
+    # 与 nifti1_io 的 nifti_quatern_to_mat44 相同
+    a = 1.0 - (b * b + c * c + d * d)
+    if a < 1.0e-7:
+        scale = 1.0 / np.sqrt(b * b + c * c + d * d)
+        b, c, d, a = b * scale, c * scale, d * scale, 0.0
+    else:
+        a = np.sqrt(a)
+    rotation = np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+    ])
+    rotation[:, 2] *= qfac
+    return rotation
+
+
+def nifti_geometry(header):
+    """
+    由NIfTI文件头计算与ITK一致的 (间距, 原点, 方向)，坐标由 RAS 转换为 ITK 使用的 LPS
+    与 ITK 的选择规则相同：sform_code > 0 且 qform_code 为0或 sform_code 为1 (SCANNER_ANAT) 时使用 sform，
+    否则使用 qform (如 sform_code 为 2 ALIGNED_ANAT、4 MNI_152 而 qform_code > 0 时)；
+    两者均未设置或使用的 sform 含切变时返回 None
+    """
+    spacing = np.abs(np.asarray(header["pixdim"][1:4], dtype=np.float64))
+    if np.any(spacing <= 0):
+        return None
+    if header["sform_code"] > 0 and (header["qform_code"] <= 0 or header["sform_code"] == NIFTI_XFORM_SCANNER_ANAT):
+        srow = header["srow"]
+        norms = np.linalg.norm(srow[:, :3], axis=0)
+        if np.any(norms <= 0):
+            return None
+        rotation = srow[:, :3] / norms
+        if np.abs(rotation.T.dot(rotation) - np.eye(3)).max() > 1.0e-4:
+            return None
+        offset = srow[:, 3]
+    elif header["qform_code"] > 0:
+        qfac = -1.0 if header["pixdim"][0] < 0 else 1.0
+        rotation = _quatern_to_rotation(*header["quatern"], qfac)
+        offset = np.asarray(header["qoffset"], dtype=np.float64)
+    else:
+        return None
+    ras_to_lps = np.diag([-1.0, -1.0, 1.0])
+    direction = ras_to_lps.dot(rotation)
+    origin = ras_to_lps.dot(offset)
+    return tuple(spacing.tolist()), tuple(origin.tolist()), tuple(direction.ravel().tolist())
+
+
+def memmap_nifti(file_path):
+    """
+    只读映射3D单文件NIfTI的体素数据，不读取到内存
+    需要缩放 (scl_slope/scl_inter)、不是3D图像或无法确定空间信息时返回 None，调用方应回退到 sitk.ReadImage
+    :return: (维度顺序为 (z, y, x) 的只读 np.memmap, (尺寸, 间距, 原点, 方向))
+    """
+    if not file_path.lower().endswith(".nii"):
+        return None
+    header = read_nifti_header(file_path)
+    if header is None:
+        return None
+    # 有缩放时ITK会转换为浮点类型，体素值与文件中存储的不同
+    if header["scl_slope"] not in (0.0, 1.0) or header["scl_inter"] != 0.0:
+        return None
+    shape = header["shape"]
+    if len(shape) < 3 or any(v != 1 for v in shape[3:]) or min(shape[:3]) < 1:
+        return None
+    shape = shape[:3]
+    geometry = nifti_geometry(header)
+    if geometry is None:
+        return None
+
+    dtype = header["dtype"]
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(file_path) < header["vox_offset"] + nbytes:
+        return None
+    # NIfTI中x变化最快，按C顺序映射为 (z, y, x)
+    array = np.memmap(file_path, dtype=dtype, mode="r", offset=header["vox_offset"], shape=shape[::-1])
+    return array, (shape, ) + geometry
@@ -0,0 +1,168 @@
+# coding: utf8
+import os
+from utils.cache import get_mask_cache, get_result_cache, summary_key
+from utils.metrics import timed
+from utils.seriesindex import get_series_index
+from utils.volumer import estimate_dicom_size, estimate_volume_memory, get_volumer, volumes_from_summary
+
+
+def format_volume_result(data_dict):
+    """
+    将体积字典格式化为前端展示的文本
+    """
+    if not data_dict or len(data_dict) == 0:
+        return "未计算出体积信息"
+    if len(data_dict) == 1:
+        return f"{data_dict[list(data_dict.keys())[0]]['volume_mm3']:.3f}"
+    volume_result = ""
+    for label, bucket in data_dict.items():
+        volume_result += f"label: {label}, bucket: {bucket['volume_mm3']:.3f}mm³\n"
+    return volume_result
+
+
+def resolve_roi_path(folder_path, roi_file):
+    # roi文件放置在DICOM目录的上一级
+    return os.path.join(os.path.dirname(folder_path), roi_file)
+
+
+def estimate_task_memory(folder_path, roi_file, intensity=False):
+    """
+    在加载数据前，根据DICOM与掩膜的文件头估计单个目录体积计算的内存占用，用于准入控制
+    已索引的序列使用索引中的网格，否则读取一个DICOM文件头按 行数 × 列数 × 文件数 估计
+    :param roi_file: ROI文件名 (相对于DICOM目录的上一级)
+    :param intensity: 是否统计CT值，需要另加解码后的DICOM像素
+    :return: 字节数，路径无效或无法读取文件头时返回 0 (由计算本身报告错误)
+    """
+    if not folder_path or not roi_file:
+        return 0
+    try:
+        series = get_series_index().lookup(folder_path)
+        size = series["geometry"].GetSize() if series else estimate_dicom_size(folder_path)
+        if size is None:
+            return 0
+        memory = estimate_volume_memory(size, resolve_roi_path(folder_path, roi_file))
+        if intensity:
+            # CT像素按16位计
+            memory += int(size[0]) * int(size[1]) * int(size[2]) * 2
+        return memory
+    except (OSError, RuntimeError, ValueError):
+        return 0
+
+
+def calculate_folder_volume(folder_path, roi_file, label_values=None, use_cache=True, stats=None, intensity=False,
+                            trace_memory=False):
+    """
+    计算DICOM目录中掩膜各标签的体积
+    每个 (目录, ROI文件) 的标签摘要 (完整直方图、体素体积与网格等) 按两者的指纹缓存，
+    之后任意标签子集都由摘要计算，不再读取图像；摘要中没有CT值统计而请求需要时重新计算
+    :param folder_path: DICOM目录
+    :param roi_file: ROI文件的完整路径
+    :param label_values: 要计算体积的标签值列表 (None表示所有非零标签)
+    :param use_cache: 是否读取和写入结果缓存
+    :param stats: 可选的字典，写入各阶段耗时 (stages，毫秒)、读取字节数 (bytes_read) 与体素数 (voxels)
+    :param intensity: 是否同时统计各标签的CT值 (mean_hu、min_hu、max_hu、std_hu)
+    :param trace_memory: 是否用 tracemalloc 记录标签统计的内存峰值，写入 stats["label_count_peak_bytes"] (有额外开销)
+    :return: {"volumes": 体积字典, "cached": 是否来自缓存, "resample_mode": 掩膜映射到DICOM网格的方式,
+              "geometry": DICOM网格的尺寸、间距与体素体积}
+    """
+    stats = {} if stats is None else stats
+    stages = stats.setdefault("stages", {})
+    key = None
+    if use_cache:
+        cache = get_result_cache()
+        with timed(stages, "result_cache"):
+            key = summary_key(folder_path, roi_file)
+            summary = cache.get(key)
+        if summary is not None and intensity and summary.get("intensity") is None:
+            summary = None
+        stats["result_cache_hit"] = summary is not None
+        if summary is not None:
+            return {"volumes": volumes_from_summary(summary, label_values, intensity), "cached": True,
+                    "resample_mode": summary.get("resample_mode"), "geometry": summary.get("geometry")}
+
+    # 已索引且未修改的序列直接复用索引中的文件列表与空间信息
+    with timed(stages, "series_lookup"):
+        series = get_series_index().lookup(folder_path)
+    volumer = get_volumer(file_type='dicom', trace_memory=trace_memory)
+    try:
+        volumes = volumer.get_volume(dicom_dir=folder_path, roi=roi_file, label_values=label_values,
+                                     dicom_files=series["files"] if series else None,
+                                     geometry=series["geometry"] if series else None, intensity=intensity)
+    finally:
+        # 失败时也返回已完成阶段的统计
+        for name, value in volumer.stats.items():
+            if name == "stages":
+                stages.update(value)
+            elif name in ("bytes_read", "voxels", "mask_cache_hit", "label_count_peak_bytes"):
+                stats[name] = value
+    summary = volumer.summary
+    if key is not None:
+        get_result_cache().put(key, summary)
+    return {"volumes": volumes, "cached": False, "resample_mode": summary["resample_mode"],
+            "geometry": summary["geometry"]}
+
+
+def load_label_summary(folder_path, roi_file):
+    """
+    读取已缓存的标签摘要 (只检查目录与ROI文件的指纹，不读取图像)
+    :param roi_file: ROI文件名 (相对于DICOM目录的上一级)
+    :return: build_label_summary 的结果，尚未计算或文件已修改时返回 None
+    """
+    return get_result_cache().get(summary_key(folder_path, resolve_roi_path(folder_path, roi_file)))
+
+
+def compute_volume_record(folder_path, roi_file, label_values=None, use_cache=True, intensity=False,
+                          trace_memory=False):
+    """
+    计算单个目录的体积，异常作为失败结果返回而不是抛出
+    :param folder_path: DICOM目录
+    :param roi_file: ROI文件名 (相对于DICOM目录的上一级)
+    :return: 任务结果字典，成功时 volumes 为体积字典，stats 为各阶段统计
+    """
+    record = {"folder_path": folder_path, "roi_file": roi_file}
+    stats = {"stages": {}}
+    with timed(stats["stages"], "task"):
+        record.update(_run_volume_task(folder_path, roi_file, label_values, use_cache, stats, intensity,
+                                       trace_memory))
+    record["stats"] = stats
+    return record
+
+
+def run_volume_task(folder_path, roi_file, label_values=None, use_cache=True, intensity=False, keep_volumes=False,
+                    trace_memory=False):
+    """
+    单个目录的体积计算任务 (在工作进程中执行)，体积字典格式化为前端展示的文本
+    统计CT值或 keep_volumes 时 (任务队列需要把结果保存为JSON) 另外以 [[标签, 体积]] 列表返回各标签的体积
+    :param trace_memory: 见 calculate_folder_volume，请求各阶段统计 (include_stats) 时启用
+    :return: 任务结果字典
+    """
+    record = compute_volume_record(folder_path, roi_file, label_values, use_cache, intensity, trace_memory)
+    volumes = record.pop("volumes", None)
+    if record["status"] == "success":
+        record["volume_result"] = format_volume_result(volumes)
+        if intensity or keep_volumes:
+            record["volumes"] = [[label, bucket] for label, bucket in volumes.items()]
+    # 附带工作进程的掩膜缓存统计，由服务进程汇总
+    record["worker"] = {"pid": os.getpid(), "mask_cache": get_mask_cache().stats()}
+    return record
+
+
+def _run_volume_task(folder_path, roi_file, label_values, use_cache, stats, intensity=False, trace_memory=False):
+    if not folder_path or not os.path.isdir(folder_path):
+        return {"status": "error", "message": "无效的文件夹路径"}
+    if not roi_file:
+        return {"status": "error", "message": "ROI文件名不能为空"}
+    try:
+        result = calculate_folder_volume(folder_path, resolve_roi_path(folder_path, roi_file),
+                                         label_values=label_values, use_cache=use_cache, stats=stats,
+                                         intensity=intensity, trace_memory=trace_memory)
+    except Exception as e:
+        return {"status": "error", "message": f"体积计算失败: {str(e)}"}
+    return {
+        "status": "success",
+        "message": "体积计算成功",
+        "volumes": result["volumes"],
+        "cached": result["cached"],
+        "resample_mode": result["resample_mode"],
+        "geometry": result["geometry"],
+    }
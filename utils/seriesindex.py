@@ -0,0 +1,258 @@
+# coding: utf8
+import os
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import SimpleITK as sitk
+from utils import config
+from utils.filehelper import _scan_directory
+from utils.metrics import observe_stage
+from utils.volumer import ReferenceGeometry, read_series_geometry
+
+# DICOM标签: 序列实例UID
+SERIES_INSTANCE_UID_TAG = "0020|000e"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL,
+    is_series INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS series (
+    folder TEXT PRIMARY KEY,
+    series_uid TEXT,
+    slice_count INTEGER NOT NULL,
+    geometry TEXT NOT NULL,
+    files TEXT NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    indexed_at REAL NOT NULL
+);
+"""
+
+
+def _read_series_uid(file_path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_path)
+    reader.ReadImageInformation()
+    if reader.HasMetaDataKey(SERIES_INSTANCE_UID_TAG):
+        return reader.GetMetaData(SERIES_INSTANCE_UID_TAG).strip()
+    return None
+
+
+def index_series(folder, dir_mtime_ns):
+    """
+    读取目录中DICOM序列的文件列表、序列UID与空间信息 (只读取文件头)
+    :return: 序列信息字典，目录中没有可用的DICOM序列时返回 None
+    """
+    with observe_stage("series_files"):
+        dicom_files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder)
+    if not dicom_files:
+        return None
+    with observe_stage("reference_geometry"):
+        geometry = read_series_geometry(dicom_files)
+    files = []
+    for file_path in dicom_files:
+        st = os.stat(file_path)
+        files.append([os.path.basename(file_path), st.st_size, st.st_mtime_ns])
+    return {
+        "folder": folder,
+        "series_uid": _read_series_uid(dicom_files[0]),
+        "slice_count": len(dicom_files),
+        "geometry": geometry.to_dict(),
+        "files": files,
+        "dir_mtime_ns": dir_mtime_ns,
+        "indexed_at": time.time(),
+    }
+
+
+def _visit_directory(path, known_dir, known_series, probe_files):
+    """
+    访问一个目录：修改时间未变化时直接复用索引中的子目录列表与序列信息，否则重新扫描
+    :return: (目录, 修改时间, 子目录列表, 序列信息, 是否需要更新目录记录)
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None, [], None, False
+    if known_dir is not None and known_dir[0] == mtime_ns:
+        subdirs, is_series, changed = known_dir[1], known_dir[2], False
+    else:
+        _, subdirs, is_series = _scan_directory(path, probe_files)
+        changed = True
+
+    series = None
+    if is_series:
+        if known_series is not None and known_series["dir_mtime_ns"] == mtime_ns:
+            series = known_series
+        else:
+            try:
+                series = index_series(path, mtime_ns)
+            except Exception as e:
+                print("索引DICOM序列失败: {}, {}".format(path, e))
+    return path, mtime_ns, subdirs, series, changed
+
+
+class SeriesIndex:
+    """
+    本地SQLite中的DICOM序列索引
+    重新扫描时只重新列出修改时间发生变化的目录，只重新解析修改时间变化的序列
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _under(column):
+        # 匹配 root 本身及其下所有路径
+        return "({0} = ? OR substr({0}, 1, ?) = ?)".format(column)
+
+    @staticmethod
+    def _under_args(root):
+        prefix = root.rstrip(os.sep) + os.sep
+        return (root, len(prefix), prefix)
+
+    @staticmethod
+    def _series_from_row(row):
+        return {
+            "folder": row["folder"],
+            "series_uid": row["series_uid"],
+            "slice_count": row["slice_count"],
+            "geometry": json.loads(row["geometry"]),
+            "files": json.loads(row["files"]),
+            "dir_mtime_ns": row["dir_mtime_ns"],
+            "indexed_at": row["indexed_at"],
+        }
+
+    def iter_scan(self, root, workers=None, probe_files=None):
+        """
+        增量扫描 root，逐个返回其中的DICOM序列信息 (返回顺序不固定)
+        扫描结束后删除索引中已不存在的目录
+        """
+        workers = workers or config.DISCOVERY_WORKERS
+        probe_files = probe_files or config.DICOM_PROBE_FILES
+        root = os.path.abspath(root)
+        with self._connect() as conn:
+            known_dirs = {
+                row["path"]: (row["mtime_ns"], json.loads(row["subdirs"]), bool(row["is_series"]))
+                for row in conn.execute("SELECT * FROM directories WHERE " + self._under("path"),
+                                        self._under_args(root))
+            }
+            known_series = {
+                row["folder"]: self._series_from_row(row)
+                for row in conn.execute("SELECT * FROM series WHERE " + self._under("folder"),
+                                        self._under_args(root))
+            }
+
+        visited, seen, found = set(), {root}, set()
+        dir_updates, series_updates = [], []
+        pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="volumer-index")
+        try:
+            pending = {pool.submit(_visit_directory, root, known_dirs.get(root), known_series.get(root), probe_files)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, mtime_ns, subdirs, series, changed = future.result()
+                    if mtime_ns is None:
+                        continue
+                    visited.add(path)
+                    if changed:
+                        dir_updates.append((path, mtime_ns, json.dumps(subdirs), int(series is not None)))
+                    for subdir in subdirs:
+                        if subdir not in seen:
+                            seen.add(subdir)
+                            pending.add(pool.submit(_visit_directory, subdir, known_dirs.get(subdir),
+                                                    known_series.get(subdir), probe_files))
+                    if series is not None:
+                        found.add(path)
+                        if series is not known_series.get(path):
+                            series_updates.append(series)
+                        yield series
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._save(dir_updates, series_updates)
+
+        # 完整扫描结束后清理已删除的目录和不再包含DICOM序列的目录
+        removed_dirs = [(path, ) for path in known_dirs if path not in visited]
+        removed_series = [(folder, ) for folder in known_series if folder not in found]
+        if removed_dirs or removed_series:
+            with self._lock, self._connect() as conn:
+                conn.executemany("DELETE FROM directories WHERE path = ?", removed_dirs)
+                conn.executemany("DELETE FROM series WHERE folder = ?", removed_series)
+
+    def scan(self, root, workers=None):
+        """
+        增量扫描 root，返回其中的DICOM序列信息列表 (按目录排序)
+        """
+        return sorted(self.iter_scan(root, workers), key=lambda series: series["folder"])
+
+    def _save(self, dir_updates, series_updates):
+        if not dir_updates and not series_updates:
+            return
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs, is_series) "
+                             "VALUES (?, ?, ?, ?)", dir_updates)
+            conn.executemany(
+                "INSERT OR REPLACE INTO series (folder, series_uid, slice_count, geometry, files, "
+                "dir_mtime_ns, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(s["folder"], s["series_uid"], s["slice_count"], json.dumps(s["geometry"]),
+                  json.dumps(s["files"]), s["dir_mtime_ns"], s["indexed_at"]) for s in series_updates])
+
+    def lookup(self, folder):
+        """
+        查询目录的索引信息，目录或其中任一DICOM文件在索引后被修改时返回 None
+        :return: {"series_uid", "slice_count", "files": 完整路径列表, "geometry": ReferenceGeometry}
+        """
+        folder = os.path.abspath(folder)
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM series WHERE folder = ?", (folder, )).fetchone()
+        if row is None:
+            return None
+        series = self._series_from_row(row)
+        try:
+            if os.stat(folder).st_mtime_ns != series["dir_mtime_ns"]:
+                return None
+            files = []
+            for name, size, mtime_ns in series["files"]:
+                file_path = os.path.join(folder, name)
+                st = os.stat(file_path)
+                if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                    return None
+                files.append(file_path)
+        except OSError:
+            return None
+        return {
+            "series_uid": series["series_uid"],
+            "slice_count": series["slice_count"],
+            "files": files,
+            "geometry": ReferenceGeometry.from_dict(series["geometry"]),
+        }
+
+
+_series_index = None
+
+
+def get_series_index():
+    global _series_index
+    if _series_index is None:
+        _series_index = SeriesIndex(config.SERIES_INDEX_PATH)
+    return _series_index
@@ -0,0 +1,462 @@
+# coding: utf8
+"""
+上传DICOM序列 (zip压缩包) 与ROI文件的流式接收
+
+请求体 (multipart/form-data) 边接收边写入临时目录，不在内存中保留整个文件：
+压缩包的本地文件头随数据到达逐个解析，每个文件解压完成后立即读取DICOM文件头并检查
+序列UID与层尺寸，不一致时在上传过程中就返回错误；上传结束时目录中即为完整的序列
+临时目录的总占用受 UPLOAD_SPOOL_MAX_BYTES 限制，上传结束或失败后删除
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import struct
+import zipfile
+import zlib
+import threading
+from multipart.multipart import MultipartParser, parse_options_header
+from utils import config
+from utils.filehelper import is_dicom_file
+from utils.seriesindex import SERIES_INSTANCE_UID_TAG
+from utils.volumer import _read_image_information
+
+# 压缩包与ROI文件在表单中的字段名
+ARCHIVE_FIELD = "archive"
+ROI_FIELD = "roi"
+# ROI文件保存在临时目录的子目录中，文件名 (如 dicom、archive.zip) 不会与DICOM目录或压缩包冲突
+ROI_SUBDIR = "roi"
+# 其他表单字段 (如 label_values) 的最大长度
+MAX_FIELD_BYTES = 64 * 1024
+
+# 各层方向余弦允许的偏差
+DIRECTION_TOLERANCE = 1e-4
+
+# 超过该时间 (秒) 的临时目录视为之前异常退出时遗留，启动时删除
+STALE_UPLOAD_SECONDS = 3600
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_LOCAL_SIGNATURE = b"PK\x03\x04"
+# 中央目录、zip64 结束记录与结束记录：本地文件已全部读完
+_END_SIGNATURES = (b"PK\x01\x02", b"PK\x06\x06", b"PK\x05\x05", b"PK\x05\x06")
+_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+
+class UploadError(Exception):
+    """
+    上传内容无效或超出限制，status_code 为返回给客户端的HTTP状态码
+    """
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SpoolQuota:
+    """
+    所有上传共用的临时目录空间，写入前预留，上传的临时目录删除后归还
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self._lock:
+            if self.max_bytes and self.used + amount > self.max_bytes:
+                raise UploadError("上传临时空间已满，请稍后重试", 503)
+            self.used += amount
+
+    def release(self, amount):
+        with self._lock:
+            self.used = max(0, self.used - amount)
+
+
+_quota = None
+
+
+def get_spool_quota():
+    global _quota
+    if _quota is None:
+        _quota = SpoolQuota(config.UPLOAD_SPOOL_MAX_BYTES)
+    return _quota
+
+
+def cleanup_spool(spool_dir=None, max_age=STALE_UPLOAD_SECONDS):
+    """
+    删除临时目录中遗留的上传 (服务异常退出时未删除的)
+    :return: 删除的目录数
+    """
+    spool_dir = spool_dir or config.UPLOAD_SPOOL_DIR
+    if not os.path.isdir(spool_dir):
+        return 0
+    removed = 0
+    now = time.time()
+    with os.scandir(spool_dir) as it:
+        for entry in it:
+            if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    return removed
+
+
+def _safe_name(name):
+    # 压缩包或表单中的文件名只保留最后一级，忽略目录、隐藏文件与 macOS 附加的资源文件
+    name = name.replace("\\", "/")
+    if name.endswith("/") or "__MACOSX/" in name:
+        return None
+    base = name.rsplit("/", 1)[-1]
+    if not base or base.startswith("."):
+        return None
+    return base
+
+
+class ZipStreamExtractor:
+    """
+    按数据到达的顺序解析zip本地文件头并解压 (存储或deflate)，每个文件完成时调用 on_file(路径)
+    deflate 数据以解压流结束判断长度，因此也支持写在数据之后的数据描述符；
+    遇到无法流式处理的条目 (加密、其他压缩方式、长度未知的存储条目) 时停止，
+    由 finish() 按中央目录解压剩余的文件
+    """
+    def __init__(self, archive_path, target_dir, on_file, reserve):
+        """
+        :param archive_path: 原始压缩包的保存路径
+        :param target_dir: 解压目录，所有文件放在同一级
+        :param on_file: 文件解压完成时的回调 on_file(路径)
+        :param reserve: 写入前预留空间的回调 reserve(字节数)
+        """
+        self.target_dir = target_dir
+        self.on_file = on_file
+        self.reserve = reserve
+        self._archive = open(archive_path, "wb")
+        self.archive_path = archive_path
+        self._buffer = bytearray()
+        self._state = "header"
+        self._entry = None
+        self._descriptor_length = 0
+        # 已解压的条目名，finish() 时跳过
+        self.extracted = set()
+        self.streaming = True
+        self._count = 0
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self._archive.write(data)
+        if not self.streaming or self._state == "done":
+            return
+        self._buffer += data
+        while self._step():
+            pass
+
+    def _step(self):
+        # 处理缓冲区中的数据，返回 False 表示需要更多数据
+        buffer = self._buffer
+        if self._state == "header":
+            if len(buffer) < 4:
+                return False
+            signature = bytes(buffer[:4])
+            if signature in _END_SIGNATURES:
+                self._state = "done"
+                self._buffer = bytearray()
+                return False
+            if signature != _LOCAL_SIGNATURE:
+                raise UploadError("压缩包格式无效")
+            if len(buffer) < _LOCAL_HEADER.size:
+                return False
+            fields = _LOCAL_HEADER.unpack_from(buffer)
+            flags, method, compressed_size, name_length, extra_length = \
+                fields[2], fields[3], fields[7], fields[9], fields[10]
+            header_length = _LOCAL_HEADER.size + name_length + extra_length
+            if len(buffer) < header_length:
+                return False
+            raw_name = bytes(buffer[_LOCAL_HEADER.size:_LOCAL_HEADER.size + name_length])
+            name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+            zip64 = self._has_zip64(bytes(buffer[_LOCAL_HEADER.size + name_length:header_length]))
+            descriptor = bool(flags & 0x08)
+            del buffer[:header_length]
+            if flags & 0x01 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) \
+                    or (method == zipfile.ZIP_STORED and (descriptor or compressed_size == 0xFFFFFFFF)):
+                # 剩余部分在上传结束后按中央目录解压
+                self.streaming = False
+                self._buffer = bytearray()
+                return False
+            base = _safe_name(name)
+            self._count += 1
+            path = os.path.join(self.target_dir, "{:06d}_{}".format(self._count, base)) if base else None
+            self._entry = {
+                "name": name, "path": path, "file": open(path, "wb") if path else None,
+                "method": method, "remaining": compressed_size, "descriptor": descriptor, "zip64": zip64,
+                "inflater": zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None,
+            }
+            self._state = "data"
+            return True
+
+        if self._state == "data":
+            entry = self._entry
+            if not buffer:
+                return False
+            if entry["inflater"] is None:
+                chunk = bytes(buffer[:entry["remaining"]])
+                del buffer[:len(chunk)]
+                entry["remaining"] -= len(chunk)
+                self._write(entry, chunk)
+                if entry["remaining"]:
+                    return False
+            else:
+                inflater = entry["inflater"]
+                # 分段解压，限制单次解压的输出大小
+                output = inflater.decompress(bytes(buffer), 1 << 20)
+                consumed = len(buffer) - len(inflater.unconsumed_tail) - len(inflater.unused_data)
+                del buffer[:consumed]
+                self._write(entry, output)
+                if not inflater.eof:
+                    return consumed > 0 or bool(output)
+            self._close_entry()
+            if entry["descriptor"]:
+                self._descriptor_length = (16 if entry["zip64"] else 8) + 4
+                self._state = "descriptor"
+            else:
+                self._state = "header"
+            return True
+
+        if self._state == "descriptor":
+            if len(buffer) < 4:
+                return False
+            length = self._descriptor_length
+            if bytes(buffer[:4]) == _DESCRIPTOR_SIGNATURE:
+                length += 4
+            if len(buffer) < length:
+                return False
+            del buffer[:length]
+            self._state = "header"
+            return True
+        return False
+
+    @staticmethod
+    def _has_zip64(extra):
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, length = struct.unpack_from("<HH", extra, offset)
+            if header_id == 0x0001:
+                return True
+            offset += 4 + length
+        return False
+
+    def _write(self, entry, data):
+        if entry["file"] is not None and data:
+            self.reserve(len(data))
+            entry["file"].write(data)
+
+    def _close_entry(self):
+        entry = self._entry
+        self.extracted.add(entry["name"])
+        if entry["file"] is not None:
+            entry["file"].close()
+            self.on_file(entry["path"])
+        self._entry = None
+
+    def finish(self):
+        """
+        上传结束：流式处理中断时按中央目录解压剩余的文件，最后删除原始压缩包
+        """
+        self._archive.close()
+        if self._state not in ("header", "done") and self.streaming:
+            raise UploadError("压缩包不完整")
+        if not self.streaming:
+            try:
+                with zipfile.ZipFile(self.archive_path) as archive:
+                    for info in archive.infolist():
+                        base = _safe_name(info.filename)
+                        if info.filename in self.extracted or base is None:
+                            continue
+                        self._count += 1
+                        path = os.path.join(self.target_dir, "{:06d}_{}".format(self._count, base))
+                        self.reserve(info.file_size)
+                        with archive.open(info) as src, open(path, "wb") as dst:
+                            shutil.copyfileobj(src, dst, 1 << 20)
+                        self.on_file(path)
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+                raise UploadError(f"无法解压压缩包: {str(e)}")
+        os.remove(self.archive_path)
+
+    def close(self):
+        if self._entry is not None and self._entry["file"] is not None:
+            self._entry["file"].close()
+        self._archive.close()
+
+
+class SeriesUpload:
+    """
+    一次上传：解析 multipart 请求体，压缩包解压到 <临时目录>/dicom，ROI文件保存在 <临时目录>/roi/<文件名>
+    (roi_file 为相对于DICOM目录上一级的路径，与 resolve_roi_path 的约定一致)
+    feed() 与 finish() 执行文件IO，应在IO线程中调用
+    """
+    def __init__(self, content_type, spool_dir=None, max_bytes=None, quota=None):
+        content_type, options = parse_options_header(content_type or "")
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            raise UploadError("请求必须为 multipart/form-data")
+        self.max_bytes = config.UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+        self.quota = quota or get_spool_quota()
+        self.upload_dir = os.path.join(spool_dir or config.UPLOAD_SPOOL_DIR, uuid.uuid4().hex)
+        self.dicom_dir = os.path.join(self.upload_dir, "dicom")
+        os.makedirs(self.dicom_dir)
+        self.bytes = 0
+        self.roi_file = None
+        self.fields = {}
+        # 已检查的DICOM文件数、跳过的非DICOM文件数、序列UID与层尺寸
+        self.slice_count = 0
+        self.skipped = 0
+        self.series_uid = None
+        self._slice_size = None
+        self._direction = None
+        self._extractor = None
+        self._part = None
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._parser = MultipartParser(options[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": lambda data, start, end: self._append_header("_header_field", data[start:end]),
+            "on_header_value": lambda data, start, end: self._append_header("_header_value", data[start:end]),
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": lambda data, start, end: self._on_part_data(data[start:end]),
+            "on_part_end": self._on_part_end,
+        })
+
+    def _reserve(self, amount):
+        # 单次上传的限制 (413) 与所有上传共用的临时空间 (503)
+        if self.max_bytes and self.bytes + amount > self.max_bytes:
+            raise UploadError("上传内容超过大小限制", 413)
+        self.quota.reserve(amount)
+        self.bytes += amount
+
+    def _append_header(self, name, data):
+        setattr(self, name, getattr(self, name) + data)
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8")
+        filename = options.get(b"filename")
+        if name == ARCHIVE_FIELD:
+            if self._extractor is not None:
+                raise UploadError("只能上传一个压缩包")
+            self._extractor = ZipStreamExtractor(os.path.join(self.upload_dir, "archive.zip"), self.dicom_dir,
+                                                 self._check_slice, self._reserve)
+            self._part = ("archive", self._extractor)
+        elif name == ROI_FIELD:
+            roi_file = _safe_name(filename.decode("utf-8")) if filename else None
+            if not roi_file or self.roi_file is not None:
+                raise UploadError("ROI文件名无效")
+            self.roi_file = os.path.join(ROI_SUBDIR, roi_file)
+            os.makedirs(os.path.join(self.upload_dir, ROI_SUBDIR), exist_ok=True)
+            self._part = ("roi", open(os.path.join(self.upload_dir, self.roi_file), "wb"))
+        else:
+            self._part = ("field", name, bytearray())
+
+    def _on_part_data(self, data):
+        kind = self._part[0]
+        if kind == "archive":
+            self._part[1].feed(data)
+        elif kind == "roi":
+            self._reserve(len(data))
+            self._part[1].write(data)
+        else:
+            value = self._part[2]
+            if len(value) + len(data) > MAX_FIELD_BYTES:
+                raise UploadError("表单字段过长")
+            value += data
+
+    def _on_part_end(self):
+        kind = self._part[0]
+        if kind == "roi":
+            self._part[1].close()
+        elif kind == "field":
+            self.fields[self._part[1]] = self._part[2].decode("utf-8")
+        self._part = None
+
+    def _check_slice(self, path):
+        """
+        每个文件解压完成时立即读取文件头：非DICOM文件删除，序列UID、层尺寸与方向需与第一层一致
+        """
+        if not is_dicom_file(path):
+            os.remove(path)
+            self.skipped += 1
+            return
+        try:
+            reader = _read_image_information(path)
+        except RuntimeError:
+            raise UploadError(f"无法读取DICOM文件头: {os.path.basename(path)}")
+        series_uid = reader.GetMetaData(SERIES_INSTANCE_UID_TAG).strip() \
+            if reader.HasMetaDataKey(SERIES_INSTANCE_UID_TAG) else None
+        slice_size = tuple(reader.GetSize()[:2])
+        direction = reader.GetDirection()
+        if self.slice_count == 0:
+            self.series_uid, self._slice_size, self._direction = series_uid, slice_size, direction
+        elif series_uid != self.series_uid:
+            raise UploadError("压缩包中包含多个DICOM序列")
+        elif slice_size != self._slice_size:
+            raise UploadError("DICOM文件的层尺寸不一致: {} 与 {}".format(slice_size, self._slice_size))
+        elif max(abs(a - b) for a, b in zip(direction, self._direction)) > DIRECTION_TOLERANCE:
+            raise UploadError("DICOM文件的层方向不一致: {}".format(os.path.basename(path)))
+        self.slice_count += 1
+
+    def feed(self, chunk):
+        self._parser.write(chunk)
+
+    def finish(self):
+        """
+        请求体接收完毕：完成压缩包的解压并检查ROI文件头
+        """
+        self._parser.finalize()
+        if self._extractor is None:
+            raise UploadError("缺少DICOM压缩包 (字段 {})".format(ARCHIVE_FIELD))
+        if self.roi_file is None:
+            raise UploadError("缺少ROI文件 (字段 {})".format(ROI_FIELD))
+        if self._part is not None:
+            raise UploadError("上传内容不完整")
+        self._extractor.finish()
+        if self.slice_count == 0:
+            raise UploadError("压缩包中没有DICOM文件")
+        try:
+            _read_image_information(os.path.join(self.upload_dir, self.roi_file))
+        except RuntimeError:
+            raise UploadError("无法读取ROI文件")
+
+    def label_values(self):
+        # 表单中的 label_values 为JSON数组，未指定时为 None
+        value = self.fields.get("label_values")
+        if not value:
+            return None
+        try:
+            labels = json.loads(value)
+        except ValueError:
+            raise UploadError("label_values 必须为JSON数组")
+        if labels is not None and not isinstance(labels, list):
+            raise UploadError("label_values 必须为JSON数组")
+        return labels
+
+    def flag(self, name):
+        return self.fields.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+    def summary(self):
+        return {"bytes": self.bytes, "slice_count": self.slice_count, "skipped_files": self.skipped,
+                "series_uid": self.series_uid,
+                "roi_file": os.path.basename(self.roi_file) if self.roi_file else None}
+
+    def cleanup(self):
+        # 删除临时目录并归还预留的空间
+        if self._extractor is not None:
+            self._extractor.close()
+        if self._part is not None and self._part[0] == "roi":
+            self._part[1].close()
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+        self.quota.release(self.bytes)
+        self.bytes = 0
@@ -1,149 +1,1021 @@
 # coding: utf8
 import os
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import SimpleITK as sitk
+from utils import config
+from utils.cache import file_fingerprint, get_mask_cache
+from utils.metrics import timed
+from utils.nifti import memmap_nifti
 
-def get_volumer(file_type=''):
+# 标签统计时每个分块的最大体素数，用于限制 bincount 产生的临时数组大小
+LABEL_CHUNK_VOXELS = 1 << 22
+
+
+def get_volumer(file_type='', **options):
     if file_type.lower() == 'dicom':
-        runner = DicomVolumer()
+        runner = DicomVolumer(**options)
     elif file_type.lower() == 'nii':
-        runner = NiiVolumer()
+        runner = NiiVolumer(**options)
     else:
         raise ValueError('Invalid file type')
     return runner
 
+
+def _iter_blocks(array, chunk_voxels=LABEL_CHUNK_VOXELS):
+    # 沿第一个轴 (z) 分块，每块最多 chunk_voxels 个体素
+    if array.ndim == 0 or array.size == 0:
+        return
+    step = max(1, chunk_voxels // max(1, array.size // array.shape[0]))
+    for start in range(0, array.shape[0], step):
+        yield array[start:start + step]
+
+
+def label_histogram(mask_array, chunk_voxels=LABEL_CHUNK_VOXELS):
+    """
+    单次遍历统计掩膜中所有标签值的体素数
+    8/16位整数掩膜按分块做 bincount (有符号类型按无符号位模式统计后还原)，
+    其他类型按分块做 np.unique 后合并
+    :param mask_array: 掩膜数组
+    :param chunk_voxels: 每个分块的最大体素数
+    :return: {标签值: 体素数}
+    """
+    dtype = mask_array.dtype
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        unsigned = np.dtype('u{}'.format(dtype.itemsize)).newbyteorder(dtype.byteorder)
+        counts = np.zeros(1 << (8 * dtype.itemsize), dtype=np.int64)
+        for block in _iter_blocks(mask_array, chunk_voxels):
+            counts += np.bincount(block.reshape(-1).view(unsigned), minlength=counts.size)
+        values = np.arange(counts.size, dtype=unsigned).view(dtype)
+        present = np.flatnonzero(counts)
+        return {values[i].item(): int(counts[i]) for i in present}
+
+    histogram = {}
+    for block in _iter_blocks(mask_array, chunk_voxels):
+        values, block_counts = np.unique(block, return_counts=True)
+        for value, count in zip(values.tolist(), block_counts.tolist()):
+            histogram[value] = histogram.get(value, 0) + count
+    return histogram
+
+
+def nonzero_bounding_box(mask_array, chunk_voxels=LABEL_CHUNK_VOXELS):
+    """
+    单次分块遍历计算掩膜中非零体素的包围盒
+    :param mask_array: 掩膜数组 (维度顺序: z, y, x)
+    :return: ((x0, y0, z0), (x1, y1, z1)) 含两端的索引范围，掩膜全为零时返回 None
+    """
+    nz, ny, nx = mask_array.shape
+    any_z = np.zeros(nz, dtype=bool)
+    any_y = np.zeros(ny, dtype=bool)
+    any_x = np.zeros(nx, dtype=bool)
+    z = 0
+    for block in _iter_blocks(mask_array, chunk_voxels):
+        nonzero = block != 0
+        any_z[z:z + block.shape[0]] = nonzero.any(axis=(1, 2))
+        any_y |= nonzero.any(axis=(0, 2))
+        any_x |= nonzero.any(axis=(0, 1))
+        z += block.shape[0]
+    if not any_z.any():
+        return None
+    bounds = [np.flatnonzero(axis) for axis in (any_x, any_y, any_z)]
+    return tuple(int(b[0]) for b in bounds), tuple(int(b[-1]) for b in bounds)
+
+
+def merge_histograms(target, other):
+    # 将 other 中的体素数累加到 target
+    for label, count in other.items():
+        target[label] = target.get(label, 0) + count
+    return target
+
+
+def _label_index(labels):
+    """
+    将一维标签数组映射为 bincount 下标
+    8/16位整数与 label_histogram 相同，按无符号位模式直接作为下标，其他类型用 np.unique 编号
+    :return: (下标对应的标签值数组, 下标数组)
+    """
+    dtype = labels.dtype
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        unsigned = np.dtype('u{}'.format(dtype.itemsize)).newbyteorder(dtype.byteorder)
+        index = labels.view(unsigned)
+        return np.arange(int(index.max()) + 1, dtype=unsigned).view(dtype), index
+    return np.unique(labels, return_inverse=True)
+
+
+class IntensityStats:
+    """
+    按标签累计参考图像 (CT值) 的体素数、和、平方和、最小值与最大值，用于计算均值、标准差与范围
+    每个分块只做一次向量化统计：标签值映射为下标后用带权重的 bincount 求和，
+    np.minimum.at / np.maximum.at 求极值，不按标签逐个生成掩码；只统计非零标签
+    """
+    def __init__(self, image_array, chunk_voxels=LABEL_CHUNK_VOXELS):
+        """
+        :param image_array: 参考网格上的图像数组 (维度顺序: z, y, x)
+        """
+        self.image_array = image_array
+        self.chunk_voxels = chunk_voxels
+        # {标签值: [体素数, 和, 平方和, 最小值, 最大值]}
+        self._labels = {}
+
+    def add(self, mask_array, start_index):
+        """
+        累计参考网格中从 start_index (x, y, z) 开始、与 mask_array 同样大小的子区域
+        :param mask_array: 参考网格子区域上的标签数组 (维度顺序: z, y, x)
+        """
+        x0, y0, z0 = start_index
+        nz, ny, nx = mask_array.shape
+        image = self.image_array[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx]
+        step = max(1, self.chunk_voxels // max(1, ny * nx))
+        for z in range(0, nz, step):
+            self._add_block(mask_array[z:z + step], image[z:z + step])
+
+    def _add_block(self, mask_block, image_block):
+        selected = mask_block != 0
+        labels = mask_block[selected]
+        if labels.size == 0:
+            return
+        values = image_block[selected].astype(np.float64)
+        keys, index = _label_index(labels)
+        counts = np.bincount(index, minlength=keys.size)
+        sums = np.bincount(index, weights=values, minlength=keys.size)
+        squares = np.bincount(index, weights=values * values, minlength=keys.size)
+        minimum = np.full(keys.size, np.inf)
+        maximum = np.full(keys.size, -np.inf)
+        np.minimum.at(minimum, index, values)
+        np.maximum.at(maximum, index, values)
+        for i in np.flatnonzero(counts):
+            label = keys[i].item()
+            bucket = self._labels.get(label)
+            if bucket is None:
+                self._labels[label] = [int(counts[i]), sums[i], squares[i], minimum[i], maximum[i]]
+            else:
+                bucket[0] += int(counts[i])
+                bucket[1] += sums[i]
+                bucket[2] += squares[i]
+                bucket[3] = min(bucket[3], minimum[i])
+                bucket[4] = max(bucket[4], maximum[i])
+
+    def results(self):
+        """
+        :return: {标签值: {mean_hu, min_hu, max_hu, std_hu}}，只包含有体素的非零标签
+        """
+        results = {}
+        for label, (count, total, squares, minimum, maximum) in self._labels.items():
+            mean = total / count
+            results[label] = {
+                "mean_hu": float(mean),
+                "min_hu": float(minimum),
+                "max_hu": float(maximum),
+                # 总体标准差，舍入误差可能使方差略小于0
+                "std_hu": float(np.sqrt(max(squares / count - mean * mean, 0.0))),
+            }
+        return results
+
+
+class LabelBoxes:
+    """
+    按标签累计参考网格上的包围盒 (x, y, z 索引，含两端)
+    每个分块取非零体素的坐标，按标签下标用 np.minimum.at / np.maximum.at 求各轴的范围
+    """
+    def __init__(self, chunk_voxels=LABEL_CHUNK_VOXELS):
+        self.chunk_voxels = chunk_voxels
+        # {标签值: ([x0, y0, z0], [x1, y1, z1])}
+        self._labels = {}
+
+    def add(self, mask_array, start_index):
+        """
+        :param mask_array: 参考网格中从 start_index (x, y, z) 开始的子区域上的标签数组 (维度顺序: z, y, x)
+        """
+        nz, ny, nx = mask_array.shape
+        step = max(1, self.chunk_voxels // max(1, ny * nx))
+        for z in range(0, nz, step):
+            offset = (start_index[0], start_index[1], start_index[2] + z)
+            self._add_block(mask_array[z:z + step], offset)
+
+    def _add_block(self, mask_block, offset):
+        zs, ys, xs = np.nonzero(mask_block)
+        if zs.size == 0:
+            return
+        keys, index = _label_index(mask_block[zs, ys, xs])
+        lower = np.full((keys.size, 3), np.iinfo(np.int64).max, dtype=np.int64)
+        upper = np.full((keys.size, 3), -1, dtype=np.int64)
+        for axis, coords in enumerate((xs, ys, zs)):
+            np.minimum.at(lower[:, axis], index, coords)
+            np.maximum.at(upper[:, axis], index, coords)
+        # keys 可能包含本块中没有出现的标签值 (见 _label_index)，先筛选再平移，避免越界
+        present = np.flatnonzero(upper[:, 0] >= 0)
+        lower += offset
+        upper += offset
+        for i in present:
+            label = keys[i].item()
+            box = self._labels.get(label)
+            if box is None:
+                self._labels[label] = (lower[i].tolist(), upper[i].tolist())
+            else:
+                self._labels[label] = (np.minimum(box[0], lower[i]).tolist(), np.maximum(box[1], upper[i]).tolist())
+
+    def results(self):
+        """
+        :return: {标签值: ([x0, y0, z0], [x1, y1, z1])}
+        """
+        return dict(self._labels)
+
+
+# 各标签的CT值统计字段
+INTENSITY_FIELDS = ("mean_hu", "min_hu", "max_hu", "std_hu")
+
+
+def build_label_volumes(histogram, voxel_volume, label_values=None, intensity=None):
+    """
+    由标签直方图计算各标签体积
+    :param histogram: {标签值: 体素数}
+    :param voxel_volume: 单个体素的体积 (mm³)
+    :param label_values: 要计算体积的标签值列表 (None表示所有非零标签)
+    :param intensity: 可选的各标签CT值统计 {标签值: {mean_hu, min_hu, max_hu, std_hu}} (IntensityStats.results)
+    :return: 体积字典 {标签值: {voxel_count, volume_mm3, volume_cm3, volume_ml}}，
+             指定 intensity 时还包含 mean_hu、min_hu、max_hu、std_hu (标签没有体素时为 None)
+    """
+    if label_values is None:
+        # 获取所有非零标签
+        label_values = sorted(label for label in histogram if label != 0)
+
+    if len(label_values) == 0:
+        raise ValueError("警告: 掩膜中没有非零标签!")
+
+    volumes = {}
+    for label in label_values:
+        voxel_count = histogram.get(label, 0)
+        volume_mm3 = voxel_count * voxel_volume
+        volumes[label] = {
+            'voxel_count': voxel_count,
+            'volume_mm3': volume_mm3,
+            'volume_cm3': volume_mm3 / 1000.0,
+            'volume_ml': volume_mm3 / 1000.0  # 1 cm³ = 1 mL
+        }
+        if intensity is not None:
+            volumes[label].update(intensity.get(label) or dict.fromkeys(INTENSITY_FIELDS))
+    return volumes
+
+
+def build_label_summary(histogram, voxel_volume, geometry, resample_mode=None, boxes=None, intensity=None):
+    """
+    一个 (序列, ROI) 的标签摘要，可以保存为JSON，之后任意标签子集的体积都由摘要计算，不再读取图像
+    :param histogram: 参考网格上的完整标签直方图 {标签值: 体素数}
+    :param geometry: 参考网格的尺寸、间距、原点、方向与体素体积
+    :param boxes: 可选的各标签包围盒 (LabelBoxes.results)
+    :param intensity: 可选的各标签CT值统计 (IntensityStats.results)
+    """
+    return {
+        "histogram": [[label, count] for label, count in sorted(histogram.items())],
+        "voxel_volume_mm3": voxel_volume,
+        "geometry": geometry,
+        "resample_mode": resample_mode,
+        "bboxes": None if boxes is None else [[label, box[0], box[1]] for label, box in sorted(boxes.items())],
+        "intensity": None if intensity is None else [[label, value] for label, value in sorted(intensity.items())],
+    }
+
+
+def volumes_from_summary(summary, label_values=None, intensity=False):
+    """
+    由标签摘要计算指定标签的体积 (与 get_volume 的结果相同)
+    :param intensity: 是否包含CT值统计，摘要中没有CT值统计时抛出 ValueError
+    :return: 体积字典
+    """
+    if intensity and summary.get("intensity") is None:
+        raise ValueError("标签摘要中没有CT值统计")
+    histogram = {label: count for label, count in summary["histogram"]}
+    stats = {label: value for label, value in summary["intensity"]} if intensity else None
+    return build_label_volumes(histogram, summary["voxel_volume_mm3"], label_values, stats)
+
+class ReferenceGeometry:
+    """
+    参考网格的空间信息 (尺寸、间距、原点、方向)
+    方法名与 sitk.Image 保持一致，可以代替 DICOM 图像作为重采样的参考，而无需解码像素
+    """
+    def __init__(self, size, spacing, origin, direction):
+        self._size = tuple(int(v) for v in size)
+        self._spacing = tuple(float(v) for v in spacing)
+        self._origin = tuple(float(v) for v in origin)
+        self._direction = tuple(float(v) for v in direction)
+
+    @classmethod
+    def from_image(cls, image):
+        return cls(image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["size"], data["spacing"], data["origin"], data["direction"])
+
+    def to_dict(self):
+        return {"size": list(self._size), "spacing": list(self._spacing),
+                "origin": list(self._origin), "direction": list(self._direction)}
+
+    def GetSize(self):
+        return self._size
+
+    def GetSpacing(self):
+        return self._spacing
+
+    def GetOrigin(self):
+        return self._origin
+
+    def GetDirection(self):
+        return self._direction
+
+    def GetDimension(self):
+        return len(self._size)
+
+    def __repr__(self):
+        return "ReferenceGeometry(size={}, spacing={}, origin={}, direction={})".format(
+            self._size, self._spacing, self._origin, self._direction)
+
+
+def map_index_box(source, target, start, end, margin=0):
+    """
+    计算 source 网格中索引范围 [start, end] (含两端的体素) 在 target 网格中对应的子区域
+    按体素边界 (索引 ±0.5) 的8个角点做物理坐标变换，取覆盖这些角点的最小索引范围后向外扩展 margin 个体素
+    :return: (start_index, size)，与 target 网格没有交集时返回 None
+    """
+    src_spacing = np.asarray(source.GetSpacing())
+    src_direction = np.asarray(source.GetDirection()).reshape(3, 3)
+    dst_spacing = np.asarray(target.GetSpacing())
+    dst_direction = np.asarray(target.GetDirection()).reshape(3, 3)
+
+    corners = np.array([[end[axis] + 0.5 if upper else start[axis] - 0.5 for axis, upper in enumerate(choice)]
+                        for choice in np.ndindex(2, 2, 2)], dtype=np.float64)
+    points = np.asarray(source.GetOrigin()) + (corners * src_spacing).dot(src_direction.T)
+    indices = np.linalg.solve(dst_direction * dst_spacing, (points - np.asarray(target.GetOrigin())).T).T
+
+    size = np.asarray(target.GetSize())
+    lower = np.maximum(np.floor(indices.min(axis=0)).astype(np.int64) - margin, 0)
+    upper = np.minimum(np.ceil(indices.max(axis=0)).astype(np.int64) + margin, size - 1)
+    if np.any(lower > upper):
+        return None
+    return tuple(int(v) for v in lower), tuple(int(v) for v in upper - lower + 1)
+
+
+def _ceil_div(a, b):
+    return -((-a) // b)
+
+
+def grid_index_mapping(mask, reference_image, tolerance=None):
+    """
+    判断参考网格的体素中心是否都落在掩膜的体素中心上 (偏差不超过 tolerance 个掩膜体素)，
+    即掩膜索引可以由参考索引经轴置换、翻转、整数倍抽样和整数平移得到
+    此时最近邻重采样等价于按步长切片掩膜数组，不需要 ResampleImageFilter
+    :return: 按参考网格 x, y, z 轴排列的 [(掩膜轴, 步长, 偏移)]，不满足时返回 None
+    """
+    if tolerance is None:
+        tolerance = config.GEOMETRY_TOLERANCE
+    mask_axes = np.asarray(mask.GetDirection()).reshape(3, 3) * np.asarray(mask.GetSpacing())
+    reference_axes = np.asarray(reference_image.GetDirection()).reshape(3, 3) * np.asarray(reference_image.GetSpacing())
+    # 掩膜连续索引 = affine · 参考索引 + offset
+    affine = np.linalg.solve(mask_axes, reference_axes)
+    offset = np.linalg.solve(mask_axes, np.asarray(reference_image.GetOrigin()) - np.asarray(mask.GetOrigin()))
+    steps = np.rint(affine)
+    shifts = np.rint(offset)
+
+    # 每个参考轴恰好对应一个不同的掩膜轴
+    nonzero = steps != 0
+    if not (np.all(nonzero.sum(axis=0) == 1) and np.all(nonzero.sum(axis=1) == 1)):
+        return None
+    # 偏差是参考索引的仿射函数，最大值出现在网格的角点
+    extent = np.asarray(reference_image.GetSize()) - 1
+    corners = np.array(list(np.ndindex(2, 2, 2))) * extent
+    deviation = np.abs(corners.dot((affine - steps).T) + (offset - shifts)).max()
+    if deviation > tolerance:
+        return None
+
+    mapping = []
+    for axis in range(3):
+        mask_axis = int(np.flatnonzero(nonzero[:, axis])[0])
+        mapping.append((mask_axis, int(steps[mask_axis, axis]), int(shifts[mask_axis])))
+    return mapping
+
+
+def _mapped_slices(mask_size, reference_size, mapping):
+    # 掩膜数组 (z, y, x) 上的切片，以及切片覆盖的参考网格起始索引 (x, y, z)；没有交集时返回 None
+    slices = [slice(0, 0)] * 3
+    start_index = [0] * 3
+    for axis, (mask_axis, step, shift) in enumerate(mapping):
+        # 参考索引 i 的取值范围: 0 <= shift + step·i <= mask_size - 1
+        last = mask_size[mask_axis] - 1
+        if step > 0:
+            low, high = _ceil_div(-shift, step), (last - shift) // step
+        else:
+            low, high = _ceil_div(last - shift, step), shift // -step
+        low, high = max(low, 0), min(high, reference_size[axis] - 1)
+        if low > high:
+            return None
+        start, stop = shift + step * low, shift + step * high + (1 if step > 0 else -1)
+        # 数组维度顺序为 (z, y, x)
+        slices[2 - mask_axis] = slice(start, stop if stop >= 0 else None, step)
+        start_index[axis] = low
+    return tuple(slices), tuple(start_index)
+
+
+def mapped_array_view(mask_array, mask_size, reference_size, mapping):
+    """
+    按 grid_index_mapping 的结果切片掩膜数组，返回落在参考网格内的部分 (不复制)
+    视图的轴顺序与掩膜数组相同，只用于统计直方图；与参考网格没有交集时返回 None
+    """
+    mapped = _mapped_slices(mask_size, reference_size, mapping)
+    return mask_array[mapped[0]] if mapped is not None else None
+
+
+def mapped_reference_view(mask_array, mask_size, reference_size, mapping):
+    """
+    与 mapped_array_view 相同，但视图按参考网格的轴顺序 (z, y, x) 排列，与参考图像逐体素对应
+    :return: (视图, 视图在参考网格中的起始索引 (x, y, z))，与参考网格没有交集时返回 None
+    """
+    mapped = _mapped_slices(mask_size, reference_size, mapping)
+    if mapped is None:
+        return None
+    slices, start_index = mapped
+    # 切片后第 2 - mask_axis 维对应参考网格的第 axis 维
+    axes = [2 - mapping[2 - k][0] for k in range(3)]
+    return mask_array[slices].transpose(axes), start_index
+
+
+def describe_mapping(mapping, mask_size, reference_size):
+    # 将索引映射描述为数组操作列表，用于日志和接口返回
+    operations = []
+    if [mask_axis for mask_axis, _, _ in mapping] != [0, 1, 2]:
+        operations.append('permute')
+    if any(step < 0 for _, step, _ in mapping):
+        operations.append('flip')
+    if any(abs(step) > 1 for _, step, _ in mapping):
+        operations.append('subsample')
+    if any(shift != (mask_size[mask_axis] - 1 if step < 0 else 0) for mask_axis, step, shift in mapping):
+        operations.append('shift')
+    if not operations and any(mask_size[mask_axis] != reference_size[axis]
+                              for axis, (mask_axis, _, _) in enumerate(mapping)):
+        # 原点与间距相同，只是尺寸不同
+        operations.append('subregion')
+    return operations
+
+
+class MappedImage(ReferenceGeometry):
+    """
+    内存映射的掩膜 (未压缩NIfTI)，空间信息由文件头计算
+    与参考网格对齐时直接在映射的数组上统计，需要重采样时再转换为 sitk.Image
+    """
+    def __init__(self, array, size, spacing, origin, direction):
+        super().__init__(size, spacing, origin, direction)
+        # 维度顺序: (z, y, x)
+        self.array = array
+
+    def to_image(self, start=None, end=None):
+        """
+        转换为 sitk.Image，指定 start/end (x, y, z 索引，含两端) 时只复制该子区域，原点相应平移
+        """
+        array, origin = self.array, self.GetOrigin()
+        if start is not None:
+            array = array[start[2]:end[2] + 1, start[1]:end[1] + 1, start[0]:end[0] + 1]
+            direction = np.asarray(self.GetDirection()).reshape(3, 3)
+            origin = (np.asarray(origin) + direction.dot(np.asarray(self.GetSpacing()) * np.asarray(start))).tolist()
+        image = sitk.GetImageFromArray(array.astype(array.dtype.newbyteorder('='), copy=False))
+        image.SetSpacing(self.GetSpacing())
+        image.SetOrigin(origin)
+        image.SetDirection(self.GetDirection())
+        return image
+
+
+def _read_image_information(file_path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def read_series_geometry(dicom_files):
+    """
+    仅读取DICOM文件头，计算与 ImageSeriesReader.Execute() 一致的图像网格
+    与ITK的处理方式相同：文件顺序沿用 GetGDCMSeriesFileNames 的排序结果，
+    原点与方向取自第一层 (层方向为行方向与列方向的叉积，与文件顺序无关)，层间距为第一层与最后一层的距离除以层数减一
+    :param dicom_files: 已排序的DICOM文件列表
+    :return: ReferenceGeometry
+    """
+    if not dicom_files:
+        raise FileNotFoundError("DICOM文件列表为空")
+    first = _read_image_information(dicom_files[0])
+    size = list(first.GetSize())
+    spacing = list(first.GetSpacing())
+    origin = first.GetOrigin()
+    direction = list(first.GetDirection())
+    if len(size) != 3:
+        raise ValueError(f"不支持的DICOM维度: {len(size)}")
+    if len(dicom_files) == 1:
+        return ReferenceGeometry(size, spacing, origin, direction)
+    if size[2] != 1:
+        raise ValueError("不支持由多帧DICOM文件组成的序列")
+
+    last = _read_image_information(dicom_files[-1])
+    offset = np.asarray(last.GetOrigin()) - np.asarray(origin)
+    distance = float(np.linalg.norm(offset))
+    size[2] = len(dicom_files)
+    spacing[2] = distance / (len(dicom_files) - 1) if distance > 0 else 1.0
+    return ReferenceGeometry(size, spacing, origin, direction)
+
+
+def _prefetch_file(file_path, chunk_size=1 << 20):
+    # 顺序读取整个文件 (丢弃内容)，解码时从页缓存读取；网络存储上读取与解码可以重叠
+    total = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return total
+            total += len(chunk)
+
+
+def _pixel_dtype(pixel_id, components):
+    # sitk像素类型对应的numpy类型
+    return sitk.GetArrayFromImage(sitk.Image([1, 1, 1], pixel_id, components)).dtype
+
+
+def read_series_array(dicom_files, workers=None, prefetch=None):
+    """
+    多线程逐层解码DICOM序列，直接写入预先分配的数组，结果与 ImageSeriesReader.Execute() 逐体素一致：
+    网格由 read_series_geometry 计算，像素类型取自第一个文件，其余各层按该类型读取
+    一个线程按顺序提前 prefetch 个文件读入文件内容，workers 个线程解码，
+    每层解码后只复制一次到数组中对应的位置，不拼接各层
+    :param dicom_files: 已排序的DICOM文件列表
+    :param workers: 解码线程数，默认为 config.DICOM_DECODE_WORKERS
+    :param prefetch: 提前读入的文件数，默认为 config.DICOM_PREFETCH_FILES，0 表示不预读
+    :return: (数组 (维度顺序: z, y, x，多分量时最后一维为分量), ReferenceGeometry)
+    """
+    workers = max(1, workers or config.DICOM_DECODE_WORKERS)
+    prefetch = config.DICOM_PREFETCH_FILES if prefetch is None else prefetch
+    geometry = read_series_geometry(dicom_files)
+    first = _read_image_information(dicom_files[0])
+    pixel_id = first.GetPixelID()
+    components = first.GetNumberOfComponents()
+    # 单个文件时可能是多帧，每个文件占 frames 层
+    frames = geometry.GetSize()[2] // len(dicom_files)
+    columns, rows = geometry.GetSize()[:2]
+    shape = (geometry.GetSize()[2], rows, columns) + ((components,) if components > 1 else ())
+    array = np.empty(shape, dtype=_pixel_dtype(pixel_id, components))
+
+    def decode(index):
+        # 文件列表来自 GetGDCMSeriesFileNames，直接指定 GDCMImageIO，省去逐个尝试图像格式
+        reader = sitk.ImageFileReader()
+        reader.SetImageIO('GDCMImageIO')
+        reader.SetFileName(dicom_files[index])
+        reader.SetOutputPixelType(pixel_id)
+        image = reader.Execute()
+        if image.GetSize()[:2] != (columns, rows) or image.GetNumberOfComponentsPerPixel() != components:
+            raise ValueError(f"DICOM文件 {dicom_files[index]} 的尺寸与序列第一层不一致")
+        # 视图在 image 释放前复制到数组中
+        array[index * frames:(index + 1) * frames] = sitk.GetArrayViewFromImage(image).reshape(
+            (frames,) + shape[1:])
+
+    reads = {}
+    pending = []
+    with ThreadPoolExecutor(1) as io_pool, ThreadPoolExecutor(workers) as pool:
+        def schedule_read(index):
+            if prefetch > 0 and index < len(dicom_files):
+                reads[index] = io_pool.submit(_prefetch_file, dicom_files[index])
+
+        for index in range(prefetch):
+            schedule_read(index)
+        for index in range(len(dicom_files)):
+            # 等待本层读入后提交解码，同时预读后面第 prefetch 个文件；
+            # 排队的解码任务不超过线程数的两倍，预读不会远远领先于解码
+            if index in reads:
+                reads.pop(index).result()
+            schedule_read(index + prefetch)
+            if len(pending) >= 2 * workers:
+                pending.pop(0).result()
+            pending.append(pool.submit(decode, index))
+        for future in pending:
+            future.result()
+    return array, geometry
+
+
+def _pixel_nbytes(reader):
+    # 文件头中像素类型的字节数 (含多个分量)
+    return sitk.Image([1, 1, 1], reader.GetPixelID(), reader.GetNumberOfComponents()).GetSizeOfPixelComponent() \
+        * reader.GetNumberOfComponents()
+
+
+def estimate_dicom_size(dicom_dir, probe_files=None):
+    """
+    不排序、不解码，只读取一个DICOM文件头估计序列的网格尺寸：(列数, 行数, 文件数)
+    :return: 尺寸，目录中没有可读取的DICOM文件时返回 None
+    """
+    probe_files = probe_files or config.DICOM_PROBE_FILES
+    names = sorted(entry.name for entry in os.scandir(dicom_dir) if entry.is_file())
+    for name in names[:probe_files]:
+        try:
+            size = _read_image_information(os.path.join(dicom_dir, name)).GetSize()
+        except RuntimeError:
+            continue
+        return (size[0], size[1], len(names) * (size[2] if len(size) > 2 else 1))
+    return None
+
+
+def estimate_volume_memory(reference_size, mask_path, memory_limit=None):
+    """
+    只读取掩膜文件头，估计一次体积计算的内存峰值 (字节)：
+    掩膜体素数据，加上重采样到参考网格的结果 (超出 memory_limit 时分块，按 memory_limit 计)
+    :param reference_size: 参考网格的尺寸 (x, y, z)
+    """
+    memory_limit = config.VOLUME_MEMORY_LIMIT if memory_limit is None else memory_limit
+    reader = _read_image_information(mask_path)
+    pixel_nbytes = _pixel_nbytes(reader)
+    mask_bytes = int(np.prod(reader.GetSize(), dtype=np.int64)) * pixel_nbytes
+    resampled_bytes = int(np.prod(reference_size, dtype=np.int64)) * pixel_nbytes
+    if memory_limit:
+        resampled_bytes = min(resampled_bytes, memory_limit)
+    return mask_bytes + resampled_bytes
+
+
 class Volumer:
     runner = None
-    def __init__(self):
-        pass
+    def __init__(self, trace_memory=False, memory_limit=None, use_memmap=True, crop=None, label_boxes=None):
+        # trace_memory: 是否使用 tracemalloc 记录标签统计的内存峰值 (有额外开销)
+        self.trace_memory = trace_memory
+        # memory_limit: 重采样结果的内存上限 (字节)，超出时沿z轴分块重采样
+        self.memory_limit = memory_limit or config.VOLUME_MEMORY_LIMIT
+        # use_memmap: 未压缩的 .nii 掩膜直接内存映射，不经过 sitk.ReadImage
+        self.use_memmap = use_memmap
+        # crop: 只重采样掩膜非零包围盒覆盖的参考网格子区域
+        self.crop = config.CROP_RESAMPLING if crop is None else crop
+        # 最近一次 get_volume 调用的统计信息，stages 为各阶段耗时 (毫秒)
+        self.stats = {}
+        # label_boxes: 同时统计各标签在参考网格上的包围盒，保存在标签摘要中
+        self.label_boxes = config.LABEL_BOXES if label_boxes is None else label_boxes
+        # 需要统计各标签CT值时为参考网格上的 IntensityStats，在统计标签的同时累计
+        self.intensity = None
+        # 统计包围盒时为 LabelBoxes
+        self.boxes = None
+        # 最近一次 get_volume 调用的标签摘要 (build_label_summary)
+        self.summary = None
 
     def get_volume(self, source, roi, label_values=None):
         return self.runner.get_volume(source, roi)
 
+    def _stage(self, name):
+        # 将代码块的耗时累加到 self.stats['stages'][name]
+        return timed(self.stats.setdefault('stages', {}), name)
+
+    def _add_stat(self, group, key, amount):
+        # 累加 bytes_read、voxels 等计数
+        counts = self.stats.setdefault(group, {})
+        counts[key] = counts.get(key, 0) + int(amount)
+
+    def _record_geometry(self, reference_image, voxel_volume):
+        # 参考网格的尺寸、间距与单个体素的体积 (mm³)，随结果一起返回
+        self.stats['geometry'] = {
+            "size": list(reference_image.GetSize()),
+            "spacing": list(reference_image.GetSpacing()),
+            "voxel_volume_mm3": voxel_volume,
+        }
+
     def _load_nifti_image(self, file_path):
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"文件 {file_path} 不存在")
         image = sitk.ReadImage(file_path)
         return image
 
+    def _load_nifti_geometry(self, file_path):
+        # 仅读取NIfTI文件头构建参考网格
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件 {file_path} 不存在")
+        with self._stage('reference_geometry'):
+            return ReferenceGeometry.from_image(_read_image_information(file_path))
+
+    def _load_mask_image(self, file_path):
+        """
+        加载掩膜图像，按 (路径, 大小, 修改时间) 缓存在进程内
+        同一上级目录下的多个序列共用一个ROI文件时只需解码一次，缓存的图像不可修改
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件 {file_path} 不存在")
+        with self._stage('mask_load'):
+            if self.use_memmap:
+                # 内存映射由操作系统页缓存共享，不放入掩膜缓存
+                mapped = memmap_nifti(file_path)
+                if mapped is not None:
+                    self.stats['mask_loader'] = 'memmap'
+                    # 映射的数据按需读入，这里记录映射的字节数
+                    self._add_stat('bytes_read', 'mask_memmap', mapped[0].nbytes)
+                    return MappedImage(mapped[0], *mapped[1])
+            self.stats['mask_loader'] = 'sitk'
+            cache = get_mask_cache()
+            key = tuple(file_fingerprint(file_path))
+            image = cache.get(key)
+            self.stats['mask_cache_hit'] = image is not None
+            if image is None:
+                image = self._load_nifti_image(file_path)
+                self._add_stat('bytes_read', 'mask', key[1])
+                cache.put(key, image)
+            return image
+
+    def _is_aligned(self, mask, reference_image):
+        # 尺寸相同且体素中心在 GEOMETRY_TOLERANCE 以内一一重合
+        if mask.GetSize() != reference_image.GetSize():
+            return False
+        mapping = grid_index_mapping(mask, reference_image)
+        return mapping is not None and not describe_mapping(mapping, mask.GetSize(), reference_image.GetSize())
+
     def _resample_mask_to_image(self, mask, reference_image):
         """
         将掩膜重采样到参考图像的空间坐标系
         :param mask: 要重采样的掩膜图像
-        :param reference_image: 参考图像 (DICOM图像)
+        :param reference_image: 参考图像 (DICOM图像或 ReferenceGeometry)
         :return: 重采样后的掩膜图像
         """
+        if isinstance(mask, MappedImage):
+            mask = mask.to_image()
         # 检查是否需要重采样
-        if (mask.GetSize() == reference_image.GetSize() and
-                mask.GetSpacing() == reference_image.GetSpacing() and
-                mask.GetOrigin() == reference_image.GetOrigin() and
-                mask.GetDirection() == reference_image.GetDirection()):
+        if self._is_aligned(mask, reference_image):
             print("掩膜已与DICOM图像对齐，无需重采样")
             return mask
+        return self._resample_region(mask, reference_image, (0, 0, 0), reference_image.GetSize())
 
-        # 设置重采样器
+    def _resample_region(self, mask, reference_image, start_index, size):
+        """
+        将掩膜重采样到参考网格中从 start_index 开始、大小为 size 的子区域
+        子区域的原点为参考网格中 start_index 处的物理坐标，间距与方向不变
+        """
+        spacing = np.asarray(reference_image.GetSpacing())
+        direction = np.asarray(reference_image.GetDirection()).reshape(3, 3)
+        origin = np.asarray(reference_image.GetOrigin()) + direction.dot(spacing * np.asarray(start_index))
+
+        # 设置重采样器 (参考图像可以是 sitk.Image 或 ReferenceGeometry)
         resampler = sitk.ResampleImageFilter()
-        resampler.SetReferenceImage(reference_image)
+        resampler.SetSize([int(v) for v in size])
+        resampler.SetOutputSpacing(reference_image.GetSpacing())
+        resampler.SetOutputOrigin(origin.tolist())
+        resampler.SetOutputDirection(reference_image.GetDirection())
         resampler.SetInterpolator(sitk.sitkNearestNeighbor)  # 最近邻插值，保持标签值不变
         resampler.SetOutputPixelType(mask.GetPixelID())
 
         # 执行重采样
-        resampled_mask = resampler.Execute(mask)
+        with self._stage('resample'):
+            resampled_mask = resampler.Execute(mask)
+        self._add_stat('voxels', 'resampled', np.prod(size))
         return resampled_mask
 
+    def _count_mask_labels(self, mask, reference_image):
+        """
+        将掩膜重采样到参考网格并统计标签直方图
+        两个网格的体素中心重合时 (见 grid_index_mapping) 直接在掩膜数组上统计，不重采样
+        启用 crop 时只重采样掩膜非零包围盒 (外扩 CROP_MARGIN 个体素) 覆盖的子区域，区域外的体素
+        最近邻插值的结果必然为0，直接计入背景，因此直方图与整体重采样完全一致
+        重采样结果超过 memory_limit 时沿z轴分块重采样、逐块统计后合并，结果与整体重采样一致
+        """
+        mapping = grid_index_mapping(mask, reference_image)
+        if mapping is not None:
+            return self._count_array_labels(mask, reference_image, mapping)
+
+        total_voxels = int(np.prod(reference_image.GetSize()))
+        start_index, size = (0, 0, 0), tuple(reference_image.GetSize())
+        if self.crop:
+            with self._stage('bbox'):
+                array = mask.array if isinstance(mask, MappedImage) else sitk.GetArrayViewFromImage(mask)
+                bbox = nonzero_bounding_box(array)
+                region = None
+                if bbox is not None:
+                    region = map_index_box(mask, reference_image, bbox[0], bbox[1], config.CROP_MARGIN)
+            if region is None:
+                # 掩膜全为零或与参考网格没有交集，重采样结果全部为背景
+                self.stats['resample_mode'] = 'empty'
+                return {0: total_voxels}
+            start_index, size = region
+            if isinstance(mask, MappedImage):
+                # 只复制包围盒 (外扩一个体素) 内的掩膜，包围盒外全为零，裁掉不影响最近邻插值的结果
+                mask_size = np.asarray(mask.GetSize())
+                mask = mask.to_image(np.maximum(np.asarray(bbox[0]) - 1, 0),
+                                     np.minimum(np.asarray(bbox[1]) + 1, mask_size - 1))
+        elif isinstance(mask, MappedImage):
+            mask = mask.to_image()
+
+        cropped = size != tuple(reference_image.GetSize())
+        if cropped:
+            self.stats['crop_region'] = {"start": list(start_index), "size": list(size)}
+        histogram = self._count_region_labels(mask, reference_image, start_index, size,
+                                              'crop' if cropped else '')
+        if cropped:
+            # 子区域外的体素均为背景
+            histogram[0] = histogram.get(0, 0) + total_voxels - int(np.prod(size))
+        return histogram
+
+    def _count_array_labels(self, mask, reference_image, mapping):
+        """
+        参考网格的体素中心与掩膜体素中心重合 (可能经过轴置换、翻转、整数倍抽样或平移) 时，
+        直接在掩膜的像素缓冲区 (或内存映射) 的切片视图上统计，不重采样也不复制
+        """
+        mask_size, reference_size = mask.GetSize(), reference_image.GetSize()
+        operations = describe_mapping(mapping, mask_size, reference_size)
+        if operations:
+            self.stats['resample_mode'] = 'array:' + '+'.join(operations)
+            print("掩膜网格与DICOM网格的体素中心重合 ({})，直接切片统计，无需重采样".format(', '.join(operations)))
+        else:
+            self.stats['resample_mode'] = 'aligned'
+            print("掩膜已与DICOM图像对齐，无需重采样")
+
+        array = mask.array if isinstance(mask, MappedImage) else sitk.GetArrayViewFromImage(mask)
+        view = mapped_array_view(array, mask_size, reference_size, mapping)
+        histogram = self._count_labels(view) if view is not None else {}
+        if (self.intensity is not None or self.boxes is not None) and view is not None:
+            self._accumulate_region(*mapped_reference_view(array, mask_size, reference_size, mapping))
+        # 参考网格中落在掩膜范围外的体素为背景
+        outside = int(np.prod(reference_size)) - (view.size if view is not None else 0)
+        if outside:
+            histogram[0] = histogram.get(0, 0) + outside
+        return histogram
+
+    def _count_region_labels(self, mask, reference_image, start_index, size, mode_prefix=''):
+        # 重采样参考网格的子区域并统计直方图，超过 memory_limit 时沿z轴分块
+        nx, ny, nz = size
+        x0, y0, z0 = start_index
+        slice_bytes = nx * ny * mask.GetSizeOfPixelComponent() * mask.GetNumberOfComponentsPerPixel()
+        if slice_bytes * nz <= self.memory_limit:
+            self.stats['resample_mode'] = mode_prefix or 'full'
+            resampled_mask = self._resample_region(mask, reference_image, start_index, size)
+            self._accumulate_region(sitk.GetArrayViewFromImage(resampled_mask), start_index)
+            return self._count_labels(sitk.GetArrayViewFromImage(resampled_mask))
+
+        # 内存上限的一半留给每块的重采样结果，四分之一留给 bincount 的临时数组 (每个体素8字节)
+        slab_depth = max(1, (self.memory_limit // 2) // max(1, slice_bytes))
+        chunk_voxels = max(1 << 16, min(LABEL_CHUNK_VOXELS, self.memory_limit // 32))
+        self.stats['resample_mode'] = mode_prefix + '_slab' if mode_prefix else 'slab'
+        self.stats['slab_depth'] = slab_depth
+        histogram = {}
+        for z in range(0, nz, slab_depth):
+            slab = self._resample_region(mask, reference_image, (x0, y0, z0 + z), (nx, ny, min(slab_depth, nz - z)))
+            self._accumulate_region(sitk.GetArrayViewFromImage(slab), (x0, y0, z0 + z))
+            merge_histograms(histogram, self._count_labels(sitk.GetArrayViewFromImage(slab), chunk_voxels))
+            del slab
+        return histogram
+
+    def _accumulate_region(self, mask_array, start_index):
+        # 参考网格子区域上的标签数组：累计对应的CT值与各标签的包围盒 (都未要求时跳过)
+        if self.intensity is not None:
+            with self._stage('intensity'):
+                self.intensity.add(mask_array, start_index)
+        if self.boxes is not None:
+            with self._stage('label_boxes'):
+                self.boxes.add(mask_array, start_index)
+
+    def _summarize(self, histogram, reference_image, voxel_volume):
+        # 由完整的直方图生成标签摘要，任意标签子集的体积都由摘要计算
+        geometry = dict(self.stats['geometry'], origin=list(reference_image.GetOrigin()),
+                        direction=list(reference_image.GetDirection()))
+        self.summary = build_label_summary(
+            histogram, voxel_volume, geometry, self.stats.get('resample_mode'),
+            self.boxes.results() if self.boxes is not None else None,
+            self.intensity.results() if self.intensity is not None else None)
+        return self.summary
+
+    def _count_labels(self, mask_array, chunk_voxels=LABEL_CHUNK_VOXELS):
+        """
+        单次遍历统计标签直方图，并将耗时和 (可选) 内存峰值累加到 self.stats
+        """
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        with self._stage('label_count'):
+            histogram = label_histogram(mask_array, chunk_voxels)
+        self._add_stat('voxels', 'counted', mask_array.size)
+
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            self.stats['label_count_peak_bytes'] = max(peak, self.stats.get('label_count_peak_bytes', 0))
+            if started_tracing:
+                tracemalloc.stop()
+        return histogram
+
+    def _print_stats(self):
+        print("标签统计: {}个体素, 耗时 {:.2f} ms{}".format(
+            self.stats.get('voxels', {}).get('counted', 0), self.stats.get('stages', {}).get('label_count', 0.0),
+            ", 内存峰值 {} 字节".format(self.stats['label_count_peak_bytes'])
+            if 'label_count_peak_bytes' in self.stats else ""))
+
 
 class NiiVolumer(Volumer):
 
     def get_volume(self, nii_path, roi_path, label_values=None):
-        ct_images = self._load_nifti_image(nii_path)
-        mask_image = self._load_nifti_image(roi_path)
-        # 将掩膜转换为NumPy数组
-        resampled_mask_image = self._resample_mask_to_image(mask_image, ct_images)
-        mask_array = sitk.GetArrayFromImage(resampled_mask_image)  # 维度顺序: (z, y, x)
+        self.stats = {}
+        self.summary = None
+        self.boxes = LabelBoxes() if self.label_boxes else None
+        # 只需要空间信息，仅读取NIfTI文件头
+        ct_images = self._load_nifti_geometry(nii_path)
+        mask_image = self._load_mask_image(roi_path)
 
         # 计算体积
         spacing = ct_images.GetSpacing()
         voxel_volume = spacing[0] * spacing[1] * spacing[2] # 计算单个体素的体积
-        roi_volume = sitk.GetArrayFromImage(mask_image).sum() * voxel_volume # 计算总体积
-
-        # 确定要计算的标签
-        if label_values is None:
-            # 获取所有非零标签
-            label_values = np.unique(mask_array)
-            label_values = label_values[label_values != 0]
-
-        if len(label_values) == 0:
-            raise ValueError("警告: 掩膜中没有非零标签!")
-
-        # 计算每个标签的体积
-        volumes = {}
-        for label in label_values:
-            voxel_count = np.sum(mask_array == label)
-            volume_mm3 = voxel_count * voxel_volume
-            volumes[label] = {
-                'voxel_count': voxel_count,
-                'volume_mm3': volume_mm3,
-                'volume_cm3': volume_mm3 / 1000.0,
-                'volume_ml': volume_mm3 / 1000.0  # 1 cm³ = 1 mL
-            }
-            print(f"标签 {label}: {voxel_count}个体素, {volume_mm3:.2f} mm³ ({volume_mm3 / 1000:.2f} cm³)")
+        self._record_geometry(ct_images, voxel_volume)
+
+        # 重采样后单次遍历统计所有标签，再按 label_values 计算体积
+        try:
+            histogram = self._count_mask_labels(mask_image, ct_images)
+            self._print_stats()
+            volumes = volumes_from_summary(self._summarize(histogram, ct_images, voxel_volume), label_values)
+        finally:
+            self.boxes = None
+        for label, bucket in volumes.items():
+            print(f"标签 {label}: {bucket['voxel_count']}个体素, {bucket['volume_mm3']:.2f} mm³ ({bucket['volume_mm3'] / 1000:.2f} cm³)")
 
         return volumes
 
 
 class DicomVolumer(Volumer):
 
-    def get_volume(self, dicom_dir, roi, label_values=None):
-        ct_images = self._load_dicom_images(dicom_dir)
-        mask_image = self._load_nifti_image(roi)
-        resampled_mask_image = self._resample_mask_to_image(mask_image, ct_images)
-
+    def get_volume(self, dicom_dir, roi, label_values=None, dicom_files=None, geometry=None, intensity=False):
+        """
+        :param dicom_files: 已排序的DICOM文件列表 (可选，例如来自序列索引，省去 GetGDCMSeriesFileNames)
+        :param geometry: 已知的参考网格 ReferenceGeometry (可选，省去读取文件头)
+        :param intensity: 是否同时统计各标签的CT值 (mean_hu、min_hu、max_hu、std_hu)，需要解码DICOM像素
         """
-            计算掩膜中指定标签的体积
-            :param image: DICOM图像 (用于获取空间信息)
-            :param mask: 掩膜图像
-            :param label_values: 要计算体积的标签值列表 (None表示所有非零标签)
-            :return: 体积字典 {标签值: 体积(mm³)}
+        self.stats = {}
+        self.summary = None
+        # 先加载掩膜：ROI文件不存在或无法读取时不必解码DICOM像素
+        mask_image = self._load_mask_image(roi)
+        try:
+            self.boxes = LabelBoxes() if self.label_boxes else None
+            if intensity:
+                # 解码一次像素，在统计标签直方图的同一遍中按标签累计CT值
+                ct_array, ct_images = self._load_dicom_array(dicom_dir, dicom_files)
+                if ct_array.ndim != 3:
+                    raise ValueError("多分量DICOM图像不支持CT值统计")
+                self.intensity = IntensityStats(ct_array)
+            else:
+                # 只需要空间信息，仅读取DICOM文件头，不解码像素
+                ct_images = geometry or self._load_dicom_geometry(dicom_dir, dicom_files)
+
             """
-        # 获取体素间距 (使用DICOM图像的空间信息)
-        spacing = ct_images.GetSpacing()
-        voxel_volume = spacing[0] * spacing[1] * spacing[2]  # mm³
-
-        # 将掩膜转换为NumPy数组
-        mask_array = sitk.GetArrayFromImage(resampled_mask_image)  # 维度顺序: (z, y, x)
-
-        # 确定要计算的标签
-        if label_values is None:
-            # 获取所有非零标签
-            label_values = np.unique(mask_array)
-            label_values = label_values[label_values != 0]
-
-        if len(label_values) == 0:
-            raise ValueError("警告: 掩膜中没有非零标签!")
-
-        # 计算每个标签的体积
-        volumes = {}
-        for label in label_values:
-            voxel_count = np.sum(mask_array == label)
-            volume_mm3 = voxel_count * voxel_volume
-            volumes[label] = {
-                'voxel_count': voxel_count,
-                'volume_mm3': volume_mm3,
-                'volume_cm3': volume_mm3 / 1000.0,
-                'volume_ml': volume_mm3 / 1000.0  # 1 cm³ = 1 mL
-            }
-            # print(f"标签 {label}: {voxel_count}个体素, {volume_mm3:.2f} mm³ ({volume_mm3 / 1000:.2f} cm³)")
+                计算掩膜中指定标签的体积
+                :param image: DICOM图像 (用于获取空间信息)
+                :param mask: 掩膜图像
+                :param label_values: 要计算体积的标签值列表 (None表示所有非零标签)
+                :return: 体积字典 {标签值: 体积(mm³)}
+                """
+            # 获取体素间距 (使用DICOM图像的空间信息)
+            spacing = ct_images.GetSpacing()
+            voxel_volume = spacing[0] * spacing[1] * spacing[2]  # mm³
+            self._record_geometry(ct_images, voxel_volume)
+
+            # 重采样到DICOM网格后单次遍历统计所有标签 (数组维度顺序: z, y, x)，再按 label_values 计算体积
+            histogram = self._count_mask_labels(mask_image, ct_images)
+            self._print_stats()
+            volumes = volumes_from_summary(self._summarize(histogram, ct_images, voxel_volume), label_values,
+                                           intensity)
+        finally:
+            # 释放解码的像素
+            self.intensity = None
+            self.boxes = None
 
         return volumes
 
-    def _load_dicom_images(self, dicom_dir):
+    def _get_dicom_files(self, dicom_dir):
         dicom_dir = os.path.abspath(os.path.expanduser(dicom_dir))
-        # 加载dicom目录
-        reader = sitk.ImageSeriesReader()
-        # 获取DICOM序列的文件名
-        dicom_files = reader.GetGDCMSeriesFileNames(dicom_dir)
+        # 获取DICOM序列的文件名 (已按层位置排序)
+        with self._stage('series_files'):
+            dicom_files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dicom_dir)
         if not dicom_files:
             raise FileNotFoundError(f"在目录 {dicom_dir} 中未找到DICOM文件")
+        return dicom_files
+
+    def _load_dicom_array(self, dicom_dir, dicom_files=None):
+        # 多线程解码dicom目录的全部像素，返回 (数组, ReferenceGeometry)
+        dicom_files = dicom_files or self._get_dicom_files(dicom_dir)
+        with self._stage('series_read'):
+            result = read_series_array(dicom_files)
+        self._add_stat('bytes_read', 'dicom', sum(os.path.getsize(f) for f in dicom_files))
+        return result
+
+    def _load_dicom_images(self, dicom_dir, dicom_files=None):
+        # 加载dicom目录 (解码全部像素)
+        dicom_files = dicom_files or self._get_dicom_files(dicom_dir)
+        if config.DICOM_DECODE_WORKERS > 1:
+            # 多线程解码，结果与 ImageSeriesReader 一致
+            array, geometry = self._load_dicom_array(dicom_dir, dicom_files)
+            ct_images = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+            ct_images.SetSpacing(geometry.GetSpacing())
+            ct_images.SetOrigin(geometry.GetOrigin())
+            ct_images.SetDirection(geometry.GetDirection())
+            return ct_images
+        # 单线程时逐个文件读取没有优势，ImageSeriesReader 复用同一个 ImageIO，开销更小
+        reader = sitk.ImageSeriesReader()
         reader.SetFileNames(dicom_files)
-        ct_images = reader.Execute()
+        with self._stage('series_read'):
+            ct_images = reader.Execute()
+        self._add_stat('bytes_read', 'dicom', sum(os.path.getsize(f) for f in dicom_files))
         return ct_images
+
+    def _load_dicom_geometry(self, dicom_dir, dicom_files=None):
+        # 仅从文件头构建参考网格
+        dicom_files = dicom_files or self._get_dicom_files(dicom_dir)
+        with self._stage('reference_geometry'):
+            return read_series_geometry(dicom_files)
@@ -0,0 +1,528 @@
+# coding: utf8
+"""
+监视目录，发现新到达或修改过的DICOM序列
+
+Linux 上使用 inotify 为每个目录添加监视，只处理发生事件的目录；inotify 不可用或监视数超过系统上限时
+改为轮询：每个目录按修改时间检查，未变化的目录检查间隔逐步加倍 (最长 WATCH_POLL_MAX_SECONDS)，
+因此每轮只检查到期的目录，而不是每次重新遍历整个目录树
+目录在 WATCH_SETTLE_SECONDS 内没有变化 (文件数、大小与最新修改时间不变) 后才视为传输完成，
+其中包含DICOM文件且与上次计算时的签名不同时交给回调
+"""
+import os
+import time
+import heapq
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils import config
+from utils.filehelper import is_dicom_file
+
+# inotify 事件 (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class Inotify:
+    """
+    通过 ctypes 调用 libc 的 inotify 接口 (不需要额外依赖)
+    add() 可以在多个线程中调用
+    """
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(str(e))
+        if fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = fd
+        self._lock = threading.Lock()
+        # 监视描述符与目录的对应关系
+        self.paths = {}
+        self.wds = {}
+
+    def add(self, path):
+        """
+        :return: 是否添加成功；超过 max_user_watches 时抛出 InotifyUnavailable
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                raise InotifyUnavailable("inotify 监视数超过系统上限 (fs.inotify.max_user_watches)")
+            # 目录已被删除或无权限
+            return False
+        with self._lock:
+            self.paths[wd] = path
+            self.wds[path] = wd
+        return True
+
+    def remove(self, path):
+        with self._lock:
+            wd = self.wds.pop(path, None)
+            if wd is not None:
+                self.paths.pop(wd, None)
+        if wd is not None:
+            self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        等待最多 timeout 秒，返回 [(目录, 文件名, 事件)]，目录为 None 表示事件队列溢出
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, None, mask))
+                    continue
+                with self._lock:
+                    path = self.paths.get(wd)
+                    if mask & IN_IGNORED and path is not None:
+                        del self.paths[wd]
+                        if self.wds.get(path) == wd:
+                            del self.wds[path]
+                if path is not None:
+                    events.append((path, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def snapshot_directory(path, roi_file, probe_files):
+    """
+    列出目录一次：子目录、文件签名 (文件数、总大小、最新修改时间，以及上一级ROI文件的大小与修改时间)、
+    用于判断DICOM的前几个文件与该目录中ROI文件的状态 (供子目录中的序列使用)
+    :return: (修改时间, 子目录列表, 签名 (没有文件时为 None), 待检查的文件, ROI文件状态)，目录不存在时返回 None
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        subdirs, probes, own_roi = [], [], None
+        count, size, latest = 0, 0, 0
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        count += 1
+                        size += st.st_size
+                        latest = max(latest, st.st_mtime_ns)
+                        if entry.name == roi_file:
+                            own_roi = "{}:{}".format(st.st_size, st.st_mtime_ns)
+                        if len(probes) < probe_files:
+                            probes.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    signature = None
+    if count:
+        try:
+            st = os.stat(os.path.join(os.path.dirname(path), roi_file))
+            roi = "{}:{}".format(st.st_size, st.st_mtime_ns)
+        except OSError:
+            roi = "-"
+        signature = "{}:{}:{}/{}".format(count, size, latest, roi)
+    return mtime_ns, subdirs, signature, probes, own_roi
+
+
+class _Directory:
+    __slots__ = ("mtime_ns", "subdirs", "roi", "interval", "next_check", "is_series")
+
+    def __init__(self, mtime_ns, subdirs, roi):
+        self.mtime_ns = mtime_ns
+        self.subdirs = set(subdirs)
+        self.roi = roi
+        self.interval = 0.0
+        self.next_check = None
+        self.is_series = False
+
+
+class FolderWatcher:
+    """
+    在后台线程中监视 root 下的所有目录，序列目录稳定后调用 on_settled([(目录, 签名)])
+    """
+    def __init__(self, root, roi_file, on_settled, signatures=None, on_baseline=None, include_existing=True,
+                 backend=None, settle_seconds=None, poll_seconds=None, poll_max_seconds=None, workers=None):
+        """
+        :param root: 监视的根目录
+        :param roi_file: ROI文件名 (位于DICOM目录的上一级)，ROI文件不存在时序列等待ROI到达后再计算
+        :param on_settled: 序列目录稳定且签名变化时的回调 (在监视线程中调用)
+        :param signatures: {目录: 签名} 上次计算时的签名，签名相同的目录不再交给回调
+        :param on_baseline: include_existing 为 False 时，启动时已存在的序列只记录签名，调用 on_baseline([(目录, 签名)])
+        :param include_existing: 启动时已存在但没有签名的序列是否计算
+        :param backend: auto、inotify 或 poll
+        """
+        self.root = os.path.abspath(root)
+        self.roi_file = roi_file
+        self.on_settled = on_settled
+        self.on_baseline = on_baseline
+        self.include_existing = include_existing
+        self.signatures = dict(signatures or {})
+        self.requested_backend = backend or config.WATCH_BACKEND
+        self.settle_seconds = config.WATCH_SETTLE_SECONDS if settle_seconds is None else settle_seconds
+        self.poll_seconds = poll_seconds or config.WATCH_POLL_SECONDS
+        self.poll_max_seconds = max(self.poll_seconds, poll_max_seconds or config.WATCH_POLL_MAX_SECONDS)
+        self.workers = workers or config.DISCOVERY_WORKERS
+        self.probe_files = config.DICOM_PROBE_FILES
+        self.backend = None
+        self.inotify = None
+        self.dirs = {}
+        # 等待稳定的目录 {目录: [截止时间, 上次的签名]} 与按截止时间排序的堆 (过期的项在弹出时跳过)
+        self.pending = {}
+        self._pending_heap = []
+        # 轮询时按下次检查时间排序的堆
+        self._poll_heap = []
+        self.emitted = 0
+        # 已确认的序列目录数，由监视线程维护，stats() 在请求线程中读取时不需要遍历 self.dirs
+        self.series_count = 0
+        self.last_error = None
+        self._add_watches = True
+        self.ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="volumer-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "root": self.root,
+            "backend": self.backend,
+            "ready": self.ready.is_set(),
+            "directories": len(self.dirs),
+            "series": self.series_count,
+            "pending": len(self.pending),
+            "queued": self.emitted,
+            "last_error": self.last_error,
+        }
+
+    def _run(self):
+        if self.requested_backend in ("auto", "inotify"):
+            try:
+                self.inotify = Inotify()
+            except InotifyUnavailable as e:
+                print(f"目录监视: inotify 不可用 ({str(e)})，改为轮询")
+        self.backend = "inotify" if self.inotify else "poll"
+        try:
+            self._walk([self.root], initial=True)
+            self.ready.set()
+            while not self._stop.is_set():
+                self._cycle()
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"目录监视失败: {str(e)}")
+            raise
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def _cycle(self):
+        now = time.monotonic()
+        deadline = self._pending_heap[0][0] if self._pending_heap else now + 1.0
+        if self.inotify is None:
+            if self._poll_heap:
+                deadline = min(deadline, self._poll_heap[0][0])
+            self._stop.wait(max(0.0, min(deadline - now, 1.0)))
+            self._poll_due()
+        else:
+            # 最多等待1秒，以便及时响应停止
+            events = self.inotify.read(min(deadline - now, 1.0))
+            self._handle_events(events)
+        self._settle_due()
+
+    def _switch_to_polling(self, reason):
+        print(f"目录监视: {reason}，改为轮询")
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.backend = "poll"
+        for path in self.dirs:
+            self._schedule_poll(path, self.poll_seconds)
+
+    def _walk(self, paths, initial=False):
+        """
+        并行列出 paths 及其下的所有目录并登记 (inotify 时先添加监视再列出，不会漏掉期间新建的文件)
+        """
+        def visit(path):
+            limit = None
+            if self.inotify is not None and self._add_watches:
+                try:
+                    self.inotify.add(path)
+                except InotifyUnavailable as e:
+                    # 之后的目录不再添加监视，遍历结束后所有目录改为轮询
+                    self._add_watches = False
+                    limit = str(e)
+            snapshot = snapshot_directory(path, self.roi_file, self.probe_files)
+            is_series = None
+            if snapshot is not None and snapshot[2] is not None and (
+                    self.signatures.get(path) == snapshot[2]
+                    or (initial and not self.include_existing and path not in self.signatures)):
+                # 不等待稳定的目录 (已计算或只记录签名) 在此检查是否为序列，ROI文件变化时需要据此重新计算
+                is_series = any(is_dicom_file(probe) for probe in snapshot[3])
+            return path, snapshot, limit, is_series
+
+        baseline = []
+        limit_reason = None
+        pool = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="volumer-watch")
+        try:
+            pending = {pool.submit(visit, path) for path in paths if path not in self.dirs}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, snapshot, limit, is_series = future.result()
+                    limit_reason = limit_reason or limit
+                    if snapshot is None or path in self.dirs:
+                        continue
+                    mtime_ns, subdirs, signature, _, roi = snapshot
+                    self.dirs[path] = _Directory(mtime_ns, subdirs, roi)
+                    if self.inotify is None:
+                        self._schedule_poll(path, self.poll_seconds)
+                    for subdir in subdirs:
+                        if subdir not in self.dirs:
+                            pending.add(pool.submit(visit, subdir))
+                    if signature is None:
+                        continue
+                    if is_series is None:
+                        self._mark(path, signature)
+                    elif is_series:
+                        self._set_series(self.dirs[path])
+                        if self.signatures.get(path) != signature:
+                            baseline.append((path, signature))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if limit_reason is not None:
+            self._switch_to_polling(limit_reason)
+        if baseline:
+            self._baseline(baseline)
+
+    def _baseline(self, entries):
+        # 启动时已存在的序列只记录签名，不计算
+        self.signatures.update(entries)
+        if self.on_baseline is not None:
+            self.on_baseline(entries)
+
+    def _forget(self, path):
+        # 目录被删除或移走：移除其下所有目录的登记
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            directory = self.dirs.pop(current, None)
+            self.pending.pop(current, None)
+            if self.inotify is not None:
+                self.inotify.remove(current)
+            if directory is not None:
+                self.series_count -= directory.is_series
+                stack.extend(directory.subdirs)
+
+    def _set_series(self, directory):
+        if not directory.is_series:
+            directory.is_series = True
+            self.series_count += 1
+
+    def _mark(self, path, signature=None):
+        """
+        目录发生变化，重新开始等待稳定
+        :param signature: 已知的当前签名 (截止时与之比较)，None 表示截止时直接视为稳定 (inotify 期间没有事件)
+        """
+        deadline = time.monotonic() + self.settle_seconds
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = [deadline, signature]
+            heapq.heappush(self._pending_heap, (deadline, path))
+        else:
+            entry[0], entry[1] = deadline, signature
+
+    def _mark_series_children(self, parent):
+        # ROI文件变化时重新检查同一目录下的序列
+        directory = self.dirs.get(parent)
+        if directory is None:
+            return
+        for subdir in directory.subdirs:
+            child = self.dirs.get(subdir)
+            if child is not None and child.is_series:
+                self._mark(subdir)
+
+    def _handle_events(self, events):
+        new_dirs = []
+        for path, name, mask in events:
+            if path is None:
+                # 事件队列溢出，丢失的事件通过比较所有目录的修改时间补回
+                self._resync()
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if path != self.root:
+                    self._forget(path)
+                continue
+            directory = self.dirs.get(path)
+            if directory is None or mask & IN_IGNORED:
+                continue
+            child = os.path.join(path, name) if name else path
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    directory.subdirs.add(child)
+                    new_dirs.append(child)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    directory.subdirs.discard(child)
+                    self._forget(child)
+                continue
+            self._mark(path)
+            if name == self.roi_file:
+                self._mark_series_children(path)
+        if new_dirs:
+            self._walk(new_dirs)
+
+    def _resync(self):
+        for path in list(self.dirs):
+            self._check(path)
+
+    def _schedule_poll(self, path, interval):
+        directory = self.dirs[path]
+        directory.interval = interval
+        directory.next_check = time.monotonic() + interval
+        heapq.heappush(self._poll_heap, (directory.next_check, path))
+
+    def _poll_due(self):
+        now = time.monotonic()
+        while self._poll_heap and self._poll_heap[0][0] <= now and not self._stop.is_set():
+            next_check, path = heapq.heappop(self._poll_heap)
+            directory = self.dirs.get(path)
+            if directory is None or directory.next_check != next_check:
+                # 目录已移除或已重新安排
+                continue
+            changed = self._check(path)
+            if path in self.dirs:
+                # 未变化的目录检查间隔加倍，变化后恢复为最短间隔
+                interval = self.poll_seconds if changed else min(directory.interval * 2, self.poll_max_seconds)
+                self._schedule_poll(path, interval)
+
+    def _check(self, path):
+        """
+        比较目录的修改时间，变化时重新列出 (登记新的子目录、移除已删除的子目录)
+        :return: 目录是否变化
+        """
+        directory = self.dirs.get(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self._forget(path)
+            return True
+        if mtime_ns == directory.mtime_ns:
+            return False
+        snapshot = snapshot_directory(path, self.roi_file, self.probe_files)
+        if snapshot is None:
+            self._forget(path)
+            return True
+        directory.mtime_ns, subdirs, signature, _, roi = snapshot
+        subdirs = set(subdirs)
+        for removed in directory.subdirs - subdirs:
+            self._forget(removed)
+        added = [subdir for subdir in subdirs - directory.subdirs if subdir not in self.dirs]
+        directory.subdirs = subdirs
+        if signature is not None:
+            self._mark(path, signature)
+        if roi != directory.roi:
+            # ROI文件到达或被替换
+            directory.roi = roi
+            self._mark_series_children(path)
+        if added:
+            self._walk(added)
+        return True
+
+    def _settle_due(self):
+        now = time.monotonic()
+        settled = []
+        while self._pending_heap and self._pending_heap[0][0] <= now:
+            deadline, path = heapq.heappop(self._pending_heap)
+            entry = self.pending.get(path)
+            if entry is None:
+                continue
+            if entry[0] > now:
+                # 期间又发生了变化，按新的截止时间重新排队
+                heapq.heappush(self._pending_heap, (entry[0], path))
+                continue
+            snapshot = snapshot_directory(path, self.roi_file, self.probe_files)
+            if snapshot is None or snapshot[2] is None:
+                del self.pending[path]
+                continue
+            _, _, signature, probes, _ = snapshot
+            if entry[1] is not None and signature != entry[1]:
+                # 仍在写入
+                self._mark(path, signature)
+                continue
+            del self.pending[path]
+            directory = self.dirs.get(path)
+            if directory is None or self.signatures.get(path) == signature:
+                continue
+            if not any(is_dicom_file(probe) for probe in probes):
+                continue
+            self._set_series(directory)
+            if signature.endswith("/-"):
+                # ROI文件尚未到达，到达后由上一级目录的变化触发重新检查
+                continue
+            self.signatures[path] = signature
+            settled.append((path, signature))
+        if settled:
+            try:
+                self.on_settled(settled)
+            except Exception as e:
+                # 回调失败 (如数据库被占用) 时稍后重试
+                self.last_error = str(e)
+                print(f"目录监视: 提交计算失败: {str(e)}")
+                for path, _ in settled:
+                    self.signatures.pop(path, None)
+                    self._mark(path)
+                return
+            self.emitted += len(settled)